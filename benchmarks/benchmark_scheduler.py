@@ -0,0 +1,242 @@
+"""
+Benchmarks for bennettbot.scheduler.
+
+For each storage backend, the queue is seeded with a number of due jobs and
+suppressions, and then the dispatcher's cycle of scheduling, reserving and
+finishing a job is repeated, keeping the depth of the queue constant.  For each
+scheduler function, we record how many calls per second it sustains and its p99
+latency.
+
+Results are compared with a saved baseline, so that regressions show up.  Baselines
+depend on the machine they were recorded on, so record one before making a change:
+
+    just benchmark --save   # record a baseline
+    just benchmark          # compare with the baseline
+
+The exit code is 1 if any function is slower than the baseline by more than the
+tolerance.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import math
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+
+import structlog
+
+from bennettbot import connection, scheduler, settings, storage
+
+
+DEFAULT_BASELINE_PATH = Path(__file__).parent / "baseline.json"
+
+# Differences in p99 latency smaller than this are treated as noise
+NOISE_FLOOR_MS = 0.5
+
+FUNCTIONS = [
+    "schedule_job",
+    "reserve_job",
+    "mark_job_done",
+    "get_next_wakeup",
+    "remove_expired_suppressions",
+]
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # log_call would otherwise log every call to the scheduler
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING)
+    )
+
+    results = {}
+    for backend in args.storage:
+        for num_jobs in args.jobs:
+            for num_suppressions in args.suppressions:
+                name = f"{backend} jobs={num_jobs} suppressions={num_suppressions}"
+                results[name] = run_case(
+                    backend, num_jobs, num_suppressions, args.iterations
+                )
+
+    baseline = None
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+
+    regressions = report(results, baseline, args.tolerance)
+
+    if args.save:
+        args.baseline.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    return 1 if regressions else 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--storage",
+        type=_list_of(str),
+        default=list(storage.STORAGES),
+        help="comma-separated storage backends to benchmark",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=_list_of(int),
+        default=[10, 100, 1000],
+        help="comma-separated queue depths",
+    )
+    parser.add_argument(
+        "--suppressions",
+        type=_list_of(int),
+        default=[0, 100],
+        help="comma-separated numbers of suppressions",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=500,
+        help="number of cycles to time for each case",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.0,
+        help="fraction by which results may be worse than the baseline",
+    )
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE_PATH)
+    parser.add_argument(
+        "--save", action="store_true", help="save results as the new baseline"
+    )
+    return parser.parse_args(argv)
+
+
+def run_case(backend, num_jobs, num_suppressions, iterations):
+    """Benchmark each scheduler function with the given backend, queue depth and
+    number of suppressions, returning ops_per_sec and p99_ms for each."""
+
+    timings = {function: [] for function in FUNCTIONS}
+
+    with tempfile.TemporaryDirectory() as tmp_dir, _fresh_scheduler(backend, tmp_dir):
+        for i in range(num_jobs):
+            _schedule_job(i)
+        # Suppressions that don't start until tomorrow, so they must be checked
+        # but don't stop any jobs being reserved
+        tomorrow = scheduler._now() + timedelta(days=1)
+        for i in range(num_suppressions):
+            scheduler.schedule_suppression(
+                f"bench_job{i}", tomorrow, tomorrow + timedelta(hours=1)
+            )
+
+        # As with timeit, garbage collection is disabled while timing, so that
+        # collections don't add noise to the results
+        gc.disable()
+        try:
+            for i in range(num_jobs, num_jobs + iterations):
+                job_id = _timed(timings["reserve_job"], scheduler.reserve_job)
+                _timed(timings["mark_job_done"], scheduler.mark_job_done, job_id)
+                _timed(timings["schedule_job"], _schedule_job, i)
+                _timed(timings["get_next_wakeup"], scheduler.get_next_wakeup)
+                _timed(
+                    timings["remove_expired_suppressions"],
+                    scheduler.remove_expired_suppressions,
+                )
+        finally:
+            gc.enable()
+
+    return {
+        function: {
+            "ops_per_sec": round(len(durations) / sum(durations), 1),
+            "p99_ms": round(_percentile(sorted(durations), 99) * 1000, 3),
+        }
+        for function, durations in timings.items()
+    }
+
+
+def report(results, baseline, tolerance):
+    """Print results, compared with baseline if given, and return a list of the
+    results that are worse than the baseline by more than tolerance."""
+
+    regressions = []
+    for name, functions in results.items():
+        print(name)
+        for function, result in functions.items():
+            line = (
+                f"  {function:<30}{result['ops_per_sec']:>12.1f} ops/sec"
+                f"{result['p99_ms']:>10.3f} ms p99"
+            )
+            previous = (baseline or {}).get(name, {}).get(function)
+            if previous:
+                change = result["p99_ms"] / previous["p99_ms"] - 1
+                line += f"  ({change:+.0%} p99 vs baseline)"
+                slower = result["ops_per_sec"] < previous["ops_per_sec"] * (
+                    1 - tolerance
+                )
+                p99_worse = (
+                    result["p99_ms"] > previous["p99_ms"] * (1 + tolerance)
+                    and result["p99_ms"] - previous["p99_ms"] > NOISE_FLOOR_MS
+                )
+                if slower or p99_worse:
+                    line += "  REGRESSION"
+                    regressions.append(f"{name} {function}")
+            print(line)
+    return regressions
+
+
+@contextmanager
+def _fresh_scheduler(backend, tmp_dir):
+    """Point the scheduler at an empty database (or memory store) in tmp_dir, and
+    restore the original settings afterwards."""
+
+    overrides = {
+        "SCHEDULER_STORAGE": backend,
+        "DB_PATH": Path(tmp_dir) / "benchmark.db",
+        # Nothing listens here, as no dispatcher is running
+        "DISPATCHER_SOCKET_PATH": Path(tmp_dir) / "dispatcher.sock",
+    }
+    originals = {name: getattr(settings, name) for name in overrides}
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+    connection.reset_connections()
+    storage.reset_storage()
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(settings, name, value)
+        connection.reset_connections()
+        storage.reset_storage()
+
+
+def _schedule_job(i):
+    scheduler.schedule_job(f"bench_job{i}", {"n": str(i)}, "#bench", None, 0)
+
+
+def _timed(durations, fn, *args):
+    start = time.perf_counter()
+    rv = fn(*args)
+    durations.append(time.perf_counter() - start)
+    return rv
+
+
+def _percentile(values, percentile):
+    rank = math.ceil(percentile / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+def _list_of(type_):
+    def parse(value):
+        return [type_(item) for item in value.split(",")]
+
+    return parse
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -117,6 +117,13 @@ def register_listeners(app, config, channels, bot_user_id, internal_user_ids):
                 f"{support['keyword']} channel id '{support['support_channel']}' not found"
             )
 
+    # Jobs with a python_entrypoint run in a shared worker, so can't be killed
+    entrypoint_job_types = {
+        job_type
+        for job_type, job_config in config["jobs"].items()
+        if job_config["python_entrypoint"]
+    }
+
     @app.event(
         "app_mention",
         # Don't match app mentions that include tech support keywords; these will be
@@ -204,17 +211,31 @@ def register_listeners(app, config, channels, bot_user_id, internal_user_ids):
             handle_status(event, say)
             return
 
+        if text == "stats" or text.startswith("stats "):
+            handle_stats(event, say, text)
+            return
+
         if text.startswith("remove job id"):
             handle_remove_job(app, event, say, text)
             return
 
+        if text.startswith("kill job id"):
+            handle_kill_job(app, event, say, text, entrypoint_job_types)
+            return
+
+        # A trailing --fresh asks for a job to be run even if a recent result of
+        # the job is cached
+        command_text, fresh = re.subn(r" --fresh$", "", text)
         for slack_config in config["slack"]:
-            if slack_config["regex"].match(text):
+            if slack_config["regex"].match(command_text):
+                event["text"] = command_text
+                event["fresh"] = bool(fresh)
                 if not user_has_permission(
                     app, event, say, text, config["restricted"], internal_user_ids
                 ):
                     return
-                handle_command(app, event, say, slack_config, is_im=is_im)
+                job_config = config["jobs"][slack_config["job_type"]]
+                handle_command(app, event, say, slack_config, job_config, is_im=is_im)
                 return
 
         for namespace, help_config in config["help"].items():
@@ -388,6 +409,69 @@ def handle_remove_job(app, message, say, text):
         say(f"Job id [{job_id}] removed", thread_ts=message.get("thread_ts"))
 
 
+@log_call
+def handle_kill_job(app, message, say, text, entrypoint_job_types):
+    """Kill a running job, and any processes that it started, or remove a job that
+    hasn't started yet."""
+    app.client.reactions_add(
+        channel=message["channel"], timestamp=message["ts"], name="crossed_fingers"
+    )
+    thread_ts = message.get("thread_ts")
+    job_id = int(text.split("kill job id ")[1])
+    jobs = {job["id"]: job for job in scheduler.get_jobs()}
+    job = jobs.get(job_id)
+    if job is None:
+        say(
+            f"Job id [{job_id}] not found in running or scheduled jobs",
+            thread_ts=thread_ts,
+        )
+    elif not job["started_at"]:
+        scheduler.mark_job_done(job_id)
+        say(
+            f"Job id [{job_id}] hadn't started, and has been removed",
+            thread_ts=thread_ts,
+        )
+    elif job["type"] in entrypoint_job_types:
+        say(
+            f"Job id [{job_id}] runs in a worker that is shared with other jobs, "
+            "so it can't be killed",
+            thread_ts=thread_ts,
+        )
+    else:
+        scheduler.request_job_kill(job_id, message["channel"], thread_ts)
+        say(f"Job id [{job_id}] will be killed", thread_ts=thread_ts)
+
+
+@log_call
+def handle_stats(message, say, text):
+    """Report durations and failure rates of recent job runs back to Slack."""
+
+    job_type = text.removeprefix("stats").strip() or None
+    stats = _build_stats(job_type)
+    say(stats, thread_ts=message.get("thread_ts"))
+
+
+def _build_stats(job_type=None, days=30):
+    stats = scheduler.get_job_run_stats(job_type, days=days)
+    if not stats:
+        if job_type:
+            return f"No `{job_type}` jobs have finished in the last {days} days"
+        return f"No jobs have finished in the last {days} days"
+
+    lines = [f"Jobs that finished in the last {days} days:", ""]
+    for s in stats:
+        lines.append(
+            f"* {s['type']}: {_pluralise_runs(s['runs'])}, "
+            f"{s['failure_rate']:.0%} failed, "
+            f"median {s['p50']:.1f}s, p95 {s['p95']:.1f}s"
+        )
+    return "\n".join(lines)
+
+
+def _pluralise_runs(n):
+    return "1 run" if n == 1 else f"{n} runs"
+
+
 def _build_status():
     running_jobs = []
     scheduled_jobs = []
@@ -398,21 +482,22 @@ def _build_status():
         else:
             scheduled_jobs.append(j)
 
-    active_suppressions = []
-    scheduled_suppressions = []
+    active_suppressions, scheduled_suppressions = (
+        scheduler.get_suppression_index().partition(_now())
+    )
 
-    for suppression in scheduler.get_suppressions():
-        if suppression["start_at"] < str(_now()):
-            active_suppressions.append(suppression)
-        else:
-            scheduled_suppressions.append(suppression)
     lines = [f"The time is {_now()}", ""]
 
     if running_jobs:
         lines.append(_pluralise(len(running_jobs), "running job:"))
         lines.append("")
         for j in running_jobs:
-            lines.append(f"* [{j['id']}] {j['type']} (started at {j['started_at']})")
+            details = f"started at {j['started_at']}"
+            if j["pid"]:
+                details += f", pid {j['pid']}"
+            if j["kill_requested"]:
+                details += ", being killed"
+            lines.append(f"* [{j['id']}] {j['type']} ({details})")
         lines.append("")
 
     if scheduled_jobs:
@@ -483,7 +568,7 @@ def user_has_permission(app, event, say, text, restricted_config, internal_user_
     return False
 
 
-def handle_command(app, message, say, slack_config, is_im):
+def handle_command(app, message, say, slack_config, job_config, is_im):
     """
     Check if user has permission to run this command
     Give a thumbs-up to the message, and dispatch to another handler.
@@ -499,7 +584,7 @@ def handle_command(app, message, say, slack_config, is_im):
         "cancel_suppression": handle_cancel_suppression,
     }[slack_config["action"]]
 
-    handler(message, say, slack_config, is_im)
+    handler(message, say, slack_config, job_config, is_im)
 
 
 def _remove_url_formatting(arg):
@@ -513,7 +598,7 @@ def _remove_url_formatting(arg):
 
 
 @log_call
-def handle_schedule_job(message, say, slack_config, is_im=False):
+def handle_schedule_job(message, say, slack_config, job_config, is_im=False):
     """Schedule a job."""
     match = slack_config["regex"].match(message["text"])
     job_args = dict(zip(slack_config["template_params"], match.groups()))
@@ -526,6 +611,9 @@ def handle_schedule_job(message, say, slack_config, is_im=False):
         thread_ts=message.get("thread_ts"),
         delay_seconds=slack_config["delay_seconds"],
         is_im=is_im,
+        priority=job_config["priority"],
+        coalesce=job_config["coalesce"],
+        fresh=message.get("fresh", False),
     )
     if existing_job_is_running:
         say(
@@ -536,14 +624,14 @@ def handle_schedule_job(message, say, slack_config, is_im=False):
 
 
 @log_call
-def handle_cancel_job(message, say, slack_config, _is_im):
+def handle_cancel_job(message, say, slack_config, _job_config, _is_im):
     """Cancel a job."""
 
     scheduler.cancel_job(slack_config["job_type"])
 
 
 @log_call
-def handle_schedule_suppression(message, say, slack_config, _is_im):
+def handle_schedule_suppression(message, say, slack_config, _job_config, _is_im):
     """Schedule a suppression."""
 
     match = slack_config["regex"].match(message["text"])
@@ -565,7 +653,7 @@ def handle_schedule_suppression(message, say, slack_config, _is_im):
 
 
 @log_call
-def handle_cancel_suppression(message, say, slack_config, _is_im):
+def handle_cancel_suppression(message, say, slack_config, _job_config, _is_im):
     """Cancel a suppression."""
 
     scheduler.cancel_suppressions(slack_config["job_type"])
@@ -623,11 +711,23 @@ def handle_help(message, say, config, include_apology):
         f"Enter `{prefix}[category] help` (e.g. `{prefix}{random.choice(list(config['help']))} help`) for more help"
     )
     lines.append(f"Enter `{prefix}status` to see running and scheduled jobs")
+    lines.append(
+        f"Enter `{prefix}stats [job_type]` to see how long recent jobs took and "
+        "how often they failed"
+    )
+    lines.append(
+        "Add `--fresh` to the end of a command to run it even if a recent result "
+        "is cached"
+    )
     lines.append(
         f"Enter `{prefix}remove job id [id]` to remove a job; this will not "
         "cancel jobs that are in progress, but will let you retry a job that "
         "appears to have stalled."
     )
+    lines.append(
+        f"Enter `{prefix}kill job id [id]` to stop a job that is in progress, "
+        "along with any processes that it started."
+    )
     say("\n".join(lines), thread_ts=message.get("thread_ts"))
 
 
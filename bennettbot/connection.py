@@ -1,36 +1,289 @@
+import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 
 from . import settings
 
 
-SCHEMA = """
-CREATE TABLE IF NOT EXISTS job (
-    id INTEGER PRIMARY KEY,
-    type TEXT NOT NULL,
-    args TEXT,
-    channel TEXT,
-    thread_ts TEXT,
-    start_after DATETIME,
-    started_at DATETIME,
-    is_im BOOLEAN
-);
+# Each migration is a list of statements.  The number of migrations that have
+# been applied to a database is recorded in its user_version, so migrations must
+# only ever be appended to this list.
+MIGRATIONS = [
+    # 1: initial schema.  This uses IF NOT EXISTS, since databases created before
+    # migrations were introduced already have these tables.
+    [
+        """
+        CREATE TABLE IF NOT EXISTS job (
+            id INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            args TEXT,
+            channel TEXT,
+            thread_ts TEXT,
+            start_after DATETIME,
+            started_at DATETIME,
+            is_im BOOLEAN
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS suppression (
+            id INTEGER PRIMARY KEY,
+            job_type TEXT NOT NULL,
+            start_at DATETIME,
+            end_at DATETIME
+        )
+        """,
+    ],
+    # 2: indexes for reserving jobs and removing expired suppressions
+    [
+        # finding running jobs of a given type
+        "CREATE INDEX job_type_started_at_start_after ON job (type, started_at, start_after)",
+        # finding pending jobs that are due, in the order they became due
+        "CREATE INDEX job_started_at_start_after ON job (started_at, start_after)",
+        # finding active suppressions of a given type
+        "CREATE INDEX suppression_job_type_start_at_end_at ON suppression (job_type, start_at, end_at)",
+        # finding expired suppressions
+        "CREATE INDEX suppression_end_at ON suppression (end_at)",
+    ],
+    # 3: history of finished jobs
+    [
+        "ALTER TABLE job ADD COLUMN created_at DATETIME",
+        """
+        CREATE TABLE job_run (
+            id INTEGER PRIMARY KEY,
+            job_id INTEGER,
+            type TEXT NOT NULL,
+            args TEXT,
+            queued_at DATETIME,
+            started_at DATETIME,
+            finished_at DATETIME,
+            rc INTEGER,
+            log_dir TEXT
+        )
+        """,
+        "CREATE INDEX job_run_type_finished_at ON job_run (type, finished_at)",
+        "CREATE INDEX job_run_finished_at ON job_run (finished_at)",
+    ],
+    # 4: job priorities
+    [
+        "ALTER TABLE job ADD COLUMN priority INTEGER NOT NULL DEFAULT 0",
+    ],
+    # 5: recurring jobs
+    [
+        """
+        CREATE TABLE recurring_job (
+            id INTEGER PRIMARY KEY,
+            job_type TEXT NOT NULL,
+            cron TEXT NOT NULL,
+            args TEXT,
+            channel TEXT,
+            catch_up BOOLEAN,
+            priority INTEGER NOT NULL DEFAULT 0,
+            next_run_at DATETIME
+        )
+        """,
+        "CREATE INDEX recurring_job_next_run_at ON recurring_job (next_run_at)",
+    ],
+    # 6: coalescing identical requests into one job
+    [
+        """
+        CREATE TABLE job_recipient (
+            id INTEGER PRIMARY KEY,
+            job_id INTEGER NOT NULL,
+            channel TEXT,
+            thread_ts TEXT,
+            is_im BOOLEAN
+        )
+        """,
+        "CREATE INDEX job_recipient_job_id ON job_recipient (job_id)",
+        "ALTER TABLE recurring_job ADD COLUMN coalesce TEXT NOT NULL DEFAULT 'replace'",
+    ],
+    # 7: cached results of jobs
+    [
+        "ALTER TABLE job ADD COLUMN fresh BOOLEAN NOT NULL DEFAULT 0",
+        """
+        CREATE TABLE result_cache (
+            id INTEGER PRIMARY KEY,
+            job_type TEXT NOT NULL,
+            args TEXT NOT NULL,
+            stdout TEXT,
+            size INTEGER NOT NULL,
+            created_at DATETIME,
+            used_at DATETIME
+        )
+        """,
+        "CREATE UNIQUE INDEX result_cache_job_type_args ON result_cache (job_type, args)",
+        "CREATE INDEX result_cache_used_at ON result_cache (used_at)",
+    ],
+    # 8: leases on running jobs
+    [
+        "ALTER TABLE job ADD COLUMN lease_expires_at DATETIME",
+    ],
+    # 9: a counter of changes to the suppression table, so that each process can
+    # tell when its storage.SuppressionIndex is out of date
+    [
+        "CREATE TABLE suppression_version (version INTEGER NOT NULL)",
+        "INSERT INTO suppression_version (version) VALUES (0)",
+        *(
+            f"""
+            CREATE TRIGGER suppression_{event.lower()} AFTER {event} ON suppression
+            BEGIN
+                UPDATE suppression_version SET version = version + 1;
+            END
+            """
+            for event in ["INSERT", "UPDATE", "DELETE"]
+        ),
+    ],
+    # 10: counters and gauges that are reported by the webserver's /metrics
+    [
+        "CREATE TABLE metric (name TEXT PRIMARY KEY, value REAL NOT NULL)",
+    ],
+    # 11: retries of failed jobs
+    [
+        "ALTER TABLE job ADD COLUMN attempt INTEGER NOT NULL DEFAULT 1",
+    ],
+    # 12: killing running jobs
+    [
+        "ALTER TABLE job ADD COLUMN pid INTEGER",
+        "ALTER TABLE job ADD COLUMN kill_requested BOOLEAN NOT NULL DEFAULT 0",
+    ],
+    # 13: leases for jobs that were already running when leases were added, which
+    # nothing is renewing, so that they expire straight away
+    [
+        "UPDATE job SET lease_expires_at = CURRENT_TIMESTAMP WHERE started_at IS NOT NULL AND lease_expires_at IS NULL",
+    ],
+    # 14: where kills of running jobs were requested from, so that the requester
+    # can be told if the job can't be killed
+    [
+        "ALTER TABLE job ADD COLUMN kill_requested_channel TEXT",
+        "ALTER TABLE job ADD COLUMN kill_requested_thread_ts TEXT",
+    ],
+]
 
-CREATE TABLE IF NOT EXISTS suppression (
-    id INTEGER PRIMARY KEY,
-    job_type TEXT NOT NULL,
-    start_at DATETIME,
-    end_at DATETIME
-);
-"""
+
+# Connections are cached per thread, since sqlite3 connections may not be
+# shared between threads.  Each cached connection is tagged with the pid of the
+# process that opened it (so that a forked child opens its own connection
+# rather than reusing its parent's), the path of the database, and the current
+# generation (so that reset_connections() can force every thread to reconnect).
+_local = threading.local()
+_generation = 0
 
 
 def get_connection():
-    """Return connection to database, ensuring tables exist."""
+    """Return this thread's connection to the database, ensuring it is migrated.
+
+    The connection is opened the first time it is needed and then reused, so that
+    callers that hit the database every second (such as the dispatcher) don't
+    reopen the file and re-run the schema each time.
+    """
+
+    key = (os.getpid(), str(settings.DB_PATH), _generation)
+    if getattr(_local, "key", None) != key:
+        _local.conn = _connect()
+        _local.key = key
+    return _local.conn
+
+
+@contextmanager
+def transaction():
+    """Run the body of the with-block in a single write transaction.
+
+    The transaction is started with BEGIN IMMEDIATE, so that the write lock is
+    taken up front and concurrent writers wait for each other rather than
+    failing part way through.  The transaction is committed if the block exits
+    normally, and rolled back if it raises, or if it can't be committed (so that
+    the connection is never left in a transaction that holds the write lock).
+
+    If a transaction is already in progress on this thread's connection, the
+    block joins it instead of starting a new one.
+    """
+
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def get_pragmas():
+    """Return the pragmas that are applied to each new connection.
+
+    busy_timeout comes first, so that changing the journal mode waits for any
+    other connection to release its locks.
+    """
+
+    return {
+        "busy_timeout": settings.DB_BUSY_TIMEOUT_MS,
+        "journal_mode": settings.DB_JOURNAL_MODE,
+        "synchronous": settings.DB_SYNCHRONOUS,
+        "mmap_size": settings.DB_MMAP_SIZE,
+        "cache_size": settings.DB_CACHE_SIZE,
+    }
 
+
+def reset_connections():
+    """Close this thread's connection, and force every other thread to open a new
+    connection the next time it needs one.
+
+    This is needed if the database file is removed, as happens between tests.
+    """
+
+    global _generation
+
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+    _local.__dict__.clear()
+    _generation += 1
+
+
+def _connect():
     def dict_factory(cursor, row):
         return {col[0]: row[ix] for ix, col in enumerate(cursor.description)}
 
-    conn = sqlite3.connect(settings.DB_PATH)
+    # isolation_level=None stops the sqlite3 module from opening transactions
+    # implicitly; statements outside transaction() are committed immediately.
+    conn = sqlite3.connect(
+        settings.DB_PATH,
+        timeout=settings.DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+    )
     conn.row_factory = dict_factory
-    conn.executescript(SCHEMA)
+    for name, value in get_pragmas().items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    migrate(conn)
     return conn
+
+
+def migrate(conn):
+    """Apply any migrations that haven't yet been applied to the database."""
+
+    if _get_user_version(conn) == len(MIGRATIONS):
+        return
+
+    # Check the version again once we hold the write lock, in case another
+    # process has migrated the database in the meantime
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for migration in MIGRATIONS[_get_user_version(conn) :]:
+            for statement in migration:
+                conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def _get_user_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()["user_version"]
@@ -0,0 +1,103 @@
+"""
+A minimal implementation of standard five-field cron expressions, used for
+recurring jobs.  All times are in UTC.
+
+The fields are minute, hour, day of month, month, and day of week.  Each field is
+either *, a number, a range (a-b), a step (*/n or a-b/n), or a comma-separated
+list of these.  Day of week is 0-6, where Sunday is 0 (or 7).  As in cron, if both
+day of month and day of week are restricted (that is, neither starts with *), a day
+matches if either matches.
+
+>>> next_after("0 9 * * 1-5", datetime(2024, 10, 5, 12, 0, tzinfo=timezone.utc))
+datetime.datetime(2024, 10, 7, 9, 0, tzinfo=datetime.timezone.utc)
+"""
+
+from datetime import timedelta
+
+
+FIELDS = [
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day of month", 1, 31),
+    ("month", 1, 12),
+    ("day of week", 0, 7),
+]
+
+
+def parse(expression):
+    """Return a list of the sets of values matched by each field of expression.
+
+    Raises ValueError if expression is not valid.
+    """
+
+    fields = expression.split()
+    if len(fields) != len(FIELDS):
+        raise ValueError(f"Cron expression `{expression}` must have 5 fields")
+
+    values = [
+        _parse_field(field, name, min_, max_)
+        for field, (name, min_, max_) in zip(fields, FIELDS)
+    ]
+    # Sunday can be 0 or 7
+    if 7 in values[4]:
+        values[4] = (values[4] - {7}) | {0}
+    return values
+
+
+def next_after(expression, after):
+    """Return the first time strictly after the given time that matches
+    expression."""
+
+    minutes, hours, days, months, weekdays = parse(expression)
+    # As in cron, a field that starts with * (including a step such as */2) is
+    # unrestricted
+    days_restricted = not expression.split()[2].startswith("*")
+    weekdays_restricted = not expression.split()[4].startswith("*")
+
+    def day_matches(t):
+        day_match = t.day in days
+        # datetime.weekday() is 0 for Monday, but cron uses 0 for Sunday
+        weekday_match = (t.weekday() + 1) % 7 in weekdays
+        if days_restricted and weekdays_restricted:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+    t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    # Every valid expression matches at least once in any 8 year period (eg
+    # 29th February, when the next leap year is skipped)
+    for _ in range(366 * 8):
+        if t.month in months and day_matches(t):
+            for hour in sorted(hours):
+                for minute in sorted(minutes):
+                    candidate = t.replace(hour=hour, minute=minute)
+                    if candidate >= t:
+                        return candidate
+        t = (t + timedelta(days=1)).replace(hour=0, minute=0)
+
+    raise ValueError(f"Cron expression `{expression}` never matches")
+
+
+def _parse_field(field, name, min_, max_):
+    values = set()
+    for part in field.split(","):
+        range_, _, step = part.partition("/")
+        if range_ == "*":
+            start, end = min_, max_
+        elif "-" in range_:
+            start, _, end = range_.partition("-")
+            start, end = _parse_number(start, name), _parse_number(end, name)
+        else:
+            start = end = _parse_number(range_, name)
+            if step:
+                end = max_
+        step = _parse_number(step, name) if step else 1
+        if not (min_ <= start <= end <= max_) or step < 1:
+            raise ValueError(f"Invalid {name} `{part}`")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def _parse_number(text, name):
+    if not text.isdigit():
+        raise ValueError(f"Invalid {name} `{text}`")
+    return int(text)
@@ -1,51 +1,293 @@
+import asyncio
+import codecs
+import contextlib
+import heapq
 import json
 import os
 import re
 import shlex
-import subprocess
-import sys
+import signal
 import time
 import traceback
+from collections import deque
 from datetime import datetime, timedelta, timezone
-from multiprocessing import Process
 from pathlib import Path
 
 import requests
 
-from . import job_configs, scheduler, settings
+from . import job_configs, scheduler, settings, workers
 from .config import get_support_config
 from .logger import logger
-from .slack import notify_slack, slack_web_client
+from .slack import notify_slack, slack_web_client, update_slack_message
+from .wakeup import Listener, notify_dispatcher
+
+
+# How long a job that has timed out is given to exit after being sent SIGTERM,
+# before it is sent SIGKILL
+KILL_GRACE_SECONDS = 5
+
+# The most characters of a job's output that are shown in its streamed message, to
+# keep well within Slack's limit of 4000 characters per message
+STREAM_OUTPUT_MAX_CHARS = 3000
+
+# How long the dispatcher waits before trying again after its loop raises an error
+# (for instance, because the database is locked)
+TICK_ERROR_SLEEP_SECONDS = 5
 
 
 def run():  # pragma: no cover
-    """Start the dispatcher and the message checker running."""
+    """Start the dispatcher and the message checker running, until the dispatcher is
+    sent SIGTERM or SIGINT."""
     slack_client = slack_web_client(token_type="bot")
     checker = MessageChecker(slack_client, slack_web_client(token_type="user"))
-    checker.run_check()
-    while True:
-        run_once(slack_client, job_configs.config)
-        time.sleep(1)
+    scheduler.sync_recurring_jobs(job_configs.config["schedules"])
+    dispatcher = Dispatcher(slack_client, job_configs.config, Listener())
+    asyncio.run(dispatcher.run(checker))
+
+
+class Dispatcher:
+    """Runs the dispatcher's loop, every job that it starts, and the message checker
+    concurrently, in a single asyncio event loop.
+
+    Jobs' subprocesses are started and waited on by the event loop, and blocking
+    calls that may be slow (such as those to Slack, and writes to the database,
+    which may wait for another process's lock) are made in threads, so that one
+    job never holds up another.
+    """
+
+    def __init__(self, slack_client, config, listener):
+        self.slack_client = slack_client
+        self.config = config
+        self.listener = listener
+        self.timers = JobTimers()
+        # The JobDispatcher of each running job, by job id
+        self.running_jobs = {}
+        self.stopping = False
+
+    async def run(self, checker=None):
+        """Start jobs as they become available until stop() is called (or the
+        process is sent SIGTERM or SIGINT), and then wait for running jobs to
+        finish."""
+
+        loop = asyncio.get_running_loop()
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            loop.add_signal_handler(signum, self.stop)
+        checker_task = None
+        if checker is not None:
+            checker_task = asyncio.create_task(checker.do_check())
+
+        while not self.stopping:
+            try:
+                sleep_seconds = await self.tick()
+            except Exception:
+                # Raising would cancel the tasks of all running jobs, so the error
+                # is logged, and we try again shortly
+                logger.exception("dispatcher error")
+                sleep_seconds = TICK_ERROR_SLEEP_SECONDS
+            self.timers.add(await self.listener.wait(sleep_seconds) or [])
+
+        if checker_task is not None:
+            checker_task.cancel()
+        logger.info("waiting for running jobs", count=len(self.running_jobs))
+        await asyncio.gather(*(jd.task for jd in self.running_jobs.values()))
+
+    async def tick(self):
+        """Kill any jobs that have been marked to be killed, and start any jobs that
+        are available, and return how long to sleep before doing so again."""
+
+        self.timers.sync_if_stale()
+        await self.kill_requested_jobs()
+        for job_dispatcher in await run_once(
+            self.slack_client, self.config, set(self.running_jobs)
+        ):
+            self.add_running_job(job_dispatcher)
+        return get_sleep_seconds(self.timers)
+
+    def add_running_job(self, job_dispatcher):
+        """Keep track of a job that has been started, until it finishes.
+
+        A job that is retried may be started again before the task that ran its
+        last attempt has finished, so that task only forgets the job if it hasn't
+        been started again.
+        """
+
+        job_id = job_dispatcher.job["id"]
+        self.running_jobs[job_id] = job_dispatcher
 
+        def forget(_):
+            if self.running_jobs.get(job_id) is job_dispatcher:
+                del self.running_jobs[job_id]
 
-def run_once(slack_client, config):
-    """Clear any expired suppressions, then start a new subprocess for each
-    available job.
+        job_dispatcher.task.add_done_callback(forget)
 
-    We collect and return started processes so that we can wait for them to
-    finish in tests before asserting the tests have done anything.
+    async def kill_requested_jobs(self):
+        """Kill any running jobs that have been marked to be killed (see
+        scheduler.request_job_kill()).
+
+        Jobs with a python_entrypoint can't be killed, so their kills are cancelled
+        instead, so that they aren't handled again every time this is called.
+        """
+
+        for job_id in scheduler.get_jobs_to_kill():
+            job_dispatcher = self.running_jobs.get(job_id)
+            if job_dispatcher is None:
+                continue
+            if job_dispatcher.job_config["python_entrypoint"]:
+                await asyncio.to_thread(job_dispatcher.cancel_kill)
+            else:
+                job_dispatcher.kill()
+
+    def stop(self):
+        """Stop starting jobs, and let the jobs that are running finish."""
+
+        logger.info("stopping dispatcher")
+        self.stopping = True
+        # Wake the loop, in case it's waiting for a notification
+        notify_dispatcher()
+
+
+async def run_once(slack_client, config, running_job_ids=()):
+    """Clear any expired suppressions, abandon any jobs whose leases have expired
+    (other than those in running_job_ids, which this dispatcher is still running),
+    and schedule any recurring jobs that are due, then reserve every available job
+    (up to the configured concurrency limits) and start a new task to run each one.
+
+    The JobDispatcher of each job is returned, so that the dispatcher can kill the
+    job, and so that we can wait for its task to finish in tests before asserting
+    the tests have done anything.
+
+    How long this takes is recorded, to be reported by the webserver's /metrics.
     """
-    scheduler.remove_expired_suppressions()
+    start = time.perf_counter()
+    await asyncio.to_thread(scheduler.remove_expired_suppressions)
+    expired = await asyncio.to_thread(scheduler.fail_expired_jobs, running_job_ids)
+    for job, recipients in expired:
+        await asyncio.to_thread(notify_lease_expired, slack_client, job, recipients)
+    await asyncio.to_thread(scheduler.schedule_recurring_jobs)
+
+    job_dispatchers = []
+    job_ids = await asyncio.to_thread(
+        scheduler.reserve_jobs,
+        max_running=settings.MAX_CONCURRENT_JOBS,
+        max_running_by_namespace=config["max_concurrent_jobs"],
+    )
+    for job_id in job_ids:
+        try:
+            job_dispatcher = JobDispatcher(slack_client, job_id, config)
+        except Exception:
+            logger.exception("could not start job", job_id=job_id)
+            try:
+                await asyncio.to_thread(fail_unstarted_job, slack_client, job_id)
+            except Exception:
+                # The job will be abandoned once its lease expires
+                logger.exception("could not record job as failed", job_id=job_id)
+            continue
+        job_dispatcher.start()
+        job_dispatchers.append(job_dispatcher)
+
+    await asyncio.to_thread(
+        scheduler.record_dispatcher_tick, time.perf_counter() - start
+    )
+    return job_dispatchers
+
+
+def notify_lease_expired(slack_client, job, recipients):
+    """Tell everyone who requested a job that it was abandoned because its lease
+    expired, and call tech-support."""
+
+    logger.info("lease expired", job_id=job["id"])
+    msg = (
+        f"Command `{job['type']}` stopped responding while it was running "
+        "(perhaps because the dispatcher was restarted) and has been abandoned.\n"
+        "It may not have finished, so check whether it needs to be run again."
+    )
+    notify_slack(slack_client, settings.SLACK_LOGS_CHANNEL, msg)
+    for recipient in recipients:
+        notify_slack(
+            slack_client, recipient["channel"], msg, thread_ts=recipient["thread_ts"]
+        )
+    notify_slack(slack_client, settings.SLACK_TECH_SUPPORT_CHANNEL, msg)
+
+
+def fail_unstarted_job(slack_client, job_id):
+    """Record a job that couldn't be started as a failed run and remove it, so that
+    the rest of the jobs that were reserved with it can still be started, and tell
+    everyone who requested it, and tech-support."""
+
+    job = scheduler.get_job(job_id)
+    if job is None:
+        # The job has been removed since it was reserved
+        return
+    recipients = scheduler.get_job_recipients(job_id)
+    scheduler.record_job_run(job_id, scheduler.NOT_STARTED_RC, None)
+    scheduler.mark_job_done(job_id)
+    msg = f"Command `{job['type']}` could not be started, so it has been abandoned."
+    notify_slack(slack_client, settings.SLACK_LOGS_CHANNEL, msg)
+    for recipient in recipients:
+        notify_slack(
+            slack_client, recipient["channel"], msg, thread_ts=recipient["thread_ts"]
+        )
+    notify_slack(slack_client, settings.SLACK_TECH_SUPPORT_CHANNEL, msg)
 
-    processes = []
-    while True:
-        job_id = scheduler.reserve_job()
-        if job_id is None:
-            break
-        job_dispatcher = JobDispatcher(slack_client, job_id, config)
-        processes.append(job_dispatcher.start_job())
 
-    return processes
+def get_sleep_seconds(timers):
+    """Return how long to sleep before the next job may become available.
+
+    The times that scheduled jobs are due to start come from timers, rather than
+    from the database.  The dispatcher is woken sooner if a job is scheduled in the
+    meantime.
+    """
+
+    now = datetime.now(timezone.utc)
+    wakeups = [timers.next_after(now), scheduler.get_next_wakeup(include_jobs=False)]
+    next_wakeup = min((wakeup for wakeup in wakeups if wakeup), default=None)
+    if next_wakeup is None:
+        return settings.DISPATCHER_MAX_SLEEP_SECONDS
+    seconds = (next_wakeup - now).total_seconds()
+    return min(max(seconds, 0), settings.DISPATCHER_MAX_SLEEP_SECONDS)
+
+
+class JobTimers:
+    """A heap of the times that scheduled jobs are due to start, so that the
+    dispatcher can tell when it next needs to wake without querying the database,
+    however many jobs are scheduled ahead of time.
+
+    The heap is loaded from the database, and then kept up to date with the start
+    times that are sent with notifications when jobs are scheduled.  In case a
+    notification is missed, it is reloaded every DISPATCHER_MAX_SLEEP_SECONDS.
+    Times may be left in the heap for jobs that have since been cancelled or
+    rescheduled, which only means that the dispatcher wakes when it needn't.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.synced_at = None
+
+    def sync(self):
+        """Reload the start times of all scheduled jobs from the database."""
+
+        self.heap = scheduler.get_pending_start_times()
+        self.synced_at = time.monotonic()
+
+    def sync_if_stale(self):
+        if (
+            self.synced_at is None
+            or time.monotonic() - self.synced_at
+            >= settings.DISPATCHER_MAX_SLEEP_SECONDS
+        ):
+            self.sync()
+
+    def add(self, start_times):
+        for start_time in start_times:
+            heapq.heappush(self.heap, start_time)
+
+    def next_after(self, now):
+        """Return the earliest start time after now, or None, discarding earlier
+        times since jobs that were due then have already been reserved."""
+
+        while self.heap and self.heap[0] <= now:
+            heapq.heappop(self.heap)
+        return self.heap[0] if self.heap else None
 
 
 class JobDispatcher:
@@ -53,6 +295,7 @@ class JobDispatcher:
         logger.info("starting job", job_id=job_id)
         self.slack_client = slack_client
         self.job = scheduler.get_job(job_id)
+        self.recipients = scheduler.get_job_recipients(job_id)
         self.job_config = config["jobs"][self.job["type"]]
 
         self.namespace = self.job["type"].split("_")[0]
@@ -62,25 +305,222 @@ class JobDispatcher:
         escaped_args = {k: shlex.quote(v) for k, v in self.job["args"].items()}
         self.run_args = self.job_config["run_args_template"].format(**escaped_args)
 
-    def start_job(self):
-        """Start running the job in a new subprocess."""
+        self.task = None
+        self.process = None
+        self.killed = False
+        self.kill_task = None
+
+    def start(self):
+        """Run the job in a new task."""
+
+        self.task = asyncio.create_task(self.run())
+
+    def kill(self):
+        """Kill the job's command, and every process that it started, or, if the
+        command hasn't started yet, stop it from starting.
+
+        Jobs with a python_entrypoint can't be killed, since they run in a worker
+        that is shared with other jobs.
+        """
+
+        logger.info("killing job", job_id=self.job["id"])
+        self.killed = True
+        if self.process is not None and self.kill_task is None:
+            self.kill_task = asyncio.create_task(kill_process_group(self.process))
+
+    def cancel_kill(self):
+        """Cancel the kill of a job that can't be killed, since it runs in a worker
+        that is shared with other jobs, and tell whoever requested the kill."""
+
+        job = scheduler.get_job(self.job["id"])
+        scheduler.cancel_job_kill(self.job["id"])
+        if job is None:
+            # The job has finished since its kill was requested
+            return
+        logger.info("not killing job", job_id=job["id"])
+        msg = (
+            f"Job id [{job['id']}] runs in a worker that is shared with other jobs, "
+            "so it can't be killed"
+        )
+        notify_slack(
+            self.slack_client,
+            job["kill_requested_channel"],
+            msg,
+            thread_ts=job["kill_requested_thread_ts"],
+        )
+
+    async def run(self):
+        """Run the job, renewing its lease until it is done, and report the outcome.
+
+        If a recent result of the job is cached, it is reported instead, without
+        running the job.
+        """
+
+        cached_result = await asyncio.to_thread(self.get_cached_result)
+        if cached_result is not None:
+            await asyncio.to_thread(self.report_cached_result, cached_result)
+            return
+
+        async with self.heartbeat():
+            await asyncio.to_thread(self.set_up_cwd)
+            self.set_up_log_dir()
+            await asyncio.to_thread(self.notify_start)
+            async with self.streaming_output():
+                if self.killed:
+                    rc = scheduler.KILLED_RC
+                elif self.job_config["python_entrypoint"]:
+                    rc = await self.run_entrypoint()
+                else:
+                    rc = await self.run_command()
+            retry_delay = await asyncio.to_thread(self.record_outcome, rc)
+        await asyncio.to_thread(self.notify_end, rc, retry_delay=retry_delay)
+
+    def record_outcome(self, rc):
+        """Record that the job has finished, caching its stdout if it succeeded, and
+        then remove it, or return it to the queue if it is to be attempted again.
+
+        Returns the number of seconds before the job is attempted again, or None.
+        """
+
+        if rc == 0 and self.job_config["cache_ttl"]:
+            with open(self.stdout_path) as f:
+                scheduler.cache_result(self.job["type"], self.job["args"], f.read())
+        scheduler.record_job_run(self.job["id"], rc, self.host_log_dir)
+        retry_delay = self.get_retry_delay(rc)
+        if retry_delay is None:
+            scheduler.mark_job_done(self.job["id"])
+        else:
+            scheduler.retry_job(self.job["id"], retry_delay)
+        return retry_delay
+
+    def get_retry_delay(self, rc):
+        """Return how many seconds to wait before attempting the job again, or None
+        if the job shouldn't be attempted again.
+
+        A failed job (unless it was killed) is attempted again up to the job's
+        retries times, waiting backoff seconds before the first retry and doubling
+        the wait each time.
+        """
+
+        if (
+            rc in [0, scheduler.KILLED_RC]
+            or self.job["attempt"] > self.job_config["retries"]
+        ):
+            return None
+        return self.job_config["backoff"] * 2 ** (self.job["attempt"] - 1)
+
+    @contextlib.asynccontextmanager
+    async def heartbeat(self):
+        """Renew the job's lease in a background task every third of
+        JOB_LEASE_SECONDS, until the block exits.
+
+        If the lease can't be renewed (for instance, because the database is
+        locked), the error is logged, and it is renewed again next time.
+        """
+
+        async def beat():
+            while True:
+                await asyncio.sleep(settings.JOB_LEASE_SECONDS / 3)
+                try:
+                    await asyncio.to_thread(scheduler.renew_job_lease, self.job["id"])
+                except Exception:
+                    logger.exception("could not renew lease", job_id=self.job["id"])
+
+        task = asyncio.create_task(beat())
+        try:
+            yield
+        finally:
+            task.cancel()
+
+    @contextlib.asynccontextmanager
+    async def streaming_output(self):
+        """If the job streams its output, post the last lines of its stdout to whoever
+        first requested it while the block runs, and once it exits.
+
+        A single message is posted, and then edited, at most every
+        STREAM_OUTPUT_INTERVAL_SECONDS, and only when there is new output.
+        """
+
+        if not self.job_config["stream_output"]:
+            yield
+            return
+
+        recipient = self.recipients[0]
+        tail = OutputTail(self.stdout_path, settings.STREAM_OUTPUT_MAX_LINES)
+        message = None
+        stopped = asyncio.Event()
+
+        async def update():
+            nonlocal message
+            if not tail.read():
+                return
+            msg = (
+                f"Output of `{self.job['type']}` so far:\n"
+                f"```{tail.text()[-STREAM_OUTPUT_MAX_CHARS:]}```"
+            )
+            if message is None:
+                message = await asyncio.to_thread(
+                    notify_slack,
+                    self.slack_client,
+                    recipient["channel"],
+                    msg,
+                    thread_ts=recipient["thread_ts"],
+                )
+            else:
+                await asyncio.to_thread(
+                    update_slack_message,
+                    self.slack_client,
+                    message["channel"],
+                    message["ts"],
+                    msg,
+                )
 
-        p = Process(target=self.do_job)
-        p.start()
-        return p
+        async def stream():
+            # Rather than being cancelled, this finishes when the block exits, so
+            # that the message is never posted twice, and shows the final output
+            while not stopped.is_set():
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(
+                        stopped.wait(), settings.STREAM_OUTPUT_INTERVAL_SECONDS
+                    )
+                await update()
+                if message is None and tail.offset:
+                    # The message couldn't be posted, and notify_slack() has already
+                    # reported that, so don't try again
+                    return
+
+        task = asyncio.create_task(stream())
+        try:
+            yield
+        finally:
+            stopped.set()
+            await task
+
+    def get_cached_result(self):
+        """Return a cached result of the job that is recent enough to report instead
+        of running the job, or None."""
+
+        if not self.job_config["cache_ttl"] or self.job["fresh"]:
+            return None
+        return scheduler.get_cached_result(
+            self.job["type"], self.job["args"], self.job_config["cache_ttl"]
+        )
 
-    def do_job(self):
-        """Run the job."""
+    def report_cached_result(self, cached_result):
+        """Report a cached result of the job, instead of running it."""
 
-        self.set_up_cwd()
-        self.set_up_log_dir()
-        self.notify_start()
-        rc = self.run_command()
+        msg = (
+            f"Command `{self.job['type']}` reported from cache "
+            f"(from {cached_result['created_at']})"
+        )
+        notify_slack(self.slack_client, settings.SLACK_LOGS_CHANNEL, msg)
+        scheduler.increment_metrics({"jobs_finished_total": 1})
         scheduler.mark_job_done(self.job["id"])
-        self.notify_end(rc)
+        self.notify_end(0, stdout=cached_result["stdout"])
 
-    def run_command(self):
-        """Run the command, writing stdout/stderr to separate files."""
+    async def run_command(self):
+        """Run the command in a new subprocess, writing stdout/stderr to separate
+        files."""
 
         logger.info("run_command {")
         logger.info(
@@ -96,82 +536,163 @@ class JobDispatcher:
             # If we have an ABSOLUTE_BIN env variable, ensure that it's set first in the path
             env["PATH"] = f"{bin_path}:{env['PATH']}"
         with (
-            open(self.stdout_path, "w") as stdout,
-            open(self.stderr_path, "w") as stderr,
+            open(self.stdout_path, "wb") as stdout,
+            open(self.stderr_path, "wb") as stderr,
         ):
             try:
-                rv = subprocess.run(
+                # The command runs in a new session, and so in its own process group,
+                # so that if it times out, every process that it started can be
+                # killed
+                process = await asyncio.create_subprocess_shell(
                     self.run_args,
                     cwd=self.cwd,
                     stdout=stdout,
                     stderr=stderr,
                     env=env,
-                    shell=True,
+                    start_new_session=True,
                 )
-                rc = rv.returncode
+                self.process = process
+                await asyncio.to_thread(
+                    scheduler.record_job_pid, self.job["id"], process.pid
+                )
+                if self.killed:
+                    # The job was killed while its command was starting
+                    self.kill()
+                try:
+                    # Only the command itself is waited for, and not any background
+                    # processes that it leaves holding its stdout or stderr open
+                    await asyncio.wait_for(
+                        process.wait(), self.job_config["timeout_seconds"]
+                    )
+                    rc = process.returncode
+                    if self.killed:
+                        await self.kill_task
+                        rc = scheduler.KILLED_RC
+                except TimeoutError:
+                    logger.info("run_command timed out", pid=process.pid)
+                    await kill_process_group(process)
+                    rc = scheduler.TIMED_OUT_RC
             except Exception:  # pragma: no cover
-                traceback.print_exception(*sys.exc_info(), file=stderr)
+                stderr.write(traceback.format_exc().encode())
                 rc = -1
 
         logger.info("run_command", rc=rc)
         logger.info("run_command }")
         return rc
 
+    async def run_entrypoint(self):
+        """Call the job's python_entrypoint in the worker pool, writing stdout/stderr
+        to separate files."""
+
+        logger.info("run_entrypoint {")
+        logger.info(
+            "run_entrypoint",
+            entrypoint=self.job_config["python_entrypoint"],
+            args=self.job["args"],
+            cwd=self.cwd,
+            stdout_path=self.stdout_path,
+            stderr_path=self.stderr_path,
+        )
+        rc = await workers.run_in_worker(
+            self.job_config["python_entrypoint"],
+            self.job["args"],
+            self.cwd,
+            self.stdout_path,
+            self.stderr_path,
+            self.job_config["timeout_seconds"],
+        )
+        logger.info("run_entrypoint", rc=rc)
+        logger.info("run_entrypoint }")
+        return rc
+
     def notify_start(self):
         """Send notification that command is about to start."""
 
         msg = f"Command `{self.job['type']}` about to start"
         notify_slack(self.slack_client, settings.SLACK_LOGS_CHANNEL, msg)
 
-    def notify_end(self, rc):
+    def notify_end(self, rc, stdout=None, retry_delay=None):
         """Send notification that command has ended, reporting stdout if
-        required."""
+        required.
+
+        stdout is read from the job's log dir, unless it is given.
+
+        If the command failed but will be attempted again in retry_delay seconds,
+        tech-support is not called.
+
+        The notification is sent to every channel and thread that requested the
+        job.
+        """
 
         error = False
         if rc == 0:
             if self.job_config["report_stdout"]:
-                with open(self.stdout_path) as f:
-                    if self.job_config["report_format"] == "blocks":
-                        msg = json.load(f)
-                    else:
-                        msg = f.read()
-                    if not msg:
-                        msg = f"No output found for command `{self.job['type']}`"
+                if stdout is None:
+                    with open(self.stdout_path) as f:
+                        stdout = f.read()
+                if self.job_config["report_format"] == "blocks":
+                    msg = json.loads(stdout)
+                else:
+                    msg = stdout
+                if not msg:
+                    msg = f"No output found for command `{self.job['type']}`"
             elif self.job_config["report_success"]:
                 msg = f"Command `{self.job['type']}` succeeded"
             else:
                 return
         else:
+            if rc == scheduler.TIMED_OUT_RC:
+                outcome = (
+                    f"timed out after {self.job_config['timeout_seconds']} seconds"
+                )
+            elif rc == scheduler.KILLED_RC:
+                outcome = "was killed"
+            else:
+                outcome = "failed"
+            if retry_delay is None:
+                outcome += "."
+            else:
+                attempts = self.job_config["retries"] + 1
+                outcome += (
+                    f", and will be attempted again in {retry_delay} seconds "
+                    f"(attempt {self.job['attempt']} of {attempts})."
+                )
             msg = (
-                f"Command `{self.job['type']}` failed.\n"
+                f"Command `{self.job['type']}` {outcome}\n"
                 f"Find logs in {self.host_log_dir} on dokku3.\n"
                 f"Or check logs here with `showlogs head/tail/all`, e.g.\n"
                 f"* `@{settings.SLACK_APP_USERNAME} showlogs tail error {self.host_log_dir}`\n"
                 f"* `@{settings.SLACK_APP_USERNAME} showlogs all output {self.host_log_dir}`\n"
             )
-            if not self.job["is_im"]:
-                msg += "\nCalling tech-support."
-            error = True
-
-        slack_message = notify_slack(
-            self.slack_client,
-            self.job["channel"],
-            msg,
-            thread_ts=self.job["thread_ts"],
-            message_format=self.job_config["report_format"] if rc == 0 else "text",
-        )
-        if error and not self.job["is_im"]:
-            # If the command failed, repost it to tech-support
-            # Don't repost to tech-support if we're in a DM with the bot, because no-one
-            # else will be able to read the reposted message
-            # Note that the bot won't register messages from itself, so we can't just
-            # rely on the tech-support listener
-            message_url = self.slack_client.chat_getPermalink(
-                channel=slack_message["channel"], message_ts=slack_message["ts"]
-            )["permalink"]
-            self.slack_client.chat_postMessage(
-                channel=settings.SLACK_TECH_SUPPORT_CHANNEL, text=message_url
+            # A job that was killed was killed on purpose, so tech-support isn't
+            # called
+            error = retry_delay is None and rc != scheduler.KILLED_RC
+
+        called_tech_support = False
+        for recipient in self.recipients:
+            calling_tech_support = (
+                error and not recipient["is_im"] and not called_tech_support
             )
+            slack_message = notify_slack(
+                self.slack_client,
+                recipient["channel"],
+                msg + "\nCalling tech-support." if calling_tech_support else msg,
+                thread_ts=recipient["thread_ts"],
+                message_format=self.job_config["report_format"] if rc == 0 else "text",
+            )
+            if calling_tech_support:
+                # If the command failed, repost it to tech-support, once
+                # Don't repost to tech-support if we're in a DM with the bot, because
+                # no-one else will be able to read the reposted message
+                # Note that the bot won't register messages from itself, so we can't
+                # just rely on the tech-support listener
+                message_url = self.slack_client.chat_getPermalink(
+                    channel=slack_message["channel"], message_ts=slack_message["ts"]
+                )["permalink"]
+                self.slack_client.chat_postMessage(
+                    channel=settings.SLACK_TECH_SUPPORT_CHANNEL, text=message_url
+                )
+                called_tech_support = True
 
     def set_up_cwd(self):
         """Ensure cwd exists, and maybe refresh fabfile."""
@@ -208,6 +729,61 @@ class JobDispatcher:
         self.log_dir.mkdir(parents=True, exist_ok=True)
 
 
+class OutputTail:
+    """The last lines written to a file that is still being written to, read
+    incrementally, so that only new output is read each time."""
+
+    def __init__(self, path, max_lines):
+        self.path = path
+        self.offset = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.lines = deque(maxlen=max_lines)
+        self.partial_line = ""
+
+    def read(self):
+        """Read anything written since the last read, and return whether there was
+        anything."""
+
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            # A job with a python_entrypoint creates its stdout file when it starts
+            return False
+        if not data:
+            return False
+        self.offset += len(data)
+        *lines, self.partial_line = (
+            self.partial_line + self.decoder.decode(data)
+        ).split("\n")
+        self.lines.extend(lines)
+        return True
+
+    def text(self):
+        lines = list(self.lines)
+        if self.partial_line:
+            lines.append(self.partial_line)
+        return "\n".join(lines)
+
+
+async def kill_process_group(process):
+    """Kill process, and every other process in its process group.
+
+    The group is sent SIGTERM, and then SIGKILL once the process has exited or
+    KILL_GRACE_SECONDS have passed, in case any process in the group ignored
+    SIGTERM.
+    """
+
+    # ProcessLookupError means that every process in the group has exited
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(process.pid, signal.SIGTERM)
+        with contextlib.suppress(TimeoutError):
+            await asyncio.wait_for(process.wait(), KILL_GRACE_SECONDS)
+        os.killpg(process.pid, signal.SIGKILL)
+    await process.wait()
+
+
 class MessageChecker:
     def __init__(self, bot_slack_client, user_slack_client):
         # The MessageChecker needs both a slack client with a bot token
@@ -219,13 +795,7 @@ class MessageChecker:
 
         self.config = get_support_config()
 
-    def run_check(self):  # pragma: no cover
-        """Start running the check in a new subprocess."""
-        p = Process(target=self.do_check)
-        p.start()
-        return p
-
-    def do_check(self, run_fn=lambda: True, delay=10):  # pragma: no branch
+    async def do_check(self, run_fn=lambda: True, delay=10):  # pragma: no branch
         # In production, we want this check to run forever. Using a
         # function means that we can test it on a finite number of loops.
         # Note that the message search endpoint is a tier2 endpoint and is
@@ -239,8 +809,8 @@ class MessageChecker:
             today = datetime.today()
             check_from = (today - timedelta(days=2)).strftime("%Y-%m-%d")
             for keyword in self.config:
-                self.check_messages(keyword, check_from)
-            time.sleep(delay)
+                await asyncio.to_thread(self.check_messages, keyword, check_from)
+            await asyncio.sleep(delay)
 
     def check_messages(self, keyword, after):
         logger.debug("Checking %s messages", keyword)
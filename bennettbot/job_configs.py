@@ -5,7 +5,7 @@ Defines which jobs may be run, and how they can be invoked via Slack.
 import re
 from operator import itemgetter
 
-from bennettbot import settings
+from bennettbot import cron, settings
 
 
 # fmt: off
@@ -19,10 +19,12 @@ raw_config = {
             },
             "hello_world": {
                 "run_args_template": "python jobs.py",
+                "python_entrypoint": "workspace.test.jobs:hello_world",
                 "report_stdout": True,
             },
             "hello_name": {
                 "run_args_template": "python jobs.py --name={name}",
+                "python_entrypoint": "workspace.test.jobs:hello_world",
                 "report_stdout": True,
             },
             "bad_job": {
@@ -87,6 +89,7 @@ raw_config = {
         "jobs": {
             "deploy": {
                 "run_args_template": "fab update:live",
+                "priority": 10,
             },
         },
         "slack": [
@@ -105,6 +108,7 @@ raw_config = {
                 "run_args_template": "python jobs.py",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "cache_ttl": 600,
             },
         },
         "slack": [
@@ -125,10 +129,12 @@ raw_config = {
             "deploy": {
                 "run_args_template": "fab deploy:production",
                 "report_success": False,
+                "priority": 10,
             },
             "restart": {
                 "run_args_template": "fab restart:production",
                 "report_success": False,
+                "priority": 10,
             },
             "cache_clear": {
                 "run_args_template": "fab clear_cloudflare"
@@ -266,6 +272,7 @@ raw_config = {
                 "run_args_template": "python jobs.py",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "cache_ttl": 600,
             },
         },
         "slack": [
@@ -284,16 +291,19 @@ raw_config = {
                 "run_args_template": "python generate_report.py --project-num {project_number} --statuses {statuses}",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "cache_ttl": 600,
             },
             "run_rap_report": {
                 "run_args_template": "python generate_report.py --project-num 15 --statuses 'Under Review' 'Blocked' 'In Progress'",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "cache_ttl": 600,
             },
             "run_rex_report": {
                 "run_args_template": "python generate_report.py --project-num 14 --statuses 'In Progress' 'In Review' 'Blocked'",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "cache_ttl": 600,
             },
         },
         "slack": [
@@ -320,40 +330,53 @@ raw_config = {
     "workflows": {
         "restricted": True,
         "description": "Report GitHub Actions workflow runs",
+        "max_concurrent_jobs": 2,
         "jobs": {
             "display_emoji_key": {
                 "run_args_template": "python jobs.py key",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "coalesce": "dedupe",
             },
             "display_usage": {
                 "run_args_template": "python jobs.py usage",
                 "report_stdout": True,
+                "coalesce": "dedupe",
             },
             "show": {
                 "run_args_template": "python jobs.py show --target {target}",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "coalesce": "dedupe",
+                "cache_ttl": 300,
             },
             "show_all": {
                 "run_args_template": "python jobs.py show",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "coalesce": "dedupe",
+                "cache_ttl": 300,
             },
             "show_failed": {
                 "run_args_template": "python jobs.py show --target {target} --skip-successful",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "coalesce": "dedupe",
+                "cache_ttl": 300,
             },
             "show_failed_all": {
                 "run_args_template": "python jobs.py show --skip-successful",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "coalesce": "dedupe",
+                "cache_ttl": 300,
             },
             "show_group": {
                 "run_args_template": "python jobs.py show --group {group}",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "coalesce": "dedupe",
+                "cache_ttl": 300,
             },
         },
         "slack": [
@@ -421,6 +444,7 @@ raw_config = {
                 "run_args_template": "python jobs.py rota",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "cache_ttl": 600,
             },
         },
         "slack": [
@@ -459,6 +483,7 @@ raw_config = {
                 "run_args_template": "python funding_report.py",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "cache_ttl": 600,
             }
         },
         "slack": [
@@ -520,6 +545,7 @@ raw_config = {
                 "run_args_template": "python jobs.py",
                 "report_stdout": True,
                 "report_format": "blocks",
+                "cache_ttl": 600,
             },
         },
         "slack": [
@@ -600,6 +626,8 @@ def build_config(raw_config):
         "workspace_dir": {},
         "restricted": {},
         "default_channel": {},
+        "max_concurrent_jobs": {},
+        "schedules": [],
     }
 
     for namespace in raw_config:
@@ -618,10 +646,32 @@ def build_config(raw_config):
             job_config["report_stdout"] = job_config.get("report_stdout", False)
             job_config["report_format"] = job_config.get("report_format", "text")
             job_config["report_success"] = job_config.get("report_success", True)
+            job_config["priority"] = job_config.get("priority", 0)
+            job_config["coalesce"] = job_config.get("coalesce", "replace")
+            job_config["cache_ttl"] = job_config.get("cache_ttl", 0)
+            job_config["retries"] = job_config.get("retries", 0)
+            job_config["backoff"] = job_config.get("backoff", 60)
+            job_config["python_entrypoint"] = job_config.get("python_entrypoint")
+            job_config["timeout_seconds"] = job_config.get("timeout_seconds")
+            job_config["stream_output"] = job_config.get("stream_output", False)
+            job_config["schedules"] = job_config.get("schedules", [])
             namespaced_job_type = f"{namespace}_{job_type}"
             validate_job_config(namespaced_job_type, job_config)
             config["jobs"][namespaced_job_type] = job_config
 
+            for schedule in job_config["schedules"]:
+                schedule["args"] = schedule.get("args", {})
+                schedule["catch_up"] = schedule.get("catch_up", True)
+                validate_schedule_config(namespaced_job_type, job_config, schedule)
+                config["schedules"].append(
+                    {
+                        "job_type": namespaced_job_type,
+                        "priority": job_config["priority"],
+                        "coalesce": job_config["coalesce"],
+                        **schedule,
+                    }
+                )
+
         for slack_config in raw_config[namespace]["slack"]:
             command = f"{namespace} {slack_config['command']}"
             slack_config["command"] = command
@@ -640,6 +690,11 @@ def build_config(raw_config):
         if "fabfile" in raw_config[namespace]:
             config["fabfiles"][namespace] = raw_config[namespace]["fabfile"]
 
+        if "max_concurrent_jobs" in raw_config[namespace]:
+            config["max_concurrent_jobs"][namespace] = raw_config[namespace][
+                "max_concurrent_jobs"
+            ]
+
         if (settings.WORKSPACE_DIR / namespace).exists():
             config["workspace_dir"][namespace] = settings.WORKSPACE_DIR
         else:
@@ -692,6 +747,15 @@ def validate_job_config(job_type, job_config):
         "report_stdout",
         "report_format",
         "report_success",
+        "priority",
+        "coalesce",
+        "cache_ttl",
+        "retries",
+        "backoff",
+        "python_entrypoint",
+        "timeout_seconds",
+        "stream_output",
+        "schedules",
     }
 
     if missing_keys := (expected_keys - job_config.keys()):
@@ -702,6 +766,12 @@ def validate_job_config(job_type, job_config):
         msg = f"Job {job_type} has extra keys {extra_keys}"
         raise RuntimeError(msg)
 
+    if isinstance(job_config["priority"], bool) or not isinstance(
+        job_config["priority"], int
+    ):
+        msg = f"Job {job_type} has an invalid priority; must be an integer"
+        raise RuntimeError(msg)
+
     if job_config["report_format"] not in ["text", "blocks", "code", "file"]:
         msg = (
             f"Job {job_type} has an invalid report_format; must be "
@@ -709,6 +779,89 @@ def validate_job_config(job_type, job_config):
         )
         raise RuntimeError(msg)
 
+    if (
+        isinstance(job_config["cache_ttl"], bool)
+        or not isinstance(job_config["cache_ttl"], int)
+        or job_config["cache_ttl"] < 0
+    ):
+        msg = f"Job {job_type} has an invalid cache_ttl; must be a number of seconds"
+        raise RuntimeError(msg)
+
+    if (
+        isinstance(job_config["retries"], bool)
+        or not isinstance(job_config["retries"], int)
+        or job_config["retries"] < 0
+    ):
+        msg = f"Job {job_type} has an invalid retries; must be a number of attempts"
+        raise RuntimeError(msg)
+
+    if (
+        isinstance(job_config["backoff"], bool)
+        or not isinstance(job_config["backoff"], int)
+        or job_config["backoff"] < 0
+    ):
+        msg = f"Job {job_type} has an invalid backoff; must be a number of seconds"
+        raise RuntimeError(msg)
+
+    timeout_seconds = job_config["timeout_seconds"]
+    if timeout_seconds is not None and (
+        isinstance(timeout_seconds, bool)
+        or not isinstance(timeout_seconds, (int, float))
+        or timeout_seconds <= 0
+    ):
+        msg = f"Job {job_type} has an invalid timeout_seconds; must be a number of seconds"
+        raise RuntimeError(msg)
+
+    if job_config["python_entrypoint"] is not None and not (
+        isinstance(job_config["python_entrypoint"], str)
+        and re.fullmatch(r"[\w.]+:\w+", job_config["python_entrypoint"])
+    ):
+        msg = (
+            f"Job {job_type} has an invalid python_entrypoint; must be "
+            "of the form 'module:function'"
+        )
+        raise RuntimeError(msg)
+
+    if job_config["cache_ttl"] and not job_config["report_stdout"]:
+        msg = f"Job {job_type} has a cache_ttl but does not report stdout"
+        raise RuntimeError(msg)
+
+    if job_config["coalesce"] not in ["replace", "dedupe", "queue"]:
+        msg = (
+            f"Job {job_type} has an invalid coalesce; must be "
+            "one of 'replace', 'dedupe' or 'queue'"
+        )
+        raise RuntimeError(msg)
+
+
+def validate_schedule_config(job_type, job_config, schedule):
+    """Validate that a job's recurring schedule contains expected keys, and a valid
+    cron expression and arguments."""
+
+    expected_keys = {"cron", "channel", "args", "catch_up"}
+
+    if missing_keys := (expected_keys - schedule.keys()):
+        msg = f"Schedule for job {job_type} is missing keys {missing_keys}"
+        raise RuntimeError(msg)
+
+    if extra_keys := (schedule.keys() - expected_keys):
+        msg = f"Schedule for job {job_type} has extra keys {extra_keys}"
+        raise RuntimeError(msg)
+
+    try:
+        cron.parse(schedule["cron"])
+    except ValueError as e:
+        msg = f"Schedule for job {job_type} has an invalid cron expression: {e}"
+        raise RuntimeError(msg)
+
+    run_args = get_template_params(job_config["run_args_template"], wrapper="{}")
+    if set(schedule["args"]) != set(run_args):
+        msg = (
+            f"Schedule for job {job_type} does not provide the arguments for the "
+            f"template {job_config['run_args_template']}"
+        )
+        raise RuntimeError(msg)
+
 
 def validate_slack_config(slack_config):
     """Validate that slack_config contains expected keys."""
@@ -1,100 +1,143 @@
 import json
+import math
 from datetime import datetime, timedelta, timezone
 
-from .connection import get_connection
+from . import cron, settings
 from .logger import log_call
+from .storage import get_storage
+from .wakeup import notify_dispatcher
+
+
+# The rc recorded for a job that was abandoned because its lease expired
+LEASE_EXPIRED_RC = -2
+# The rc recorded for a job that was killed because it ran for longer than its
+# timeout_seconds
+TIMED_OUT_RC = -3
+# The rc recorded for a job that was killed with the bot's kill job command
+KILLED_RC = -4
+# The rc recorded for a job that the dispatcher couldn't start (for instance,
+# because its type is no longer in the config)
+NOT_STARTED_RC = -5
 
 
 @log_call
-def schedule_job(type_, args, channel, thread_ts, delay_seconds, is_im=False):
+def schedule_job(
+    type_,
+    args,
+    channel,
+    thread_ts,
+    delay_seconds,
+    is_im=False,
+    priority=0,
+    coalesce="replace",
+    fresh=False,
+):
     """Schedule job to be run.
 
-    Only one job of any type may be scheduled.  If a job is already scheduled
-    but isn't running yet and another job of the same type is scheduled, the
-    record of the first job is updated.
+    What happens when a job of the same type is already scheduled but isn't
+    running yet depends on coalesce:
 
-    If a job is already running, another job of that type may be scheduled.
+        * "replace": the record of the existing job is updated, so that only one
+          job of any type may be scheduled
+        * "dedupe": if the existing job has the same args, the request is merged
+          into it, and the job's result is reported to every requester; otherwise
+          another job is scheduled
+        * "queue": another job is scheduled
 
-    Returns a boolean indicating whether an existing job was already running.
-    """
+    If a job is already running, another job of that type may be scheduled.  Jobs
+    of the same type never run at the same time, so queued jobs run one after
+    another.
 
-    conn = get_connection()
+    Jobs with a higher priority are started before jobs with a lower priority,
+    and are admitted first when the number of running jobs is limited.
 
-    sql = """
-    SELECT id, started_at IS NOT NULL AS has_started
-    FROM job
-    WHERE type = ?
-    ORDER BY has_started
-    """
+    If fresh is True, the job is run even if a recent result of the job is cached
+    (see get_cached_result()).
 
-    start_after = _now() + timedelta(seconds=delay_seconds)
-    args = json.dumps(args)
-
-    existing_jobs = list(conn.execute(sql, [type_]))
-    existing_job_running = False
-    if len(existing_jobs) == 0:
-        _create_job(type_, args, channel, thread_ts, start_after, is_im)
-    elif len(existing_jobs) == 1:
-        job = existing_jobs[0]
-        if job["has_started"]:
-            existing_job_running = True
-            _create_job(type_, args, channel, thread_ts, start_after, is_im)
-        else:
-            id_ = job["id"]
-            _update_job(id_, args, channel, thread_ts, start_after)
-    elif len(existing_jobs) == 2:
-        assert not existing_jobs[0]["has_started"]
-        assert existing_jobs[1]["has_started"]
-        existing_job_running = True
-        id_ = existing_jobs[0]["id"]
-        _update_job(id_, args, channel, thread_ts, start_after)
-    else:
-        assert False
+    Returns a boolean indicating whether an existing job was already running.
+    """
 
+    job = _prepare_job(
+        type_,
+        args,
+        channel,
+        thread_ts,
+        delay_seconds,
+        is_im,
+        priority,
+        coalesce,
+        fresh,
+    )
+    existing_job_running = get_storage().schedule_job(**job)
+    notify_dispatcher([job["start_after"]])
     return existing_job_running
 
 
-def _create_job(type_, args, channel, thread_ts, start_after, is_im):
-    with get_connection() as conn:
-        conn.execute(
-            "INSERT INTO job (type, args, channel, thread_ts, start_after, is_im) VALUES (?, ?, ?, ?, ?, ?)",
-            [type_, args, channel, thread_ts, start_after, is_im],
-        )
+@log_call
+def schedule_jobs(jobs):
+    """Schedule several jobs in a single transaction.
 
+    Each job is a dict of keyword arguments to schedule_job(), and jobs are
+    coalesced as described there.  Jobs are scheduled in order, so a job may be
+    coalesced with one earlier in the list.  If any job can't be scheduled, none
+    are.
 
-def _update_job(id_, args, channel, thread_ts, start_after):
-    with get_connection() as conn:
-        conn.execute(
-            "UPDATE job SET args = ?, channel = ?, thread_ts = ?, start_after = ? WHERE id = ?",
-            [args, channel, thread_ts, start_after, id_],
-        )
+    Returns a list with a boolean for each job, indicating whether an existing job
+    of the same type was already running.
+    """
+
+    jobs = [_prepare_job(**job) for job in jobs]
+    existing_jobs_running = get_storage().schedule_jobs(jobs)
+    notify_dispatcher([job["start_after"] for job in jobs])
+    return existing_jobs_running
+
+
+def _prepare_job(
+    type_,
+    args,
+    channel,
+    thread_ts,
+    delay_seconds,
+    is_im=False,
+    priority=0,
+    coalesce="replace",
+    fresh=False,
+):
+    """Convert arguments to schedule_job() to arguments to Storage.schedule_job()."""
+
+    return {
+        "type_": type_,
+        "args": args,
+        "channel": channel,
+        "thread_ts": thread_ts,
+        "start_after": _now() + timedelta(seconds=delay_seconds),
+        "is_im": is_im,
+        "priority": priority,
+        "coalesce": coalesce,
+        "fresh": fresh,
+    }
 
 
 @log_call
 def cancel_job(type_):
     """Cancel scheduled job of given type."""
 
-    with get_connection() as conn:
-        conn.execute("DELETE FROM job WHERE type = ? AND started_at IS NULL", [type_])
+    get_storage().cancel_job(type_)
 
 
 @log_call
 def schedule_suppression(job_type, start_at, end_at):
     """Schedule suppression for jobs of given type."""
 
-    with get_connection() as conn:
-        conn.execute(
-            "INSERT INTO suppression (job_type, start_at, end_at) VALUES (?, ?, ?)",
-            [job_type, start_at, end_at],
-        )
+    get_storage().schedule_suppression(job_type, start_at, end_at)
 
 
 @log_call
 def cancel_suppressions(job_type):
     """Cancel suppressions for jobs of given type."""
 
-    with get_connection() as conn:
-        conn.execute("DELETE FROM suppression WHERE job_type = ?", [job_type])
+    get_storage().cancel_suppressions(job_type)
+    notify_dispatcher()
 
 
 # @log_call
@@ -104,109 +147,485 @@ def remove_expired_suppressions():
     This is not logged because it is called every second by the dispatcher.
     """
 
-    with get_connection() as conn:
-        conn.execute("DELETE FROM suppression WHERE end_at < ?", [_now()])
+    get_storage().remove_expired_suppressions(_now())
 
 
 # @log_call
 def reserve_job():
-    """Reserve a job and return its id.
+    """Reserve a job and return its id, or None if no job is available.
+
+    See reserve_jobs() for which jobs are available.
+
+    This is not logged because it is called every second by the dispatcher.
+    """
+
+    job_ids = reserve_jobs(limit=1)
+    return job_ids[0] if job_ids else None
+
+
+# @log_call
+def reserve_jobs(limit=None, max_running=None, max_running_by_namespace=None):
+    """Reserve up to limit jobs (or every available job, if limit is None), and
+    return their ids in order of priority (highest first) and then in the order
+    they became due.
 
-    The first job where:
+    A job is available if:
 
+        * it is due to run
         * there is not a running job of the same type
         * there is no active suppression
+        * fewer than max_running_by_namespace[namespace] jobs in its namespace
+          are running (if its namespace has a limit)
+
+    Only the first available job of each type is reserved, and jobs are only
+    reserved while fewer than max_running jobs (if given) are running in total.
+    When these limits mean that not every available job can be reserved, jobs
+    are admitted in priority order, and the rest stay queued.  Reserving a
+    job sets its started_at, and leases it for JOB_LEASE_SECONDS.  The process
+    running the job must renew the lease with renew_job_lease() until the job is
+    done, or the job will be abandoned by fail_expired_jobs().
 
-    is reserved.  This updates the started_at column on the database record.
+    Two callers can never reserve the same job, or two jobs of the same type.
 
     This is not logged because it is called every second by the dispatcher.
     """
 
-    conn = get_connection()
+    now = _now()
+    job_ids = get_storage().reserve_jobs(
+        now,
+        now + timedelta(seconds=settings.JOB_LEASE_SECONDS),
+        limit,
+        max_running,
+        max_running_by_namespace,
+    )
+    if job_ids:
+        increment_metrics({"jobs_started_total": len(job_ids)})
+    return job_ids
+
 
-    sql = """
-    WITH running_job_types AS (
-        SELECT type
-        FROM job
-        WHERE started_at IS NOT NULL
-    ),
+# @log_call
+def renew_job_lease(job_id):
+    """Extend the lease of a running job by JOB_LEASE_SECONDS from now.
 
-    suppressed_job_types AS (
-        SELECT job_type
-        FROM suppression
-        WHERE start_at < ?
+    This is not logged because it is called regularly while every job runs.
+    """
+
+    get_storage().renew_lease(
+        job_id, _now() + timedelta(seconds=settings.JOB_LEASE_SECONDS)
     )
 
-    SELECT id
-    FROM job
-    WHERE
-          type NOT IN (SELECT * FROM suppressed_job_types)
-      AND type NOT IN (SELECT * FROM running_job_types)
-      AND started_at IS NULL
-      AND start_after <= ?
-    ORDER BY start_after
-    LIMIT 1
+
+# @log_call
+def fail_expired_jobs(running_job_ids=()):
+    """Abandon running jobs whose leases have expired, because the process running
+    them has stopped renewing them (for instance, because the dispatcher was
+    restarted).
+
+    Jobs whose ids are in running_job_ids are never abandoned, since the caller
+    knows that it is still running them, even if it has failed to renew their
+    leases.
+
+    Each job is recorded as a failed run with LEASE_EXPIRED_RC and removed, so that
+    other jobs of the same type can run.  Returns a (job, recipients) pair for each
+    job, where recipients is the result of get_job_recipients(), so that they can
+    be told.
+
+    This is not logged because it is called by the dispatcher on every run.
     """
 
-    now = _now()
-    results = list(conn.execute(sql, [now, now]))
+    expired = []
+    for job in get_storage().get_expired_jobs(_now()):
+        if job.id in running_job_ids:
+            continue
+        expired.append((job, get_job_recipients(job.id)))
+        record_job_run(job.id, LEASE_EXPIRED_RC, None)
+        mark_job_done(job.id)
+    return expired
+
+
+# @log_call
+def get_next_wakeup(include_jobs=True):
+    """Return the next time after now at which a job may become available, or
+    None if there is no such time.
+
+    This is the earliest of:
+
+        * the time that a scheduled job is due to start (unless include_jobs is
+          False, for callers that keep track of these themselves)
+        * the start or end of a suppression
+        * the time that a recurring job is next due
+
+    A job can also become available when a job of the same type finishes, or when
+    a suppression is cancelled, but in these cases the dispatcher is notified.
+
+    This is not logged because it is called by the dispatcher after every run.
+    """
 
-    if not results:
+    now = _now()
+    wakeups = [
+        get_storage().get_next_wakeup(now) if include_jobs else None,
+        get_suppression_index().next_boundary(now),
+        get_storage().get_next_recurring_run_at(),
+    ]
+    wakeup_at = min((wakeup for wakeup in wakeups if wakeup is not None), default=None)
+    if wakeup_at is None:
         return None
+    return datetime.fromisoformat(wakeup_at)
+
+
+# @log_call
+def get_pending_start_times():
+    """Return the times after now that scheduled jobs are due to start, in order.
 
-    job_id = results[0]["id"]
-    with conn:
-        conn.execute("UPDATE job SET started_at = ? WHERE id = ?", [now, job_id])
+    This is not logged because it is called by the dispatcher whenever it checks
+    that it knows when every job is due.
+    """
 
-    return job_id
+    return [
+        datetime.fromisoformat(start_after)
+        for start_after in get_storage().get_pending_start_times(_now())
+    ]
 
 
 @log_call
 def mark_job_done(job_id):
     """Remove job from job table."""
 
-    with get_connection() as conn:
-        conn.execute("DELETE FROM job WHERE id = ?", [job_id])
+    get_storage().mark_job_done(job_id)
+    notify_dispatcher()
+
+
+@log_call
+def retry_job(job_id, delay_seconds):
+    """Return a job that has failed to the job table, to be attempted again in
+    delay_seconds.
+
+    This should be called instead of mark_job_done, after the failed run has been
+    recorded with record_job_run.  The job keeps its recipients, and its attempt is
+    incremented.
+    """
+
+    start_after = _now() + timedelta(seconds=delay_seconds)
+    get_storage().retry_job(job_id, start_after)
+    increment_metrics({"jobs_retried_total": 1})
+    notify_dispatcher([start_after])
+
+
+@log_call
+def record_job_pid(job_id, pid):
+    """Record the pid of the process running a job's command.
+
+    The command runs in its own process group, so this is also the id of the group
+    that is killed if the job is killed.
+    """
+
+    get_storage().set_job_pid(job_id, pid)
+
+
+@log_call
+def request_job_kill(job_id, channel, thread_ts):
+    """Ask the dispatcher to kill a running job (and every process that it started).
+
+    The job is marked, and the dispatcher is woken, so that it kills the job
+    straight away; the job is then removed by the dispatcher, as if it had failed,
+    but without being retried.  If the dispatcher can't kill the job, it says so in
+    the given channel and thread.
+    """
+
+    get_storage().request_kill(job_id, channel, thread_ts)
+    notify_dispatcher()
+
+
+@log_call
+def cancel_job_kill(job_id):
+    """Stop asking the dispatcher to kill a job, because it can't be killed."""
+
+    get_storage().cancel_kill(job_id)
+
+
+# @log_call
+def get_jobs_to_kill():
+    """Return the ids of running jobs that have been marked to be killed.
+
+    This is not logged because it is called by the dispatcher on every run.
+    """
+
+    return get_storage().get_jobs_to_kill()
+
+
+@log_call
+def cache_result(type_, args, stdout):
+    """Cache the stdout of a successful job, replacing any earlier result of a job
+    with the same type and args.
+
+    If the cache then takes up more than RESULT_CACHE_MAX_BYTES, the least
+    recently used results are evicted.
+    """
+
+    get_storage().cache_result(
+        type_, args, stdout, _now(), settings.RESULT_CACHE_MAX_BYTES
+    )
+
+
+@log_call
+def get_cached_result(type_, args, max_age_seconds):
+    """Return the cached result of a job with the given type and args, if there is
+    one that is no older than max_age_seconds, or None.
+
+    Results are dicts with stdout and created_at keys.
+    """
+
+    now = _now()
+    return get_storage().get_cached_result(
+        type_, args, now, now - timedelta(seconds=max_age_seconds)
+    )
+
+
+@log_call
+def sync_recurring_jobs(schedules):
+    """Make the recurring_job table match the given schedules.
+
+    Each schedule is a dict with job_type, cron, args, channel, catch_up, priority
+    and coalesce keys (see job_configs.build_config).  Schedules that already exist
+    keep the time that they are next due, so that runs that were missed while the
+    dispatcher wasn't running can be caught up.
+    """
+
+    now = _now()
+    get_storage().sync_recurring_jobs(
+        [
+            {**schedule, "next_run_at": cron.next_after(schedule["cron"], now)}
+            for schedule in schedules
+        ]
+    )
+
+
+# @log_call
+def schedule_recurring_jobs():
+    """Schedule a job for each recurring job that is due, and record when each is
+    next due.
+
+    If the dispatcher wasn't running when a recurring job was due, all the runs
+    that were missed are combined into one.  If the recurring job has catch_up set
+    to False, runs that were missed by more than the longest time that the
+    dispatcher sleeps for are skipped instead.
+
+    Returns the types of the jobs that were scheduled.
+
+    This is not logged because it is called by the dispatcher on every run.
+    """
+
+    now = _now()
+
+    def plan(recurring_job):
+        last_due_at = datetime.fromisoformat(recurring_job["next_run_at"])
+        next_run_at = cron.next_after(recurring_job["cron"], last_due_at)
+        while next_run_at <= now:
+            last_due_at = next_run_at
+            next_run_at = cron.next_after(recurring_job["cron"], next_run_at)
+
+        missed_by = (now - last_due_at).total_seconds()
+        job = None
+        if (
+            recurring_job["catch_up"]
+            or missed_by <= settings.DISPATCHER_MAX_SLEEP_SECONDS
+        ):
+            job = _prepare_job(
+                type_=recurring_job["job_type"],
+                args=json.loads(recurring_job["args"]),
+                channel=recurring_job["channel"],
+                thread_ts=None,
+                delay_seconds=0,
+                priority=recurring_job["priority"],
+                coalesce=recurring_job["coalesce"],
+            )
+        return next_run_at, job
+
+    jobs = get_storage().schedule_recurring_jobs(now, plan)
+    if jobs:
+        notify_dispatcher([job["start_after"] for job in jobs])
+    return [job["type_"] for job in jobs]
+
+
+@log_call
+def get_recurring_jobs():
+    """Retrieve all recurring jobs."""
+
+    recurring_jobs = get_storage().get_recurring_jobs()
+    for recurring_job in recurring_jobs:
+        _convert_job_args_from_json(recurring_job)
+    return recurring_jobs
+
+
+@log_call
+def record_job_run(job_id, rc, log_dir):
+    """Record that a job has finished in the history of job runs.
+
+    This should be called before the job is removed with mark_job_done.  log_dir
+    is None if the job never wrote any logs.  Nothing is recorded if the job has
+    already been removed.
+    """
+
+    get_storage().record_job_run(
+        job_id, _now(), rc, None if log_dir is None else str(log_dir)
+    )
+
+
+@log_call
+def get_job_runs(type_=None, days=30):
+    """Return the runs of all jobs (or of jobs of given type) that finished in the
+    last given number of days, in the order they finished."""
+
+    runs = get_storage().get_job_runs(_now() - timedelta(days=days), type_)
+    for run in runs:
+        _convert_job_args_from_json(run)
+    return runs
+
+
+# @log_call
+def increment_metrics(increments):
+    """Add each value in the dict increments to the metric with its name, creating
+    metrics that don't exist yet.
+
+    This is not logged because it is called whenever a job starts or finishes.
+    """
+
+    get_storage().update_metrics(increments, {})
+
+
+# @log_call
+def record_dispatcher_tick(duration):
+    """Record that a run of the dispatcher's loop took duration seconds.
+
+    This is not logged because it is called by the dispatcher on every run.
+    """
+
+    get_storage().update_metrics(
+        {"dispatcher_tick_seconds_count": 1, "dispatcher_tick_seconds_sum": duration},
+        {
+            "dispatcher_last_tick_seconds": duration,
+            "dispatcher_last_tick_timestamp_seconds": _now().timestamp(),
+        },
+    )
+
+
+# @log_call
+def get_metrics():
+    """Return a dict of the values of all metrics, by name.
+
+    This is not logged because it is called whenever metrics are scraped.
+    """
+
+    return get_storage().get_metrics()
+
+
+# @log_call
+def get_queue_stats():
+    """Return the number of pending and running jobs of each type, and when the
+    oldest pending job of each type was created.
+
+    See Storage.get_queue_stats().  This is not logged because it is called
+    whenever metrics are scraped.
+    """
+
+    return get_storage().get_queue_stats()
+
+
+@log_call
+def get_job_run_stats(type_=None, days=30):
+    """Return the number of runs, the failure rate, and the median and 95th
+    percentile durations (in seconds) of jobs that finished in the last given
+    number of days.
+
+    Returns a list with a dict for each job type (or just for type_, if given),
+    ordered by type.
+    """
+
+    runs_by_type = {}
+    for run in get_storage().get_job_runs(_now() - timedelta(days=days), type_):
+        runs_by_type.setdefault(run["type"], []).append(run)
+
+    stats = []
+    for job_type, runs in sorted(runs_by_type.items()):
+        durations = sorted(
+            (
+                datetime.fromisoformat(run["finished_at"])
+                - datetime.fromisoformat(run["started_at"])
+            ).total_seconds()
+            for run in runs
+        )
+        failures = sum(1 for run in runs if run["rc"] != 0)
+        stats.append(
+            {
+                "type": job_type,
+                "runs": len(runs),
+                "failure_rate": failures / len(runs),
+                "p50": _percentile(durations, 50),
+                "p95": _percentile(durations, 95),
+            }
+        )
+    return stats
+
+
+def _percentile(values, percentile):
+    """Return the given percentile of a sorted list of values, using the
+    nearest-rank method."""
+
+    rank = math.ceil(percentile / 100 * len(values))
+    return values[max(rank, 1) - 1]
 
 
 @log_call
 def get_job(job_id):
-    """Retrieve job from job table."""
+    """Retrieve job, or None if there is no such job."""
 
-    conn = get_connection()
-    job = list(conn.execute("SELECT * FROM job WHERE id = ?", [job_id]))[0]
-    _convert_job_args_from_json(job)
-    return job
+    return get_storage().get_job(job_id)
+
+
+@log_call
+def get_job_recipients(job_id):
+    """Retrieve the channels and threads that the result of a job should be
+    reported to.
+
+    The first is the one the job was scheduled from, and the rest are from any
+    identical requests that were merged into the job (see schedule_job()).
+    """
+
+    return get_storage().get_job_recipients(job_id)
 
 
 @log_call
 def get_jobs():
-    """Retrieve all jobs from job table."""
+    """Retrieve all jobs."""
 
-    conn = get_connection()
-    jobs = list(conn.execute("SELECT * FROM job ORDER BY id"))
-    for job in jobs:
-        _convert_job_args_from_json(job)
-    return jobs
+    return get_storage().get_jobs()
 
 
 @log_call
 def get_jobs_of_type(type_):
-    """Retrieve all jobs of given type from job table."""
+    """Retrieve all jobs of given type."""
 
-    conn = get_connection()
-    jobs = list(conn.execute("SELECT * FROM job WHERE type = ? ORDER BY id", [type_]))
-    for job in jobs:
-        _convert_job_args_from_json(job)
-    return jobs
+    return get_storage().get_jobs(type_)
 
 
 @log_call
 def get_suppressions():
-    """Retrieve all suppressions from job table."""
+    """Retrieve all suppressions."""
+
+    return get_storage().get_suppressions()
+
+
+# @log_call
+def get_suppression_index():
+    """Return a storage.SuppressionIndex of all suppressions.
+
+    The index is only rebuilt when suppressions have changed, so this is cheap to
+    call often.
+
+    This is not logged because it is called by the dispatcher on every run.
+    """
 
-    conn = get_connection()
-    return list(conn.execute("SELECT * FROM suppression ORDER BY id"))
+    return get_storage().get_suppression_index()
 
 
 def _now():
@@ -14,6 +14,23 @@ WRITEABLE_DIR = env.path("WRITEABLE_DIR", default=APPLICATION_ROOT)
 
 DB_PATH = env.path("DB_PATH", default=WRITEABLE_DIR / "bennettbot.db")
 
+# SQLite settings applied to every connection to the job database.  The bot, the
+# dispatcher and the webserver's workers all write to the same file, so by default
+# we use WAL mode (readers don't block writers) and wait for locks to be released
+# rather than failing immediately with "database is locked".
+# See https://www.sqlite.org/pragma.html for the meaning of each setting.
+DB_JOURNAL_MODE = env.str("DB_JOURNAL_MODE", default="wal")
+DB_SYNCHRONOUS = env.str("DB_SYNCHRONOUS", default="normal")
+DB_BUSY_TIMEOUT_MS = env.int("DB_BUSY_TIMEOUT_MS", default=5000)
+DB_MMAP_SIZE = env.int("DB_MMAP_SIZE", default=64 * 1024 * 1024)
+# A negative cache size is a number of KiB rather than a number of pages
+DB_CACHE_SIZE = env.int("DB_CACHE_SIZE", default=-8000)
+
+# Where the scheduler stores jobs and suppressions: "sqlite" (in the database at
+# DB_PATH) or "memory".  Jobs stored in memory are not shared between processes, so
+# "memory" is only useful for tests and benchmarking.
+SCHEDULER_STORAGE = env.str("SCHEDULER_STORAGE", default="sqlite")
+
 # location of job workspaces that live in this repo
 WORKSPACE_DIR = env.path("WORKSPACE_DIR", default=APPLICATION_ROOT / "workspace")
 
@@ -27,6 +44,55 @@ WRITEABLE_WORKSPACE_DIR = env.path(
     "WRITEABLE_WORKSPACE_DIR", default=WRITEABLE_DIR / "workspace"
 )
 
+# Unix socket that the dispatcher listens on, so that it can be woken when jobs are
+# scheduled.  In production, this must be in the mounted volume that is shared by
+# the bot, dispatcher and webserver containers.
+DISPATCHER_SOCKET_PATH = env.path(
+    "DISPATCHER_SOCKET_PATH", default=WRITEABLE_DIR / "dispatcher.sock"
+)
+# The longest the dispatcher will sleep without checking for new jobs, in case it
+# misses a wakeup
+DISPATCHER_MAX_SLEEP_SECONDS = env.float("DISPATCHER_MAX_SLEEP_SECONDS", default=60)
+
+# The most jobs that the dispatcher will run at once; any more stay queued until a
+# running job finishes.  Individual namespaces can also be limited with
+# max_concurrent_jobs in job_configs.raw_config.
+MAX_CONCURRENT_JOBS = env.int("MAX_CONCURRENT_JOBS", default=8)
+
+# How long a reservation of a running job lasts.  The process running the job renews
+# its lease every third of this time, and if the lease expires (for instance, because
+# the dispatcher was restarted while the job was running) the job is abandoned, so
+# that other jobs of the same type can run.
+JOB_LEASE_SECONDS = env.float("JOB_LEASE_SECONDS", default=60)
+
+# Jobs with a python_entrypoint in job_configs.raw_config are run in a pool of up to
+# PYTHON_WORKER_POOL_SIZE worker processes.  Workers are forked from a process that
+# has already imported the modules in PYTHON_WORKER_PRELOAD, and each worker is
+# replaced after it has run PYTHON_WORKER_MAX_JOBS jobs.
+PYTHON_WORKER_POOL_SIZE = env.int("PYTHON_WORKER_POOL_SIZE", default=4)
+PYTHON_WORKER_MAX_JOBS = env.int("PYTHON_WORKER_MAX_JOBS", default=50)
+PYTHON_WORKER_PRELOAD = env.list(
+    "PYTHON_WORKER_PRELOAD",
+    default=[
+        "requests",
+        "slack_sdk",
+        "googleapiclient.discovery",
+        "google.oauth2.service_account",
+    ],
+)
+
+# Jobs with stream_output in job_configs.raw_config post the last
+# STREAM_OUTPUT_MAX_LINES lines of their stdout to Slack while they run, editing the
+# same message at most every STREAM_OUTPUT_INTERVAL_SECONDS.  Slack rate limits
+# chat.update to around 50 calls a minute, which is shared by all running jobs.
+STREAM_OUTPUT_INTERVAL_SECONDS = env.float("STREAM_OUTPUT_INTERVAL_SECONDS", default=10)
+STREAM_OUTPUT_MAX_LINES = env.int("STREAM_OUTPUT_MAX_LINES", default=20)
+
+# The most space that cached job results may take up; the least recently used
+# results are evicted first.  Results are only cached for jobs with a cache_ttl in
+# job_configs.raw_config.
+RESULT_CACHE_MAX_BYTES = env.int("RESULT_CACHE_MAX_BYTES", default=16 * 1024 * 1024)
+
 LOGS_DIR = env.path("LOGS_DIR")
 # An alias for logs dir; this is just used for reporting the host location of logs
 # in slack, where the log dir is a mounted volume
@@ -53,6 +119,10 @@ WEBHOOK_ORIGIN = env.str("WEBHOOK_ORIGIN")
 # "Secret" from https://github.com/bennettoxford/openprescribing/settings/hooks/85994427
 GITHUB_WEBHOOK_SECRET = env.str("GITHUB_WEBHOOK_SECRET").encode("ascii")
 
+# Bearer token that must be sent to the webserver's /metrics.  If this is not set,
+# /metrics can't be read.
+METRICS_TOKEN = env.str("METRICS_TOKEN", default="").encode("ascii")
+
 # Path to credentials of gdrive@ebmdatalab.iam.gserviceaccount.com GCP service account
 GCP_CREDENTIALS_PATH = env.path("GCP_CREDENTIALS_PATH")
 
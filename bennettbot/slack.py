@@ -103,6 +103,21 @@ def notify_slack(
         )
 
 
+def update_slack_message(slack_client, channel, ts, message_text):
+    """Replace the text of a message that has already been sent to Slack.
+
+    Unlike notify_slack(), this doesn't retry, or report errors in Slack, since it is
+    used for messages that will be updated again soon anyway.
+    """
+    logger.info("Updating message", channel=channel, ts=ts)
+    try:
+        slack_client.chat_update(channel=channel, ts=ts, text=message_text)
+    except Exception as error:
+        logger.error(
+            "Could not update slack message", channel=channel, ts=ts, error=error
+        )
+
+
 def get_slack_error_blocks(header_text, message_text, error):
     return get_basic_header_and_text_blocks(
         header_text=header_text,
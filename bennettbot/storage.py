@@ -0,0 +1,1462 @@
+"""
+Storage backends for scheduled jobs, suppressions, recurring jobs, the history of
+finished jobs, cached results and metrics.
+
+The scheduler module works out what to store and when, and a Storage is
+responsible for storing it.  There are two implementations:
+
+    * SQLiteStorage, which stores everything in the database at settings.DB_PATH,
+      so that it is shared by the bot, dispatcher and webserver processes
+    * MemoryStorage, which stores them in the memory of the current process, so
+      is only useful for tests and benchmarking
+
+The backend is chosen with settings.SCHEDULER_STORAGE.
+
+Each backend keeps a SuppressionIndex of the current suppressions, which is
+rebuilt when it finds that the suppressions have changed.
+
+Both backends return jobs and suppressions as Job and Suppression records, and
+everything else as dicts, with datetimes stored as strings, booleans stored as
+integers and args stored as JSON, as SQLite stores them.
+"""
+
+import abc
+import bisect
+import itertools
+import json
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+from . import settings
+from .connection import get_connection, transaction
+
+
+class Record:
+    """A lightweight, slotted record of a row.
+
+    Fields can be read as attributes, or by key like the dicts that other queries
+    return.  Subclasses list their fields in COLUMNS, in the order that they are
+    passed to __init__ and selected from the database.
+    """
+
+    __slots__ = ()
+    COLUMNS = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __repr__(self):
+        fields = ", ".join(
+            f"{column}={value!r}" for column, value in zip(self.COLUMNS, self._values())
+        )
+        return f"{type(self).__name__}({fields})"
+
+    def _values(self):
+        return tuple(getattr(self, column) for column in self.COLUMNS)
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        """Build a record from a row, for use as a cursor's row_factory."""
+
+        return cls(*row)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(*(d[column] for column in cls.COLUMNS))
+
+
+# Marks job args that haven't been decoded yet
+_UNDECODED = object()
+
+
+class Job(Record):
+    """A scheduled or running job.
+
+    args are stored as JSON, and only decoded the first time they are read, since
+    many callers (such as those that only need ids) never read them.
+    """
+
+    __slots__ = (
+        "id",
+        "type",
+        "_raw_args",
+        "_args",
+        "channel",
+        "thread_ts",
+        "start_after",
+        "started_at",
+        "is_im",
+        "created_at",
+        "priority",
+        "fresh",
+        "lease_expires_at",
+        "attempt",
+        "pid",
+        "kill_requested",
+        "kill_requested_channel",
+        "kill_requested_thread_ts",
+    )
+    COLUMNS = (
+        "id",
+        "type",
+        "args",
+        "channel",
+        "thread_ts",
+        "start_after",
+        "started_at",
+        "is_im",
+        "created_at",
+        "priority",
+        "fresh",
+        "lease_expires_at",
+        "attempt",
+        "pid",
+        "kill_requested",
+        "kill_requested_channel",
+        "kill_requested_thread_ts",
+    )
+
+    def __init__(
+        self,
+        id_,
+        type_,
+        args,
+        channel,
+        thread_ts,
+        start_after,
+        started_at,
+        is_im,
+        created_at,
+        priority,
+        fresh,
+        lease_expires_at,
+        attempt,
+        pid,
+        kill_requested,
+        kill_requested_channel,
+        kill_requested_thread_ts,
+    ):
+        self.id = id_
+        self.type = type_
+        self._raw_args = args
+        self._args = _UNDECODED
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.start_after = start_after
+        self.started_at = started_at
+        self.is_im = is_im
+        self.created_at = created_at
+        self.priority = priority
+        self.fresh = fresh
+        self.lease_expires_at = lease_expires_at
+        self.attempt = attempt
+        self.pid = pid
+        self.kill_requested = kill_requested
+        self.kill_requested_channel = kill_requested_channel
+        self.kill_requested_thread_ts = kill_requested_thread_ts
+
+    @property
+    def args(self):
+        if self._args is _UNDECODED:
+            self._args = json.loads(self._raw_args)
+        return self._args
+
+
+class Suppression(Record):
+    """A suppression of jobs of a given type."""
+
+    __slots__ = ("id", "job_type", "start_at", "end_at")
+    COLUMNS = __slots__
+
+    def __init__(self, id_, job_type, start_at, end_at):
+        self.id = id_
+        self.job_type = job_type
+        self.start_at = start_at
+        self.end_at = end_at
+
+
+class SuppressionIndex:
+    """An index of suppressions, for answering which job types are suppressed at a
+    given time, and when suppressions next start or end.
+
+    A suppression is active at t if start_at < t <= end_at.  For each job type, the
+    intervals covered by its suppressions are merged and sorted, so that these
+    questions can be answered by bisection.  As elsewhere, times are compared as
+    strings.
+    """
+
+    def __init__(self, suppressions, version=None):
+        self.version = version
+        self.suppressions = sorted(suppressions, key=lambda s: s.id)
+
+        # job_type -> sorted, non-overlapping [start_at, end_at] intervals
+        intervals_by_type = {}
+        for suppression in sorted(
+            self.suppressions, key=lambda s: (s.start_at, s.end_at)
+        ):
+            intervals = intervals_by_type.setdefault(suppression.job_type, [])
+            if intervals and suppression.start_at <= intervals[-1][1]:
+                intervals[-1][1] = max(intervals[-1][1], suppression.end_at)
+            else:
+                intervals.append([suppression.start_at, suppression.end_at])
+
+        self.starts_by_type = {
+            job_type: [start_at for start_at, _ in intervals]
+            for job_type, intervals in intervals_by_type.items()
+        }
+        self.ends_by_type = {
+            job_type: [end_at for _, end_at in intervals]
+            for job_type, intervals in intervals_by_type.items()
+        }
+        self.boundaries = sorted(
+            {s.start_at for s in self.suppressions}
+            | {s.end_at for s in self.suppressions}
+        )
+
+        # segment_types[ix] is the set of job types that are suppressed between
+        # boundaries[ix - 1] (exclusive) and boundaries[ix] (inclusive), so that the
+        # types suppressed at any time can be found with a single bisection
+        starting = {}
+        ending = {}
+        for job_type, intervals in intervals_by_type.items():
+            for start_at, end_at in intervals:
+                starting.setdefault(start_at, []).append(job_type)
+                ending.setdefault(end_at, []).append(job_type)
+        self.segment_types = [frozenset()]
+        suppressed = set()
+        for boundary in self.boundaries[:-1]:
+            # Intervals for a job type never overlap or touch, so a type never
+            # starts and ends at the same boundary
+            suppressed.difference_update(ending.get(boundary, []))
+            suppressed.update(starting.get(boundary, []))
+            self.segment_types.append(frozenset(suppressed))
+        self.segment_types.append(frozenset())
+
+    def suppressed_until(self, job_type, at):
+        """Return when jobs of given type stop being suppressed, if they are
+        suppressed at the given time, or None."""
+
+        at = str(at)
+        starts = self.starts_by_type.get(job_type, [])
+        # The last interval that starts before at
+        ix = bisect.bisect_left(starts, at) - 1
+        if ix >= 0 and at <= self.ends_by_type[job_type][ix]:
+            return self.ends_by_type[job_type][ix]
+        return None
+
+    def is_suppressed(self, job_type, at):
+        """Return whether jobs of given type are suppressed at the given time."""
+
+        return self.suppressed_until(job_type, at) is not None
+
+    def suppressed_types(self, at):
+        """Return the set of job types that are suppressed at the given time."""
+
+        return self.segment_types[bisect.bisect_left(self.boundaries, str(at))]
+
+    def next_boundary(self, at):
+        """Return the earliest time, no earlier than the given time, that a
+        suppression starts or ends, or None."""
+
+        ix = bisect.bisect_left(self.boundaries, str(at))
+        return self.boundaries[ix] if ix < len(self.boundaries) else None
+
+    def partition(self, at):
+        """Return the suppressions that are active at the given time, and those that
+        haven't started yet, each in the order they were created."""
+
+        at = str(at)
+        active = [s for s in self.suppressions if s.start_at < at <= s.end_at]
+        scheduled = [s for s in self.suppressions if s.start_at >= at]
+        return active, scheduled
+
+
+class Storage(abc.ABC):
+    _suppression_index = None
+
+    @abc.abstractmethod
+    def schedule_job(
+        self,
+        type_,
+        args,
+        channel,
+        thread_ts,
+        start_after,
+        is_im,
+        priority,
+        coalesce,
+        fresh,
+    ):
+        """Store a job, coalescing it with any pending job of the same type as
+        described by scheduler.schedule_job().
+
+        Returns a boolean indicating whether an existing job was already running.
+        """
+
+    @abc.abstractmethod
+    def schedule_jobs(self, jobs):
+        """Store several jobs atomically, in order.  Each job is a dict of keyword
+        arguments to schedule_job().
+
+        Returns a list of what schedule_job() returns for each job.
+        """
+
+    @abc.abstractmethod
+    def cancel_job(self, type_):
+        """Remove pending jobs of given type."""
+
+    @abc.abstractmethod
+    def mark_job_done(self, job_id):
+        """Remove job."""
+
+    @abc.abstractmethod
+    def retry_job(self, job_id, start_after):
+        """Return running job with given id to the queue, to be attempted again
+        after start_after."""
+
+    @abc.abstractmethod
+    def set_job_pid(self, job_id, pid):
+        """Record the pid of the process running job with given id."""
+
+    @abc.abstractmethod
+    def request_kill(self, job_id, channel, thread_ts):
+        """Mark running job with given id to be killed, recording the channel and
+        thread that the kill was requested from."""
+
+    @abc.abstractmethod
+    def cancel_kill(self, job_id):
+        """Unmark job with given id to be killed."""
+
+    @abc.abstractmethod
+    def get_jobs_to_kill(self):
+        """Return ids of running jobs that have been marked to be killed."""
+
+    @abc.abstractmethod
+    def reserve_jobs(
+        self, now, lease_expires_at, limit, max_running, max_running_by_namespace
+    ):
+        """Reserve available jobs and return their ids, as described by
+        scheduler.reserve_jobs().  Each reserved job is leased until
+        lease_expires_at."""
+
+    @abc.abstractmethod
+    def renew_lease(self, job_id, lease_expires_at):
+        """Extend the lease of running job with given id until lease_expires_at."""
+
+    @abc.abstractmethod
+    def get_expired_jobs(self, now):
+        """Return running jobs whose leases expired before now, in the order they
+        were created."""
+
+    @abc.abstractmethod
+    def get_next_wakeup(self, now):
+        """Return the earliest time after now that a pending job is due to start, or
+        None."""
+
+    @abc.abstractmethod
+    def get_pending_start_times(self, now):
+        """Return the times after now that pending jobs are due to start, in
+        order."""
+
+    @abc.abstractmethod
+    def get_job(self, job_id):
+        """Return job with given id, or None."""
+
+    @abc.abstractmethod
+    def get_job_recipients(self, job_id):
+        """Return the channel, thread_ts and is_im of everyone who requested job
+        with given id, in the order they requested it."""
+
+    @abc.abstractmethod
+    def get_jobs(self, type_=None):
+        """Return all jobs (or all jobs of given type) in the order they were
+        created."""
+
+    @abc.abstractmethod
+    def get_queue_stats(self):
+        """Return a dict for each type of job that is scheduled or running, ordered by
+        type, with the number of pending and running jobs of that type, and the
+        created_at of the oldest pending job (or None)."""
+
+    @abc.abstractmethod
+    def record_job_run(self, job_id, finished_at, rc, log_dir):
+        """Atomically record that job with given id finished at finished_at, and
+        count it in the jobs_finished_total and jobs_failed_total metrics.  Nothing
+        is recorded if there is no such job."""
+
+    @abc.abstractmethod
+    def get_job_runs(self, since, type_=None):
+        """Return the runs of all jobs (or of jobs of given type) that finished no
+        earlier than since, in the order they were recorded."""
+
+    @abc.abstractmethod
+    def cache_result(self, type_, args, stdout, now, max_bytes):
+        """Cache the stdout of a job, as described by scheduler.cache_result(),
+        evicting the least recently used results while the cache takes up more than
+        max_bytes."""
+
+    @abc.abstractmethod
+    def get_cached_result(self, type_, args, now, created_since):
+        """Return the stdout and created_at of the cached result of a job with given
+        type and args, if it was created no earlier than created_since, marking it
+        as used at now, or None."""
+
+    @abc.abstractmethod
+    def sync_recurring_jobs(self, schedules):
+        """Make the recurring jobs match schedules, as described by
+        scheduler.sync_recurring_jobs().  Each schedule has a next_run_at key, which
+        is only stored for schedules that don't already exist."""
+
+    @abc.abstractmethod
+    def schedule_recurring_jobs(self, now, plan):
+        """Pass each recurring job that is due at now to plan(), in the order they
+        were created, which returns when it is next due, and a dict of keyword
+        arguments to schedule_job() (or None).  Then atomically record when each is
+        next due and store the jobs, returning them."""
+
+    @abc.abstractmethod
+    def get_recurring_jobs(self):
+        """Return all recurring jobs in the order they were created."""
+
+    @abc.abstractmethod
+    def get_next_recurring_run_at(self):
+        """Return the earliest time that a recurring job is next due, or None."""
+
+    @abc.abstractmethod
+    def update_metrics(self, increments, values):
+        """Atomically add each value in the dict increments to the metric with its
+        name, and set each metric named in the dict values to its value, creating
+        metrics that don't exist yet."""
+
+    @abc.abstractmethod
+    def get_metrics(self):
+        """Return a dict of the values of all metrics, by name."""
+
+    @abc.abstractmethod
+    def schedule_suppression(self, job_type, start_at, end_at):
+        """Store suppression for jobs of given type."""
+
+    @abc.abstractmethod
+    def cancel_suppressions(self, job_type):
+        """Remove suppressions for jobs of given type."""
+
+    @abc.abstractmethod
+    def remove_expired_suppressions(self, now):
+        """Remove suppressions that ended before now."""
+
+    @abc.abstractmethod
+    def get_suppressions(self):
+        """Return all suppressions in the order they were created."""
+
+    @abc.abstractmethod
+    def get_suppression_version(self):
+        """Return a number that changes whenever suppressions are changed."""
+
+    def get_suppression_index(self):
+        """Return a SuppressionIndex of all suppressions, rebuilding it only if
+        suppressions have changed since it was last built."""
+
+        # The version is read first, so that if suppressions change while the index
+        # is being built, it is rebuilt again next time
+        version = self.get_suppression_version()
+        index = self._suppression_index
+        if index is None or index.version != version:
+            index = SuppressionIndex(self.get_suppressions(), version)
+            self._suppression_index = index
+        return index
+
+
+class SQLiteStorage(Storage):
+    def schedule_job(
+        self,
+        type_,
+        args,
+        channel,
+        thread_ts,
+        start_after,
+        is_im,
+        priority,
+        coalesce,
+        fresh,
+    ):
+        sql = """
+        SELECT id, args, started_at IS NOT NULL AS has_started
+        FROM job
+        WHERE type = ?
+        ORDER BY has_started, id
+        """
+
+        with transaction() as conn:
+            existing_jobs = list(conn.execute(sql, [type_]))
+            existing_job_running = any(job["has_started"] for job in existing_jobs)
+            pending_jobs = [job for job in existing_jobs if not job["has_started"]]
+            matching_jobs = [
+                job for job in pending_jobs if json.loads(job["args"]) == args
+            ]
+
+            if coalesce == "replace" and pending_jobs:
+                conn.execute(
+                    "UPDATE job SET args = ?, channel = ?, thread_ts = ?, start_after = ?, created_at = ?, priority = ?, fresh = ?, attempt = 1 WHERE id = ?",
+                    [
+                        json.dumps(args),
+                        channel,
+                        thread_ts,
+                        start_after,
+                        _now(),
+                        priority,
+                        fresh,
+                        pending_jobs[0]["id"],
+                    ],
+                )
+            elif coalesce == "dedupe" and matching_jobs:
+                conn.execute(
+                    "INSERT INTO job_recipient (job_id, channel, thread_ts, is_im) VALUES (?, ?, ?, ?)",
+                    [matching_jobs[0]["id"], channel, thread_ts, is_im],
+                )
+                if fresh:
+                    conn.execute(
+                        "UPDATE job SET fresh = ? WHERE id = ?",
+                        [fresh, matching_jobs[0]["id"]],
+                    )
+            else:
+                conn.execute(
+                    "INSERT INTO job (type, args, channel, thread_ts, start_after, is_im, created_at, priority, fresh) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        type_,
+                        json.dumps(args),
+                        channel,
+                        thread_ts,
+                        start_after,
+                        is_im,
+                        _now(),
+                        priority,
+                        fresh,
+                    ],
+                )
+
+        return existing_job_running
+
+    def schedule_jobs(self, jobs):
+        with transaction():
+            return [self.schedule_job(**job) for job in jobs]
+
+    def cancel_job(self, type_):
+        with transaction() as conn:
+            conn.execute(
+                "DELETE FROM job_recipient WHERE job_id IN (SELECT id FROM job WHERE type = ? AND started_at IS NULL)",
+                [type_],
+            )
+            conn.execute(
+                "DELETE FROM job WHERE type = ? AND started_at IS NULL", [type_]
+            )
+
+    def mark_job_done(self, job_id):
+        with transaction() as conn:
+            conn.execute("DELETE FROM job_recipient WHERE job_id = ?", [job_id])
+            conn.execute("DELETE FROM job WHERE id = ?", [job_id])
+
+    def retry_job(self, job_id, start_after):
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE job SET start_after = ?, started_at = NULL, lease_expires_at = NULL, attempt = attempt + 1, pid = NULL WHERE id = ?",
+                [start_after, job_id],
+            )
+
+    def set_job_pid(self, job_id, pid):
+        with transaction() as conn:
+            conn.execute("UPDATE job SET pid = ? WHERE id = ?", [pid, job_id])
+
+    def request_kill(self, job_id, channel, thread_ts):
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE job SET kill_requested = 1, kill_requested_channel = ?, kill_requested_thread_ts = ? WHERE id = ? AND started_at IS NOT NULL",
+                [channel, thread_ts, job_id],
+            )
+
+    def cancel_kill(self, job_id):
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE job SET kill_requested = 0, kill_requested_channel = NULL, kill_requested_thread_ts = NULL WHERE id = ?",
+                [job_id],
+            )
+
+    def get_jobs_to_kill(self):
+        sql = "SELECT id FROM job WHERE kill_requested ORDER BY id"
+        return [row["id"] for row in get_connection().execute(sql)]
+
+    def reserve_jobs(
+        self, now, lease_expires_at, limit, max_running, max_running_by_namespace
+    ):
+        # Jobs are selected and updated in a single UPDATE ... RETURNING statement,
+        # so that two callers can never reserve the same job, or two jobs of the
+        # same type.
+        sql = """
+        WITH namespace_limit AS (
+            SELECT key AS namespace, value AS max_running
+            FROM json_each(?)
+        ),
+
+        running_count AS (
+            SELECT substr(type, 1, instr(type, '_') - 1) AS namespace, COUNT(*) AS running
+            FROM job
+            WHERE started_at IS NOT NULL
+            GROUP BY namespace
+        ),
+
+        available_jobs AS (
+            SELECT
+                job.id,
+                substr(job.type, 1, instr(job.type, '_') - 1) AS namespace,
+                job.priority,
+                job.start_after,
+                ROW_NUMBER() OVER (
+                    PARTITION BY job.type
+                    ORDER BY job.priority DESC, job.start_after, job.id
+                ) AS rank
+            FROM job
+            WHERE
+                  job.started_at IS NULL
+              AND job.start_after <= ?
+              AND NOT EXISTS (
+                  SELECT 1
+                  FROM job AS running_job
+                  WHERE running_job.type = job.type
+                    AND running_job.started_at IS NOT NULL
+              )
+              AND job.type NOT IN (SELECT value FROM json_each(?))
+        ),
+
+        namespace_ranked_jobs AS (
+            SELECT
+                id,
+                namespace,
+                priority,
+                start_after,
+                ROW_NUMBER() OVER (
+                    PARTITION BY namespace ORDER BY priority DESC, start_after, id
+                ) AS namespace_rank
+            FROM available_jobs
+            WHERE rank = 1
+        )
+
+        UPDATE job
+        SET started_at = ?, lease_expires_at = ?
+        WHERE id IN (
+            SELECT id
+            FROM namespace_ranked_jobs
+            LEFT JOIN namespace_limit USING (namespace)
+            LEFT JOIN running_count USING (namespace)
+            WHERE
+                 namespace_limit.max_running IS NULL
+              OR namespace_rank + COALESCE(running_count.running, 0)
+                 <= namespace_limit.max_running
+            ORDER BY priority DESC, start_after, id
+            LIMIT ?
+        )
+        RETURNING id, priority, start_after
+        """
+
+        namespace_limits = json.dumps(max_running_by_namespace or {})
+        with transaction() as conn:
+            # This is inside the transaction, so that the suppressions can't change
+            # before the jobs are reserved
+            suppressed_types = json.dumps(
+                sorted(self.get_suppression_index().suppressed_types(now))
+            )
+            if max_running is not None:
+                running = conn.execute(
+                    "SELECT COUNT(*) AS running FROM job WHERE started_at IS NOT NULL"
+                ).fetchone()["running"]
+                available = max(max_running - running, 0)
+                limit = available if limit is None else min(limit, available)
+            # A negative LIMIT means no limit
+            limit = -1 if limit is None else limit
+            results = list(
+                conn.execute(
+                    sql,
+                    [
+                        namespace_limits,
+                        now,
+                        suppressed_types,
+                        now,
+                        lease_expires_at,
+                        limit,
+                    ],
+                )
+            )
+
+        results.sort(key=_priority_order)
+        return [job["id"] for job in results]
+
+    def renew_lease(self, job_id, lease_expires_at):
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE job SET lease_expires_at = ? WHERE id = ? AND started_at IS NOT NULL",
+                [lease_expires_at, job_id],
+            )
+
+    def get_expired_jobs(self, now):
+        return _query(
+            Job,
+            "job WHERE started_at IS NOT NULL AND lease_expires_at < ? ORDER BY id",
+            [now],
+        )
+
+    def get_next_wakeup(self, now):
+        sql = """
+        SELECT MIN(start_after) AS wakeup_at
+        FROM job
+        WHERE started_at IS NULL AND start_after > ?
+        """
+
+        return get_connection().execute(sql, [now]).fetchone()["wakeup_at"]
+
+    def get_pending_start_times(self, now):
+        sql = """
+        SELECT start_after
+        FROM job
+        WHERE started_at IS NULL AND start_after > ?
+        ORDER BY start_after
+        """
+
+        return [row["start_after"] for row in get_connection().execute(sql, [now])]
+
+    def get_job(self, job_id):
+        jobs = _query(Job, "job WHERE id = ?", [job_id])
+        return jobs[0] if jobs else None
+
+    def get_job_recipients(self, job_id):
+        conn = get_connection()
+        return list(
+            conn.execute(
+                "SELECT channel, thread_ts, is_im FROM job WHERE id = ?", [job_id]
+            )
+        ) + list(
+            conn.execute(
+                "SELECT channel, thread_ts, is_im FROM job_recipient WHERE job_id = ? ORDER BY id",
+                [job_id],
+            )
+        )
+
+    def get_jobs(self, type_=None):
+        return _query(
+            Job, "job WHERE (? IS NULL OR type = ?) ORDER BY id", [type_, type_]
+        )
+
+    def get_queue_stats(self):
+        sql = """
+        SELECT
+            type,
+            SUM(started_at IS NULL) AS pending,
+            SUM(started_at IS NOT NULL) AS running,
+            MIN(CASE WHEN started_at IS NULL THEN created_at END)
+                AS oldest_pending_created_at
+        FROM job
+        GROUP BY type
+        ORDER BY type
+        """
+
+        return list(get_connection().execute(sql))
+
+    def record_job_run(self, job_id, finished_at, rc, log_dir):
+        sql = """
+        INSERT INTO job_run
+            (job_id, type, args, queued_at, started_at, finished_at, rc, log_dir)
+        SELECT id, type, args, created_at, started_at, ?, ?, ?
+        FROM job
+        WHERE id = ?
+        """
+
+        with transaction() as conn:
+            if conn.execute(sql, [finished_at, rc, log_dir, job_id]).rowcount:
+                self.update_metrics(
+                    {"jobs_finished_total": 1, "jobs_failed_total": int(rc != 0)}, {}
+                )
+
+    def get_job_runs(self, since, type_=None):
+        sql = """
+        SELECT *
+        FROM job_run
+        WHERE finished_at >= ? AND (? IS NULL OR type = ?)
+        ORDER BY id
+        """
+
+        return list(get_connection().execute(sql, [since, type_, type_]))
+
+    def cache_result(self, type_, args, stdout, now, max_bytes):
+        sql = """
+        INSERT INTO result_cache (job_type, args, stdout, size, created_at, used_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (job_type, args) DO UPDATE SET
+            stdout = excluded.stdout,
+            size = excluded.size,
+            created_at = excluded.created_at,
+            used_at = excluded.used_at
+        """
+
+        evict_sql = """
+        DELETE FROM result_cache
+        WHERE id IN (
+            SELECT id
+            FROM (
+                SELECT id, SUM(size) OVER (ORDER BY used_at DESC, id DESC) AS total_size
+                FROM result_cache
+            )
+            WHERE total_size > ?
+        )
+        """
+
+        args = json.dumps(args, sort_keys=True)
+        size = len(stdout.encode())
+        with transaction() as conn:
+            conn.execute(sql, [type_, args, stdout, size, now, now])
+            conn.execute(evict_sql, [max_bytes])
+
+    def get_cached_result(self, type_, args, now, created_since):
+        sql = """
+        UPDATE result_cache
+        SET used_at = ?
+        WHERE job_type = ? AND args = ? AND created_at >= ?
+        RETURNING stdout, created_at
+        """
+
+        args = json.dumps(args, sort_keys=True)
+        with transaction() as conn:
+            return conn.execute(sql, [now, type_, args, created_since]).fetchone()
+
+    def sync_recurring_jobs(self, schedules):
+        with transaction() as conn:
+            existing_ids = {
+                (row["job_type"], row["cron"], row["args"], row["channel"]): row["id"]
+                for row in conn.execute("SELECT * FROM recurring_job")
+            }
+
+            for schedule in schedules:
+                args = json.dumps(schedule["args"], sort_keys=True)
+                key = (
+                    schedule["job_type"],
+                    schedule["cron"],
+                    args,
+                    schedule["channel"],
+                )
+                if key in existing_ids:
+                    conn.execute(
+                        "UPDATE recurring_job SET catch_up = ?, priority = ?, coalesce = ? WHERE id = ?",
+                        [
+                            schedule["catch_up"],
+                            schedule["priority"],
+                            schedule["coalesce"],
+                            existing_ids.pop(key),
+                        ],
+                    )
+                else:
+                    conn.execute(
+                        "INSERT INTO recurring_job (job_type, cron, args, channel, catch_up, priority, coalesce, next_run_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [
+                            *key,
+                            schedule["catch_up"],
+                            schedule["priority"],
+                            schedule["coalesce"],
+                            schedule["next_run_at"],
+                        ],
+                    )
+
+            for id_ in existing_ids.values():
+                conn.execute("DELETE FROM recurring_job WHERE id = ?", [id_])
+
+    def schedule_recurring_jobs(self, now, plan):
+        jobs = []
+        with transaction() as conn:
+            recurring_jobs = conn.execute(
+                "SELECT * FROM recurring_job WHERE next_run_at <= ? ORDER BY id", [now]
+            ).fetchall()
+            for recurring_job in recurring_jobs:
+                next_run_at, job = plan(recurring_job)
+                conn.execute(
+                    "UPDATE recurring_job SET next_run_at = ? WHERE id = ?",
+                    [next_run_at, recurring_job["id"]],
+                )
+                if job is not None:
+                    jobs.append(job)
+            if jobs:
+                self.schedule_jobs(jobs)
+        return jobs
+
+    def get_recurring_jobs(self):
+        return list(get_connection().execute("SELECT * FROM recurring_job ORDER BY id"))
+
+    def get_next_recurring_run_at(self):
+        sql = "SELECT MIN(next_run_at) AS next_run_at FROM recurring_job"
+        return get_connection().execute(sql).fetchone()["next_run_at"]
+
+    def update_metrics(self, increments, values):
+        with transaction() as conn:
+            conn.executemany(
+                "INSERT INTO metric (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                increments.items(),
+            )
+            conn.executemany(
+                "INSERT INTO metric (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+                values.items(),
+            )
+
+    def get_metrics(self):
+        return {
+            row["name"]: row["value"]
+            for row in get_connection().execute("SELECT name, value FROM metric")
+        }
+
+    def schedule_suppression(self, job_type, start_at, end_at):
+        with transaction() as conn:
+            conn.execute(
+                "INSERT INTO suppression (job_type, start_at, end_at) VALUES (?, ?, ?)",
+                [job_type, start_at, end_at],
+            )
+
+    def cancel_suppressions(self, job_type):
+        with transaction() as conn:
+            conn.execute("DELETE FROM suppression WHERE job_type = ?", [job_type])
+
+    def remove_expired_suppressions(self, now):
+        with transaction() as conn:
+            conn.execute("DELETE FROM suppression WHERE end_at < ?", [now])
+
+    def get_suppressions(self):
+        return _query(Suppression, "suppression ORDER BY id")
+
+    def get_suppression_version(self):
+        # Maintained by triggers on the suppression table
+        conn = get_connection()
+        return conn.execute("SELECT version FROM suppression_version").fetchone()[
+            "version"
+        ]
+
+
+class MemoryStorage(Storage):
+    """Stores everything in dicts and lists.
+
+    A lock is held while jobs are changed, so that (as with SQLiteStorage) two
+    threads can never reserve the same job.  The lock is reentrant, so that the
+    suppression index can be brought up to date while it is held.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.jobs = {}
+        self.recipients = {}
+        self.suppressions = {}
+        self.metrics = {}
+        self.job_runs = []
+        # Cached results, by (job_type, args)
+        self.results = {}
+        self.recurring_jobs = {}
+        self.job_ids = itertools.count(1)
+        self.suppression_ids = itertools.count(1)
+        self.job_run_ids = itertools.count(1)
+        self.result_ids = itertools.count(1)
+        self.recurring_job_ids = itertools.count(1)
+        self.suppression_version = 0
+
+    def schedule_job(
+        self,
+        type_,
+        args,
+        channel,
+        thread_ts,
+        start_after,
+        is_im,
+        priority,
+        coalesce,
+        fresh,
+    ):
+        with self.lock:
+            existing_jobs = [job for job in self.jobs.values() if job["type"] == type_]
+            existing_job_running = any(job["started_at"] for job in existing_jobs)
+            pending_jobs = [job for job in existing_jobs if not job["started_at"]]
+            matching_jobs = [
+                job for job in pending_jobs if json.loads(job["args"]) == args
+            ]
+
+            if coalesce == "replace" and pending_jobs:
+                pending_jobs[0].update(
+                    args=json.dumps(args),
+                    channel=channel,
+                    thread_ts=thread_ts,
+                    start_after=str(start_after),
+                    created_at=str(_now()),
+                    priority=priority,
+                    fresh=int(fresh),
+                    attempt=1,
+                )
+            elif coalesce == "dedupe" and matching_jobs:
+                job = matching_jobs[0]
+                self.recipients[job["id"]].append(
+                    {"channel": channel, "thread_ts": thread_ts, "is_im": int(is_im)}
+                )
+                if fresh:
+                    job["fresh"] = int(fresh)
+            else:
+                id_ = next(self.job_ids)
+                self.jobs[id_] = {
+                    "id": id_,
+                    "type": type_,
+                    "args": json.dumps(args),
+                    "channel": channel,
+                    "thread_ts": thread_ts,
+                    "start_after": str(start_after),
+                    "started_at": None,
+                    "is_im": int(is_im),
+                    "created_at": str(_now()),
+                    "priority": priority,
+                    "fresh": int(fresh),
+                    "lease_expires_at": None,
+                    "attempt": 1,
+                    "pid": None,
+                    "kill_requested": 0,
+                    "kill_requested_channel": None,
+                    "kill_requested_thread_ts": None,
+                }
+                self.recipients[id_] = []
+
+        return existing_job_running
+
+    def schedule_jobs(self, jobs):
+        with self.lock:
+            # Restore the original jobs if any job can't be stored, as a rolled
+            # back transaction would
+            original_jobs = {id_: dict(job) for id_, job in self.jobs.items()}
+            original_recipients = {
+                id_: list(recipients) for id_, recipients in self.recipients.items()
+            }
+            try:
+                return [self.schedule_job(**job) for job in jobs]
+            except BaseException:
+                self.jobs = original_jobs
+                self.recipients = original_recipients
+                raise
+
+    def cancel_job(self, type_):
+        with self.lock:
+            for job in list(self.jobs.values()):
+                if job["type"] == type_ and not job["started_at"]:
+                    del self.jobs[job["id"]]
+                    del self.recipients[job["id"]]
+
+    def mark_job_done(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+            self.recipients.pop(job_id, None)
+
+    def retry_job(self, job_id, start_after):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.update(
+                    start_after=str(start_after),
+                    started_at=None,
+                    lease_expires_at=None,
+                    attempt=job["attempt"] + 1,
+                    pid=None,
+                )
+
+    def set_job_pid(self, job_id, pid):
+        with self.lock:
+            if job_id in self.jobs:
+                self.jobs[job_id]["pid"] = pid
+
+    def request_kill(self, job_id, channel, thread_ts):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job["started_at"]:
+                job.update(
+                    kill_requested=1,
+                    kill_requested_channel=channel,
+                    kill_requested_thread_ts=thread_ts,
+                )
+
+    def cancel_kill(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.update(
+                    kill_requested=0,
+                    kill_requested_channel=None,
+                    kill_requested_thread_ts=None,
+                )
+
+    def get_jobs_to_kill(self):
+        with self.lock:
+            return sorted(
+                job["id"] for job in self.jobs.values() if job["kill_requested"]
+            )
+
+    def reserve_jobs(
+        self, now, lease_expires_at, limit, max_running, max_running_by_namespace
+    ):
+        now = str(now)
+        namespace_limits = max_running_by_namespace or {}
+
+        with self.lock:
+            running_jobs = [job for job in self.jobs.values() if job["started_at"]]
+            running_types = {job["type"] for job in running_jobs}
+            running_by_namespace = Counter(
+                _get_namespace(job["type"]) for job in running_jobs
+            )
+            suppressed_types = self.get_suppression_index().suppressed_types(now)
+
+            # The first available job of each type
+            available_jobs = {}
+            for job in sorted(self.jobs.values(), key=_priority_order):
+                if (
+                    not job["started_at"]
+                    and job["start_after"] <= now
+                    and job["type"] not in running_types
+                    and job["type"] not in suppressed_types
+                ):
+                    available_jobs.setdefault(job["type"], job)
+
+            if max_running is not None:
+                available = max(max_running - len(running_jobs), 0)
+                limit = available if limit is None else min(limit, available)
+
+            reserved_jobs = []
+            for job in sorted(available_jobs.values(), key=_priority_order):
+                if limit is not None and len(reserved_jobs) >= limit:
+                    break
+                namespace = _get_namespace(job["type"])
+                if (
+                    namespace in namespace_limits
+                    and running_by_namespace[namespace] >= namespace_limits[namespace]
+                ):
+                    continue
+                running_by_namespace[namespace] += 1
+                job["started_at"] = now
+                job["lease_expires_at"] = str(lease_expires_at)
+                reserved_jobs.append(job)
+
+        return [job["id"] for job in reserved_jobs]
+
+    def renew_lease(self, job_id, lease_expires_at):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job["started_at"]:
+                job["lease_expires_at"] = str(lease_expires_at)
+
+    def get_expired_jobs(self, now):
+        now = str(now)
+        with self.lock:
+            return [
+                Job.from_dict(job)
+                for job in self.jobs.values()
+                if job["started_at"] and job["lease_expires_at"] < now
+            ]
+
+    def get_next_wakeup(self, now):
+        now = str(now)
+        with self.lock:
+            return min(
+                (
+                    job["start_after"]
+                    for job in self.jobs.values()
+                    if not job["started_at"] and job["start_after"] > now
+                ),
+                default=None,
+            )
+
+    def get_pending_start_times(self, now):
+        now = str(now)
+        with self.lock:
+            return sorted(
+                job["start_after"]
+                for job in self.jobs.values()
+                if not job["started_at"] and job["start_after"] > now
+            )
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else Job.from_dict(job)
+
+    def get_job_recipients(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return []
+            return [
+                {
+                    "channel": job["channel"],
+                    "thread_ts": job["thread_ts"],
+                    "is_im": job["is_im"],
+                },
+                *(dict(recipient) for recipient in self.recipients[job_id]),
+            ]
+
+    def get_jobs(self, type_=None):
+        with self.lock:
+            return [
+                Job.from_dict(job)
+                for job in self.jobs.values()
+                if type_ is None or job["type"] == type_
+            ]
+
+    def get_queue_stats(self):
+        stats = {}
+        with self.lock:
+            for job in self.jobs.values():
+                type_stats = stats.setdefault(
+                    job["type"],
+                    {
+                        "type": job["type"],
+                        "pending": 0,
+                        "running": 0,
+                        "oldest_pending_created_at": None,
+                    },
+                )
+                if job["started_at"]:
+                    type_stats["running"] += 1
+                else:
+                    type_stats["pending"] += 1
+                    type_stats["oldest_pending_created_at"] = min(
+                        type_stats["oldest_pending_created_at"] or job["created_at"],
+                        job["created_at"],
+                    )
+        return [stats[type_] for type_ in sorted(stats)]
+
+    def record_job_run(self, job_id, finished_at, rc, log_dir):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            self.job_runs.append(
+                {
+                    "id": next(self.job_run_ids),
+                    "job_id": job["id"],
+                    "type": job["type"],
+                    "args": job["args"],
+                    "queued_at": job["created_at"],
+                    "started_at": job["started_at"],
+                    "finished_at": str(finished_at),
+                    "rc": rc,
+                    "log_dir": log_dir,
+                }
+            )
+            self.update_metrics(
+                {"jobs_finished_total": 1, "jobs_failed_total": int(rc != 0)}, {}
+            )
+
+    def get_job_runs(self, since, type_=None):
+        since = str(since)
+        with self.lock:
+            return [
+                dict(job_run)
+                for job_run in self.job_runs
+                if job_run["finished_at"] >= since
+                and (type_ is None or job_run["type"] == type_)
+            ]
+
+    def cache_result(self, type_, args, stdout, now, max_bytes):
+        now = str(now)
+        key = (type_, json.dumps(args, sort_keys=True))
+        with self.lock:
+            result = self.results.get(key)
+            self.results[key] = {
+                "id": next(self.result_ids) if result is None else result["id"],
+                "stdout": stdout,
+                "size": len(stdout.encode()),
+                "created_at": now,
+                "used_at": now,
+            }
+            total_size = 0
+            for result_key, result in sorted(
+                self.results.items(),
+                key=lambda item: (item[1]["used_at"], item[1]["id"]),
+                reverse=True,
+            ):
+                total_size += result["size"]
+                if total_size > max_bytes:
+                    del self.results[result_key]
+
+    def get_cached_result(self, type_, args, now, created_since):
+        key = (type_, json.dumps(args, sort_keys=True))
+        with self.lock:
+            result = self.results.get(key)
+            if result is None or result["created_at"] < str(created_since):
+                return None
+            result["used_at"] = str(now)
+            return {"stdout": result["stdout"], "created_at": result["created_at"]}
+
+    def sync_recurring_jobs(self, schedules):
+        with self.lock:
+            existing_ids = {
+                (rj["job_type"], rj["cron"], rj["args"], rj["channel"]): rj["id"]
+                for rj in self.recurring_jobs.values()
+            }
+
+            for schedule in schedules:
+                args = json.dumps(schedule["args"], sort_keys=True)
+                key = (
+                    schedule["job_type"],
+                    schedule["cron"],
+                    args,
+                    schedule["channel"],
+                )
+                if key in existing_ids:
+                    self.recurring_jobs[existing_ids.pop(key)].update(
+                        catch_up=int(schedule["catch_up"]),
+                        priority=schedule["priority"],
+                        coalesce=schedule["coalesce"],
+                    )
+                else:
+                    id_ = next(self.recurring_job_ids)
+                    self.recurring_jobs[id_] = {
+                        "id": id_,
+                        "job_type": schedule["job_type"],
+                        "cron": schedule["cron"],
+                        "args": args,
+                        "channel": schedule["channel"],
+                        "catch_up": int(schedule["catch_up"]),
+                        "priority": schedule["priority"],
+                        "next_run_at": str(schedule["next_run_at"]),
+                        "coalesce": schedule["coalesce"],
+                    }
+
+            for id_ in existing_ids.values():
+                del self.recurring_jobs[id_]
+
+    def schedule_recurring_jobs(self, now, plan):
+        now = str(now)
+        jobs = []
+        next_run_ats = {}
+        with self.lock:
+            for recurring_job in self.recurring_jobs.values():
+                if recurring_job["next_run_at"] <= now:
+                    next_run_at, job = plan(dict(recurring_job))
+                    next_run_ats[recurring_job["id"]] = str(next_run_at)
+                    if job is not None:
+                        jobs.append(job)
+            # The jobs are stored first, so that if they can't be, nothing changes,
+            # as with a rolled back transaction
+            if jobs:
+                self.schedule_jobs(jobs)
+            for id_, next_run_at in next_run_ats.items():
+                self.recurring_jobs[id_]["next_run_at"] = next_run_at
+        return jobs
+
+    def get_recurring_jobs(self):
+        with self.lock:
+            return [dict(rj) for rj in self.recurring_jobs.values()]
+
+    def get_next_recurring_run_at(self):
+        with self.lock:
+            return min(
+                (rj["next_run_at"] for rj in self.recurring_jobs.values()),
+                default=None,
+            )
+
+    def update_metrics(self, increments, values):
+        with self.lock:
+            for name, increment in increments.items():
+                self.metrics[name] = self.metrics.get(name, 0) + increment
+            self.metrics.update(values)
+
+    def get_metrics(self):
+        with self.lock:
+            return dict(self.metrics)
+
+    def schedule_suppression(self, job_type, start_at, end_at):
+        with self.lock:
+            id_ = next(self.suppression_ids)
+            self.suppressions[id_] = {
+                "id": id_,
+                "job_type": job_type,
+                "start_at": str(start_at),
+                "end_at": str(end_at),
+            }
+            self.suppression_version += 1
+
+    def cancel_suppressions(self, job_type):
+        with self.lock:
+            for suppression in list(self.suppressions.values()):
+                if suppression["job_type"] == job_type:
+                    del self.suppressions[suppression["id"]]
+                    self.suppression_version += 1
+
+    def remove_expired_suppressions(self, now):
+        now = str(now)
+        with self.lock:
+            for suppression in list(self.suppressions.values()):
+                if suppression["end_at"] < now:
+                    del self.suppressions[suppression["id"]]
+                    self.suppression_version += 1
+
+    def get_suppressions(self):
+        with self.lock:
+            return [
+                Suppression.from_dict(suppression)
+                for suppression in self.suppressions.values()
+            ]
+
+    def get_suppression_version(self):
+        return self.suppression_version
+
+
+STORAGES = {
+    "sqlite": SQLiteStorage,
+    "memory": MemoryStorage,
+}
+
+_storages = {}
+
+
+def get_storage():
+    """Return the storage backend named by settings.SCHEDULER_STORAGE.
+
+    Each backend is only created once per process, so that a MemoryStorage
+    keeps its contents between calls.
+    """
+
+    name = settings.SCHEDULER_STORAGE
+    if name not in _storages:
+        _storages[name] = STORAGES[name]()
+    return _storages[name]
+
+
+def reset_storage():
+    """Discard every backend, along with the contents of any MemoryStorage."""
+
+    _storages.clear()
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _get_namespace(job_type):
+    return job_type.split("_")[0]
+
+
+def _priority_order(job):
+    return (-job["priority"], job["start_after"], job["id"])
+
+
+def _query(record_type, sql, params=()):
+    """Select rows as records of given type, where sql is the part of the query
+    after "FROM".
+
+    Building records directly from rows avoids building a dict for each row, as
+    the connection's row factory does.
+    """
+
+    cursor = get_connection().cursor()
+    cursor.row_factory = record_type.from_row
+    columns = ", ".join(record_type.COLUMNS)
+    return cursor.execute(f"SELECT {columns} FROM {sql}", params).fetchall()
@@ -0,0 +1,115 @@
+"""
+Lets the bot and the webserver wake the dispatcher when they change the job or
+suppression tables, so that the dispatcher can sleep until it next has work to do
+rather than polling the database every second.
+
+The dispatcher listens on a Unix datagram socket at settings.DISPATCHER_SOCKET_PATH,
+which is in the storage that is shared between the bot, dispatcher and webserver
+containers.
+
+When jobs are scheduled, the notification carries the times they are due to start,
+so that the dispatcher can keep track of when it next needs to wake without
+querying the database.
+"""
+
+import asyncio
+import os
+import socket
+from datetime import datetime
+
+from . import settings
+from .logger import logger
+
+
+# The most start times that are sent in one notification, so that it fits in
+# RECV_BUFFER_SIZE.  Only the earliest are sent; the dispatcher finds the rest when
+# it next checks the database.
+MAX_NOTIFIED_START_TIMES = 1000
+RECV_BUFFER_SIZE = 65536
+
+
+def notify_dispatcher(start_times=()):
+    """Wake the dispatcher, telling it the times that any jobs that have just been
+    scheduled are due to start.
+
+    This never blocks or raises: if the dispatcher isn't listening, it will find
+    the change the next time it checks the database anyway.
+    """
+
+    start_times = sorted(start_times)[:MAX_NOTIFIED_START_TIMES]
+    message = "\n".join(start_time.isoformat() for start_time in start_times) or "."
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        try:
+            sock.sendto(message.encode(), str(settings.DISPATCHER_SOCKET_PATH))
+        except OSError as e:
+            # Either the dispatcher isn't running, or its socket's buffer is full,
+            # in which case it already has a wakeup pending
+            logger.debug("Could not notify dispatcher", error=e)
+
+
+class Listener:
+    """Receives notifications sent by notify_dispatcher()."""
+
+    def __init__(self, path=None):
+        self.path = str(path or settings.DISPATCHER_SOCKET_PATH)
+        # Remove the socket left behind by any previous dispatcher
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(self.path)
+
+    async def wait(self, timeout):
+        """Wait until a notification is received or timeout seconds have passed.
+
+        Returns a list of the start times carried by every notification that has
+        arrived, or None if no notification was received.  (The list is empty if
+        notifications carried no start times.)  Any process can write to the
+        socket, so lines that aren't start times are logged and skipped.
+        """
+
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(self.sock, lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, timeout)
+        except TimeoutError:
+            return None
+        finally:
+            loop.remove_reader(self.sock)
+
+        start_times = []
+        while True:
+            try:
+                message = self.sock.recv(RECV_BUFFER_SIZE)
+            except BlockingIOError:
+                return start_times
+            message = message.decode(errors="replace")
+            if message != ".":
+                for line in message.split("\n"):
+                    start_time = _parse_start_time(line)
+                    if start_time is None:
+                        logger.info("Ignoring invalid start time", line=line)
+                    else:
+                        start_times.append(start_time)
+
+    def close(self):
+        self.sock.close()
+
+
+def _parse_start_time(line):
+    """Return the start time in a line of a notification, or None if the line isn't
+    a timezone-aware ISO 8601 datetime (which couldn't be compared with other start
+    times)."""
+
+    try:
+        start_time = datetime.fromisoformat(line)
+    except ValueError:
+        return None
+    if start_time.tzinfo is None:
+        return None
+    return start_time
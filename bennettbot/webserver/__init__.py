@@ -1,6 +1,7 @@
 from flask import Flask
 
 from .github import handle_github_webhook
+from .metrics import metrics
 
 
 def check():
@@ -10,3 +11,4 @@ def check():
 app = Flask(__name__)
 app.route("/check/", methods=["GET"])(check)
 app.route("/github/<project>/", methods=["POST"])(handle_github_webhook)
+app.route("/metrics", methods=["GET"])(metrics)
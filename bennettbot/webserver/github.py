@@ -73,25 +73,27 @@ def schedule_deploy(project):
 
     logger.info("Scheduling deploy", project=project)
     channel = config["default_channel"][project]
-    scheduler.schedule_job(job, {}, channel, "", delay_seconds=60)
+    scheduler.schedule_job(
+        job,
+        {},
+        channel,
+        "",
+        delay_seconds=60,
+        priority=config["jobs"][job]["priority"],
+        coalesce=config["jobs"][job]["coalesce"],
+    )
 
     # Notify if deploys are suppressed
-    active_suppression = next(
-        (
-            suppression
-            for suppression in scheduler.get_suppressions()
-            if suppression["start_at"] < str(scheduler._now())
-            and suppression["job_type"] == job
-        ),
-        None,
+    suppressed_until = scheduler.get_suppression_index().suppressed_until(
+        job, scheduler._now()
     )
-    if active_suppression:
+    if suppressed_until:
         notify_slack(
             slack_web_client(),
             channel,
             (
                 "PR merged, not deploying because deploys suppressed until "
-                f"{active_suppression['end_at']}.\n"
+                f"{suppressed_until}.\n"
                 f"In an emergency, use `{project} suppress cancel` followed by "
                 f"`{project} deploy` to force a deployment"
             ),
@@ -0,0 +1,144 @@
+import hmac
+from collections import Counter
+from datetime import datetime
+
+from flask import Response, abort, request
+
+from .. import scheduler, settings
+
+
+# Metrics that are recorded in the metric table by the scheduler and dispatcher,
+# with their types and help text
+RECORDED_METRICS = {
+    "jobs_started_total": ("counter", "Jobs started by the dispatcher."),
+    "jobs_finished_total": (
+        "counter",
+        "Jobs that finished, including those reported from the cache.",
+    ),
+    "jobs_failed_total": ("counter", "Jobs that finished with a non-zero rc."),
+    "jobs_retried_total": (
+        "counter",
+        "Jobs that failed and were queued to be attempted again.",
+    ),
+    "dispatcher_tick_seconds": (
+        "summary",
+        "Time taken by each run of the dispatcher's loop.",
+    ),
+    "dispatcher_last_tick_seconds": (
+        "gauge",
+        "Time taken by the last run of the dispatcher's loop.",
+    ),
+    "dispatcher_last_tick_timestamp_seconds": (
+        "gauge",
+        "When the dispatcher's loop last ran, as a Unix timestamp.",
+    ),
+}
+
+
+def metrics():
+    """Report the state of the job queue and the dispatcher in the Prometheus text
+    format, so that monitoring can alert when jobs back up."""
+
+    verify_token(request)
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+def verify_token(request):
+    """Verify that request has been sent with the bearer token in METRICS_TOKEN.
+
+    Raises 403 if it has not been, or if no token is configured.
+    """
+
+    header = request.headers.get("Authorization")
+
+    if not settings.METRICS_TOKEN or header is None:
+        abort(403)
+
+    if header[:7] != "Bearer ":
+        abort(403)
+
+    if not hmac.compare_digest(header[7:].encode("utf8"), settings.METRICS_TOKEN):
+        abort(403)
+
+
+def render_metrics():
+    now = scheduler._now()
+    lines = []
+
+    def add(name, type_, help_text, samples):
+        lines.append(f"# HELP bennettbot_{name} {help_text}")
+        lines.append(f"# TYPE bennettbot_{name} {type_}")
+        for suffix, labels, value in samples:
+            lines.append(
+                f"bennettbot_{name}{suffix}{_format_labels(labels)} {float(value)!r}"
+            )
+
+    queue_stats = scheduler.get_queue_stats()
+    add(
+        "jobs_pending",
+        "gauge",
+        "Jobs waiting to run, by type.",
+        [("", {"type": s["type"]}, s["pending"]) for s in queue_stats],
+    )
+    add(
+        "jobs_running",
+        "gauge",
+        "Jobs running, by type.",
+        [("", {"type": s["type"]}, s["running"]) for s in queue_stats],
+    )
+    oldest_created_at = min(
+        (
+            s["oldest_pending_created_at"]
+            for s in queue_stats
+            if s["oldest_pending_created_at"]
+        ),
+        default=None,
+    )
+    oldest_age = 0
+    if oldest_created_at:
+        oldest_age = (now - datetime.fromisoformat(oldest_created_at)).total_seconds()
+    add(
+        "oldest_pending_job_age_seconds",
+        "gauge",
+        "How long ago the oldest job that is waiting to run was scheduled.",
+        [("", {}, oldest_age)],
+    )
+
+    active_suppressions, _ = scheduler.get_suppression_index().partition(now)
+    add(
+        "suppressions_active",
+        "gauge",
+        "Active suppressions, by job type.",
+        [
+            ("", {"type": job_type}, count)
+            for job_type, count in sorted(
+                Counter(s.job_type for s in active_suppressions).items()
+            )
+        ],
+    )
+
+    values = scheduler.get_metrics()
+    for name, (type_, help_text) in RECORDED_METRICS.items():
+        if type_ == "summary":
+            samples = [
+                (suffix, {}, values.get(f"{name}{suffix}", 0))
+                for suffix in ["_sum", "_count"]
+            ]
+        else:
+            samples = [("", {}, values.get(name, 0))]
+        add(name, type_, help_text, samples)
+
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{key}="{_escape_label_value(value)}"' for key, value in labels.items()
+    )
+    return f"{{{pairs}}}"
+
+
+def _escape_label_value(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,177 @@
+"""
+A pool of warm worker processes for running jobs that have a python_entrypoint.
+
+Running a job's run_args_template starts a shell and then a new Python interpreter,
+which has to import everything the job uses before it can do anything.  Instead, a
+job with a python_entrypoint has its function called in one of these workers.
+
+Workers are forked from a server process that has already imported
+settings.PYTHON_WORKER_PRELOAD, so they start with those libraries loaded.  Each
+worker is replaced after running settings.PYTHON_WORKER_MAX_JOBS jobs, so that
+state left behind by one job (such as modules that it imported, or globals that it
+changed) can't build up indefinitely.
+"""
+
+import asyncio
+import contextlib
+import importlib
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from . import scheduler, settings
+from .logger import logger
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class JobTimedOut(BaseException):
+    """Raised in a job's function when it runs for longer than its timeout_seconds.
+
+    Like KeyboardInterrupt, this isn't an Exception, so that it isn't caught by the
+    function's own error handling.
+    """
+
+
+async def run_in_worker(
+    entrypoint, args, cwd, stdout_path, stderr_path, timeout_seconds=None
+):
+    """Run a job's entrypoint in the pool with run_entrypoint(), waiting for it to
+    finish, and return its rc.
+
+    The job is waited for without holding a thread, so that jobs that are queued for
+    a worker don't stop other calls being made in threads.  It is submitted in a
+    thread, though, since submitting may wait for a new worker to be started.
+
+    If the worker dies while running the job, the pool can't be used again, so it is
+    replaced, and the job fails.
+    """
+
+    try:
+        future = await asyncio.to_thread(
+            get_executor().submit,
+            run_entrypoint,
+            entrypoint,
+            args,
+            cwd,
+            stdout_path,
+            stderr_path,
+            timeout_seconds,
+        )
+        return await asyncio.wrap_future(future)
+    except BrokenProcessPool:
+        logger.info("worker died", entrypoint=entrypoint)
+        await asyncio.to_thread(reset_executor)
+        with open(stderr_path, "a") as stderr:
+            traceback.print_exc(file=stderr)
+        return -1
+
+
+def run_entrypoint(
+    entrypoint, args, cwd, stdout_path, stderr_path, timeout_seconds=None
+):
+    """Call the function named by entrypoint ("module:function") with args as
+    keyword arguments, and return an rc.
+
+    This runs in a worker.  As with a script that is run by a job, the function runs
+    in cwd, and anything it prints goes to stdout_path and stderr_path.  Whatever it
+    returns (unless it's None) is written to stdout_path, as if it had been printed.
+    If it raises an exception, the traceback is written to stderr_path and the rc is
+    1; if it calls sys.exit(), the rc is the exit status.  The files are line
+    buffered, so that output can be streamed while the function runs.
+
+    If timeout_seconds is given, JobTimedOut is raised in the function when it has
+    run for that long (with SIGALRM, so this must be called in the main thread), and
+    the rc is scheduler.TIMED_OUT_RC.
+    """
+
+    original_cwd = os.getcwd()
+    with (
+        open(stdout_path, "w", buffering=1) as stdout,
+        open(stderr_path, "w", buffering=1) as stderr,
+        contextlib.redirect_stdout(stdout),
+        contextlib.redirect_stderr(stderr),
+        _timeout(timeout_seconds),
+    ):
+        try:
+            # The function is loaded before changing directory, in case the module
+            # is found through a relative entry in sys.path
+            function = load_entrypoint(entrypoint)
+            os.chdir(cwd)
+            rv = function(**args)
+            if rv is not None:
+                print(rv)
+            rc = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                rc = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                rc = 1
+        except JobTimedOut:
+            traceback.print_exc()
+            rc = scheduler.TIMED_OUT_RC
+        except Exception:
+            traceback.print_exc()
+            rc = 1
+        finally:
+            os.chdir(original_cwd)
+    return rc
+
+
+@contextlib.contextmanager
+def _timeout(seconds):
+    """Raise JobTimedOut if the block is still running after seconds (if given)."""
+
+    if seconds is None:
+        yield
+        return
+
+    def raise_timed_out(signum, frame):
+        raise JobTimedOut(f"Timed out after {seconds} seconds")
+
+    previous_handler = signal.signal(signal.SIGALRM, raise_timed_out)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def load_entrypoint(entrypoint):
+    module_name, function_name = entrypoint.split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def get_executor():
+    """Return the pool, starting it if it hasn't been started yet."""
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload([__name__, *settings.PYTHON_WORKER_PRELOAD])
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.PYTHON_WORKER_POOL_SIZE,
+                mp_context=context,
+                max_tasks_per_child=settings.PYTHON_WORKER_MAX_JOBS,
+            )
+        return _executor
+
+
+def reset_executor():
+    """Shut the pool down, so that a new one is started when it is next needed."""
+
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(cancel_futures=True)
+        _executor = None
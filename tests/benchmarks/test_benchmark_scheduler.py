@@ -0,0 +1,71 @@
+import json
+
+import pytest
+import structlog
+
+from benchmarks import benchmark_scheduler
+from bennettbot import scheduler, settings
+
+
+@pytest.fixture(autouse=True)
+def restore_structlog_config():
+    config = structlog.get_config()
+    yield
+    structlog.configure(**config)
+
+
+def test_benchmark_saves_baseline(tmp_path, capsys):
+    baseline_path = tmp_path / "baseline.json"
+    db_path = settings.DB_PATH
+
+    rc = benchmark_scheduler.main(
+        [
+            "--jobs=2,3",
+            "--suppressions=0,2",
+            "--iterations=5",
+            f"--baseline={baseline_path}",
+            "--save",
+        ]
+    )
+
+    assert rc == 0
+    baseline = json.loads(baseline_path.read_text())
+    assert len(baseline) == 8
+    assert set(baseline["memory jobs=3 suppressions=2"]) == set(
+        benchmark_scheduler.FUNCTIONS
+    )
+    assert f"Saved baseline to {baseline_path}" in capsys.readouterr().out
+
+    # The settings and scheduler are left as they were
+    assert settings.DB_PATH == db_path
+    assert scheduler.get_jobs() == []
+
+
+def test_benchmark_reports_regressions(tmp_path, capsys):
+    baseline_path = tmp_path / "baseline.json"
+    args = ["--storage=memory", "--jobs=1", "--suppressions=0", "--iterations=5"]
+    name = "memory jobs=1 suppressions=0"
+
+    # Without a baseline, nothing can regress
+    assert benchmark_scheduler.main(args + [f"--baseline={baseline_path}"]) == 0
+
+    # Against an impossibly fast baseline, everything regresses (the memory backend
+    # is too fast for its p99 to be worse by more than the noise floor, so this
+    # relies on it sustaining fewer calls per second)
+    fast = {"ops_per_sec": 1e9, "p99_ms": 1e-9}
+    baseline = {name: {function: fast for function in benchmark_scheduler.FUNCTIONS}}
+    baseline_path.write_text(json.dumps(baseline))
+    assert (
+        benchmark_scheduler.main(
+            args + [f"--baseline={baseline_path}", "--tolerance=0.5"]
+        )
+        == 1
+    )
+    assert "REGRESSION" in capsys.readouterr().out
+
+    # Against an impossibly slow baseline, nothing does
+    slow = {"ops_per_sec": 1e-9, "p99_ms": 1e9}
+    baseline = {name: {function: slow for function in benchmark_scheduler.FUNCTIONS}}
+    baseline_path.write_text(json.dumps(baseline))
+    assert benchmark_scheduler.main(args + [f"--baseline={baseline_path}"]) == 0
+    assert "REGRESSION" not in capsys.readouterr().out
@@ -6,7 +6,7 @@ import os
 
 import pytest
 
-from bennettbot import settings
+from bennettbot import connection, settings, storage, workers
 
 
 pytest.register_assert_rewrite("tests.assertions")
@@ -14,7 +14,18 @@ pytest.register_assert_rewrite("tests.assertions")
 
 @pytest.fixture(autouse=True)
 def reset_db():
-    try:
-        os.remove(settings.DB_PATH)
-    except FileNotFoundError:
-        pass
+    connection.reset_connections()
+    storage.reset_storage()
+    # In WAL mode, the database has -wal and -shm files alongside it, which must
+    # be removed too so that they aren't applied to the next test's database
+    for suffix in ["", "-wal", "-shm"]:
+        try:
+            os.remove(f"{settings.DB_PATH}{suffix}")
+        except FileNotFoundError:
+            pass
+
+
+@pytest.fixture(autouse=True)
+def reset_workers():
+    yield
+    workers.reset_executor()
@@ -21,6 +21,11 @@ raw_config = {
                 "run_args_template": "cat poem",
                 "report_stdout": True,
             },
+            "cached_job": {
+                "run_args_template": "cat poem",
+                "report_stdout": True,
+                "cache_ttl": 60,
+            },
             "unreported_job": {
                 "run_args_template": "cat poem",
                 "report_success": False,
@@ -28,12 +33,47 @@ raw_config = {
             "bad_job": {
                 "run_args_template": "cat no-poem",
             },
+            "retried_bad_job": {
+                "run_args_template": "cat no-poem",
+                "retries": 2,
+                "backoff": 10,
+            },
+            "timed_out_job": {
+                "run_args_template": "sleep 10 & echo $! > {pid_path}; wait",
+                "timeout_seconds": 0.2,
+            },
+            "stubborn_timed_out_job": {
+                "run_args_template": "trap '' TERM; sleep 10",
+                "timeout_seconds": 0.2,
+            },
+            "killable_job": {
+                "run_args_template": "sleep 10 & echo $! > {pid_path}; wait",
+                "retries": 1,
+            },
+            "streamed_job": {
+                "run_args_template": "echo one; sleep 0.3; echo two; sleep 0.3; echo three",
+                "stream_output": True,
+            },
             "really_bad_job": {
                 "run_args_template": "dog poem",
             },
             "job_with_url": {
                 "run_args_template": "curl {url}",
             },
+            "good_entrypoint_job": {
+                "run_args_template": "python jobs.py hello_world",
+                "python_entrypoint": "tests.workspace.test.jobs:hello_world",
+                "report_stdout": True,
+            },
+            "parameterised_entrypoint_job": {
+                "run_args_template": "python jobs.py hello_world --name {name}",
+                "python_entrypoint": "tests.workspace.test.jobs:hello_world",
+                "report_stdout": True,
+            },
+            "bad_entrypoint_job": {
+                "run_args_template": "python jobs.py hello_world_blocks_error",
+                "python_entrypoint": "tests.workspace.test.jobs:hello_world_blocks_error",
+            },
             "good_python_job": {
                 "run_args_template": "python jobs.py hello_world",
                 "report_stdout": True
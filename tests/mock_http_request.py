@@ -146,6 +146,7 @@ def register_dispatcher_uris():
                 {"ok": True, "channel": "channel", "permalink": "http://example.com"}
             ],
             "reactions.add": [{"ok": True}],
+            "chat.update": [{"ok": True, "ts": TS, "channel": "channel"}],
         }
     )
 
@@ -156,7 +157,7 @@ def get_mock_received_requests():
     mocket.
     Note that the slack_sdk uses params for its api calls for most methods.
     It uses json for calls that use (or can use) blocks. For our purposes, this
-    if just the chat.postMessage calls.
+    is just the chat.postMessage and chat.update calls.
     param values are converted to lists during the api call, so e.g. for a
     reactions.add call, a call using
         client.reactions_add(channel="C1", name=":sos:", timestamp=123.45)
@@ -169,7 +170,7 @@ def get_mock_received_requests():
     for request in Mocket.request_list():
         if request.headers["content-length"] == "0":
             body = ""
-        elif request.path == "/api/chat.postMessage":
+        elif request.path in ["/api/chat.postMessage", "/api/chat.update"]:
             body = json.loads(request.body)
         else:
             body = parse_qs(request.body)
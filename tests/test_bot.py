@@ -115,6 +115,21 @@ def test_schedule_job(mock_app):
     )
 
 
+@pytest.mark.parametrize(
+    "text,job_type,args",
+    [
+        ("test do job 10 --fresh", "test_parameterised_job", {"n": "10"}),
+        ("test do good job --fresh", "test_good_job", {}),
+    ],
+)
+def test_schedule_job_with_fresh(mock_app, text, job_type, args):
+    handle_message(mock_app, f"<@U1234> {text}")
+
+    [job] = scheduler.get_jobs_of_type(job_type)
+    assert job["args"] == args
+    assert job["fresh"]
+
+
 def test_schedule_job_with_job_already_running(mock_app):
     with patch("bennettbot.scheduler.schedule_job", return_value=True):
         handle_message(mock_app, "<@U1234> test do good job")
@@ -313,6 +328,50 @@ def test_status(mock_app):
     )
 
 
+def test_stats(mock_app):
+    handle_message(mock_app, "<@U1234> stats", reaction_count=0)
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "channel", "text": "No jobs have finished in the last 30 days"}
+        ],
+    )
+
+
+def test_stats_for_job_type(mock_app):
+    handle_message(mock_app, "<@U1234> stats test_good_job", reaction_count=0)
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {
+                "channel": "channel",
+                "text": "No `test_good_job` jobs have finished in the last 30 days",
+            }
+        ],
+    )
+
+
+def test_build_stats(freezer):
+    for job_type, duration, rc in [
+        ("good_job", 10, 0),
+        ("good_job", 20, 1),
+        ("odd_job", 5, 0),
+    ]:
+        scheduler.schedule_job(job_type, {}, "channel", TS, 0)
+        job_id = scheduler.reserve_job()
+        freezer.tick(timedelta(seconds=duration))
+        scheduler.record_job_run(job_id, rc, "logs")
+        scheduler.mark_job_done(job_id)
+
+    assert (
+        bot._build_stats()
+        == """
+Jobs that finished in the last 30 days:
+
+* good_job: 2 runs, 50% failed, median 10.0s, p95 20.0s
+* odd_job: 1 run, 0% failed, median 5.0s, p95 5.0s
+""".strip()
+    )
+
+
 @pytest.mark.parametrize(
     "pre_message,message",
     [
@@ -429,6 +488,20 @@ There is 1 scheduled suppression:
     )
 
 
+def test_build_status_with_job_being_killed():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    scheduler.record_job_pid(job_id, 1234)
+    scheduler.request_job_kill(job_id, "channel", TS)
+
+    status = bot._build_status()
+
+    assert (
+        "* [1] good_job (started at 2019-12-10 11:12:13+00:00, pid 1234, being killed)"
+        in status
+    )
+
+
 def test_pluralise():
     assert bot._pluralise(0, "bot") == "There are 0 bots"
     assert bot._pluralise(1, "bot") == "There is 1 bot"
@@ -829,6 +902,59 @@ def test_remove_non_existent_job(mock_app):
     ) in post_message.items()
 
 
+def test_kill_job(mock_app):
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+
+    with patch("bennettbot.scheduler.notify_dispatcher") as notify_dispatcher:
+        handle_message(mock_app, f"<@U1234> kill job id {job_id}", reaction_count=1)
+
+    # The dispatcher is woken to kill the job, which is removed once it has been
+    notify_dispatcher.assert_called_once_with()
+    assert scheduler.get_jobs_to_kill() == [job_id]
+    assert scheduler.get_job(job_id)["kill_requested_channel"] == "channel"
+    post_message = get_mock_received_requests()["/api/chat.postMessage"][0]
+    assert ("text", "Job id [1] will be killed") in post_message.items()
+
+
+def test_kill_job_that_has_not_started(mock_app):
+    handle_message(mock_app, "<@U1234> test do good job", reaction_count=1)
+    job_id = scheduler.get_jobs_of_type("test_good_job")[0]["id"]
+
+    handle_message(mock_app, f"<@U1234> kill job id {job_id}", reaction_count=2)
+
+    assert not scheduler.get_jobs_of_type("test_good_job")
+    post_message = get_mock_received_requests()["/api/chat.postMessage"][0]
+    assert (
+        "text",
+        "Job id [1] hadn't started, and has been removed",
+    ) in post_message.items()
+
+
+def test_kill_entrypoint_job(mock_app):
+    scheduler.schedule_job("test_good_entrypoint_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+
+    handle_message(mock_app, f"<@U1234> kill job id {job_id}", reaction_count=1)
+
+    assert scheduler.get_jobs_to_kill() == []
+    post_message = get_mock_received_requests()["/api/chat.postMessage"][0]
+    assert (
+        "text",
+        "Job id [1] runs in a worker that is shared with other jobs, so it can't be "
+        "killed",
+    ) in post_message.items()
+
+
+def test_kill_non_existent_job(mock_app):
+    handle_message(mock_app, "<@U1234> kill job id 10", reaction_count=1)
+    post_message = get_mock_received_requests()["/api/chat.postMessage"][0]
+    assert (
+        "text",
+        "Job id [10] not found in running or scheduled jobs",
+    ) in post_message.items()
+
+
 @pytest.mark.parametrize(
     "user,command,reaction_count,scheduled_job_count",
     [
@@ -0,0 +1,221 @@
+import sqlite3
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from bennettbot import connection, scheduler, settings
+
+
+def test_get_connection_reuses_connection():
+    assert connection.get_connection() is connection.get_connection()
+
+
+def test_get_connection_per_thread():
+    conns = []
+    thread = threading.Thread(target=lambda: conns.append(connection.get_connection()))
+    thread.start()
+    thread.join()
+
+    assert conns[0] is not connection.get_connection()
+
+
+def test_get_connection_after_fork():
+    conn = connection.get_connection()
+    with patch("bennettbot.connection.os.getpid", return_value=-1):
+        assert connection.get_connection() is not conn
+
+
+def test_get_connection_after_reset():
+    conn = connection.get_connection()
+    connection.reset_connections()
+    assert connection.get_connection() is not conn
+
+
+def test_transaction_commits():
+    with connection.transaction() as conn:
+        conn.execute("INSERT INTO job (type) VALUES ('good_job')")
+
+    assert not conn.in_transaction
+    assert len(list(conn.execute("SELECT * FROM job"))) == 1
+
+
+def test_transaction_rolls_back():
+    with pytest.raises(ValueError):
+        with connection.transaction() as conn:
+            conn.execute("INSERT INTO job (type) VALUES ('good_job')")
+            raise ValueError
+
+    assert not conn.in_transaction
+    assert len(list(conn.execute("SELECT * FROM job"))) == 0
+
+
+def test_transaction_rolls_back_when_commit_fails():
+    conn = connection.get_connection()
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY)")
+    conn.execute(
+        "CREATE TABLE child (parent_id INTEGER REFERENCES parent (id) "
+        "DEFERRABLE INITIALLY DEFERRED)"
+    )
+
+    # The foreign key is only checked when the transaction is committed
+    with pytest.raises(sqlite3.IntegrityError):
+        with connection.transaction() as conn:
+            conn.execute("INSERT INTO child (parent_id) VALUES (1)")
+
+    assert not conn.in_transaction
+    assert len(list(conn.execute("SELECT * FROM child"))) == 0
+
+
+def test_transaction_already_rolled_back_by_error():
+    conn = connection.get_connection()
+    conn.execute(
+        "CREATE TRIGGER job_insert BEFORE INSERT ON job "
+        "BEGIN SELECT RAISE(ROLLBACK, 'no jobs'); END"
+    )
+
+    # The original error is raised, rather than an error from rolling back again
+    with pytest.raises(sqlite3.IntegrityError, match="no jobs"):
+        with connection.transaction() as conn:
+            conn.execute("INSERT INTO job (type) VALUES ('good_job')")
+
+    assert not conn.in_transaction
+
+
+def test_nested_transaction_joins_outer_transaction():
+    with pytest.raises(ValueError):
+        with connection.transaction() as conn:
+            conn.execute("INSERT INTO job (type) VALUES ('good_job')")
+            with connection.transaction() as inner_conn:
+                assert inner_conn is conn
+                conn.execute("INSERT INTO job (type, args) VALUES ('odd_job', '{}')")
+            assert conn.in_transaction
+            raise ValueError
+
+    assert len(list(conn.execute("SELECT * FROM job"))) == 0
+
+
+def test_pragmas_applied():
+    conn = connection.get_connection()
+    assert list(conn.execute("PRAGMA journal_mode")) == [{"journal_mode": "wal"}]
+    assert list(conn.execute("PRAGMA synchronous")) == [{"synchronous": 1}]
+    assert list(conn.execute("PRAGMA busy_timeout")) == [{"timeout": 5000}]
+
+
+@patch("bennettbot.settings.DB_JOURNAL_MODE", "delete")
+@patch("bennettbot.settings.DB_BUSY_TIMEOUT_MS", 100)
+def test_pragmas_configurable():
+    conn = connection.get_connection()
+    assert list(conn.execute("PRAGMA journal_mode")) == [{"journal_mode": "delete"}]
+    assert list(conn.execute("PRAGMA busy_timeout")) == [{"timeout": 100}]
+
+
+def test_migrations_applied():
+    conn = connection.get_connection()
+    assert connection._get_user_version(conn) == len(connection.MIGRATIONS)
+    indexes = {
+        row["name"]
+        for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    }
+    assert {
+        "job_type_started_at_start_after",
+        "job_started_at_start_after",
+        "suppression_job_type_start_at_end_at",
+        "suppression_end_at",
+    } <= indexes
+
+
+def test_migrate_database_created_before_migrations():
+    with sqlite3.connect(settings.DB_PATH) as conn:
+        conn.execute(
+            "CREATE TABLE job (id INTEGER PRIMARY KEY, type TEXT NOT NULL, args TEXT, "
+            "channel TEXT, thread_ts TEXT, start_after DATETIME, started_at DATETIME, "
+            "is_im BOOLEAN)"
+        )
+        conn.execute("INSERT INTO job (type) VALUES ('good_job')")
+    conn.close()
+
+    conn = connection.get_connection()
+    assert connection._get_user_version(conn) == len(connection.MIGRATIONS)
+    assert [job["type"] for job in conn.execute("SELECT * FROM job")] == ["good_job"]
+
+
+def test_migrate_database_with_running_job_from_before_leases():
+    with patch("bennettbot.connection.MIGRATIONS", connection.MIGRATIONS[:7]):
+        conn = connection.get_connection()
+        conn.execute(
+            "INSERT INTO job (type, args, started_at) VALUES ('good_job', '{}', '2019-12-10 11:12:13+00:00')"
+        )
+        conn.execute("INSERT INTO job (type, args) VALUES ('odd_job', '{}')")
+    connection.reset_connections()
+
+    conn = connection.get_connection()
+    assert connection._get_user_version(conn) == len(connection.MIGRATIONS)
+    # The running job's lease has expired, so that it can be abandoned
+    [(job, _)] = scheduler.fail_expired_jobs()
+    assert job["type"] == "good_job"
+    assert [job["type"] for job in scheduler.get_jobs()] == ["odd_job"]
+
+
+def test_migrate_already_migrated_database():
+    conn = connection.get_connection()
+    connection.migrate(conn)
+    assert connection._get_user_version(conn) == len(connection.MIGRATIONS)
+
+
+def test_migration_is_rolled_back_when_commit_fails():
+    migrations = [
+        [
+            "CREATE TABLE parent (id INTEGER PRIMARY KEY)",
+            "CREATE TABLE child (parent_id INTEGER REFERENCES parent (id) "
+            "DEFERRABLE INITIALLY DEFERRED)",
+            "INSERT INTO child (parent_id) VALUES (1)",
+        ],
+    ]
+    conn = sqlite3.connect(settings.DB_PATH, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+
+    with patch("bennettbot.connection.MIGRATIONS", migrations):
+        with pytest.raises(sqlite3.IntegrityError):
+            connection.migrate(conn)
+
+    assert not conn.in_transaction
+    assert list(conn.execute("PRAGMA user_version"))[0]["user_version"] == 0
+    assert list(conn.execute("SELECT name FROM sqlite_master")) == []
+    conn.close()
+
+
+def test_migration_already_rolled_back_by_error():
+    migrations = [
+        [
+            "CREATE TABLE good (id INTEGER PRIMARY KEY)",
+            "CREATE TRIGGER good_insert BEFORE INSERT ON good "
+            "BEGIN SELECT RAISE(ROLLBACK, 'no rows'); END",
+            "INSERT INTO good (id) VALUES (1)",
+        ],
+    ]
+    with patch("bennettbot.connection.MIGRATIONS", migrations):
+        with pytest.raises(sqlite3.IntegrityError, match="no rows"):
+            connection.get_connection()
+
+    conn = sqlite3.connect(settings.DB_PATH)
+    assert list(conn.execute("PRAGMA user_version")) == [(0,)]
+    assert list(conn.execute("SELECT name FROM sqlite_master")) == []
+    conn.close()
+
+
+def test_failed_migration_is_rolled_back():
+    migrations = [
+        ["CREATE TABLE good (id INTEGER PRIMARY KEY)"],
+        ["CREATE TABLE bad (id INTEGER PRIMARY KEY"],
+    ]
+    with patch("bennettbot.connection.MIGRATIONS", migrations):
+        with pytest.raises(sqlite3.OperationalError):
+            connection.get_connection()
+
+    conn = sqlite3.connect(settings.DB_PATH)
+    assert list(conn.execute("PRAGMA user_version")) == [(0,)]
+    assert list(conn.execute("SELECT name FROM sqlite_master")) == []
+    conn.close()
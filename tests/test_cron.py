@@ -0,0 +1,66 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from bennettbot import cron
+
+
+def dt(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def test_parse():
+    assert cron.parse("*/15 9-17/4 1,15 * 7") == [
+        {0, 15, 30, 45},
+        {9, 13, 17},
+        {1, 15},
+        set(range(1, 13)),
+        {0},
+    ]
+
+
+def test_parse_with_step_from_number():
+    assert cron.parse("50/5 0 1 1 0")[0] == {50, 55}
+
+
+@pytest.mark.parametrize(
+    "expression",
+    ["* * * *", "60 * * * *", "* * 0 * *", "5-1 * * * *", "*/0 * * * *", "a * * * *"],
+)
+def test_parse_with_invalid_expression(expression):
+    with pytest.raises(ValueError):
+        cron.parse(expression)
+
+
+@pytest.mark.parametrize(
+    "expression,after,expected",
+    [
+        # every minute: strictly after, with seconds ignored
+        ("* * * * *", dt(2024, 10, 7, 9, 0, 30), dt(2024, 10, 7, 9, 1)),
+        ("* * * * *", dt(2024, 10, 7, 9, 0), dt(2024, 10, 7, 9, 1)),
+        # later the same day
+        ("30 9 * * *", dt(2024, 10, 7, 9, 0), dt(2024, 10, 7, 9, 30)),
+        # the next day
+        ("0 9 * * *", dt(2024, 10, 7, 9, 0), dt(2024, 10, 8, 9, 0)),
+        # weekdays only, from a Saturday
+        ("0 9 * * 1-5", dt(2024, 10, 5, 12, 0), dt(2024, 10, 7, 9, 0)),
+        # the next month, and the next year
+        ("0 0 1 * *", dt(2024, 10, 7), dt(2024, 11, 1)),
+        ("0 0 1 1 *", dt(2024, 10, 7), dt(2025, 1, 1)),
+        # either day of month or day of week matches when both are restricted
+        ("0 0 15 * 5", dt(2024, 10, 7), dt(2024, 10, 11)),
+        ("0 0 8 * 5", dt(2024, 10, 7), dt(2024, 10, 8)),
+        # but fields that start with * are unrestricted, even with a step
+        ("0 0 */2 * 5", dt(2024, 10, 7), dt(2024, 10, 11)),
+        ("0 0 15 * */1", dt(2024, 10, 7), dt(2024, 10, 15)),
+        # the next leap day
+        ("0 0 29 2 *", dt(2024, 3, 1), dt(2028, 2, 29)),
+    ],
+)
+def test_next_after(expression, after, expected):
+    assert cron.next_after(expression, after) == expected
+
+
+def test_next_after_with_expression_that_never_matches():
+    with pytest.raises(ValueError, match="never matches"):
+        cron.next_after("0 0 31 2 *", dt(2024, 10, 7))
@@ -1,7 +1,12 @@
+import asyncio
 import json
 import os
 import platform
 import shutil
+import signal
+import sqlite3
+import time
+from datetime import timedelta
 from pathlib import Path
 from unittest.mock import Mock, patch
 
@@ -9,8 +14,17 @@ import pytest
 from mocket import Mocket, Mocketizer
 from mocket.mockhttp import Entry
 
-from bennettbot import scheduler, settings
-from bennettbot.dispatcher import JobDispatcher, MessageChecker, run_once
+from bennettbot import connection, scheduler, settings, workers
+from bennettbot.dispatcher import (
+    Dispatcher,
+    JobDispatcher,
+    JobTimers,
+    MessageChecker,
+    OutputTail,
+    fail_unstarted_job,
+    get_sleep_seconds,
+    run_once,
+)
 from bennettbot.slack import slack_web_client
 
 from .assertions import assert_call_counts, assert_slack_client_sends_messages
@@ -23,8 +37,9 @@ from .mock_http_request import (
 from .time_helpers import T0, TS, T
 
 
-# Make sure all tests run when datetime.now() returning T0
-pytestmark = pytest.mark.freeze_time(T0)
+# Make sure all tests run when datetime.now() returning T0, while letting asyncio see
+# the real time, so that its sleeps and timeouts work
+pytestmark = pytest.mark.freeze_time(T0, real_asyncio=True)
 
 
 @pytest.fixture(autouse=True)
@@ -48,14 +63,173 @@ def test_run_once():
     scheduler.schedule_job("test_bad_job", {}, "channel", TS, 0)
     scheduler.schedule_job("test_really_bad_job", {}, "channel", TS, 0)
 
-    processes = run_once(slack_web_client(), config)
-
-    for p in processes:
-        p.join()
+    run_once_and_wait(slack_web_client())
 
     assert os.path.exists(build_log_dir("test_good_job"))
     assert os.path.exists(build_log_dir("test_bad_job"))
     assert not os.path.exists(build_log_dir("test_really_bad_job"))
+    assert scheduler.get_metrics()["dispatcher_tick_seconds_count"] == 1
+
+
+def test_run_once_fails_jobs_with_expired_leases(freezer):
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    scheduler.reserve_job()
+    freezer.move_to(T(61))
+
+    job_dispatchers = run_once_and_wait(slack_web_client())
+
+    assert job_dispatchers == []
+    assert not scheduler.get_jobs()
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "stopped responding"},
+            {"channel": "channel", "text": "stopped responding", "thread_ts": TS},
+            {
+                "channel": settings.SLACK_TECH_SUPPORT_CHANNEL,
+                "text": "stopped responding",
+            },
+        ],
+    )
+
+
+def test_run_once_does_not_fail_jobs_it_is_running(freezer):
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    freezer.move_to(T(61))
+
+    job_dispatchers = asyncio.run(run_once(slack_web_client(), config, [job_id]))
+
+    assert job_dispatchers == []
+    assert [job["id"] for job in scheduler.get_jobs()] == [job_id]
+    assert get_mock_received_requests() == {}
+
+
+def test_run_once_fails_jobs_that_cannot_be_started():
+    # The job's type isn't in the config, so it can't be started, but the job that
+    # was reserved with it still runs
+    scheduler.schedule_job("test_removed_job", {}, "channel", TS, 0)
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+
+    job_dispatchers = run_once_and_wait(slack_web_client())
+
+    assert [jd.job["type"] for jd in job_dispatchers] == ["test_good_job"]
+    assert not scheduler.get_jobs()
+    job_runs = connection.get_connection().execute(
+        "SELECT type, rc FROM job_run ORDER BY type"
+    )
+    assert [(job_run["type"], job_run["rc"]) for job_run in job_runs] == [
+        ("test_good_job", 0),
+        ("test_removed_job", scheduler.NOT_STARTED_RC),
+    ]
+    messages = get_mock_received_requests()["/api/chat.postMessage"]
+    assert [
+        (message["channel"], message.get("thread_ts"))
+        for message in messages
+        if "could not be started" in message["text"]
+    ] == [("logs", None), ("channel", TS), (settings.SLACK_TECH_SUPPORT_CHANNEL, None)]
+
+
+def test_run_once_when_job_that_cannot_be_started_cannot_be_recorded():
+    scheduler.schedule_job("test_removed_job", {}, "channel", TS, 0)
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+
+    with patch(
+        "bennettbot.dispatcher.fail_unstarted_job",
+        side_effect=sqlite3.OperationalError("database is locked"),
+    ):
+        job_dispatchers = run_once_and_wait(slack_web_client())
+
+    # The job is left to be abandoned once its lease expires
+    assert [jd.job["type"] for jd in job_dispatchers] == ["test_good_job"]
+    assert [job["type"] for job in scheduler.get_jobs()] == ["test_removed_job"]
+
+
+def test_fail_unstarted_job_when_job_has_been_removed():
+    fail_unstarted_job(slack_web_client(), 123)
+
+    assert not connection.get_connection().execute("SELECT * FROM job_run").fetchall()
+    assert get_mock_received_requests() == {}
+
+
+def test_run_once_with_memory_storage_does_not_touch_database():
+    with patch("bennettbot.settings.SCHEDULER_STORAGE", "memory"):
+        scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+        run_once_and_wait(slack_web_client())
+        get_sleep_seconds(synced_timers())
+
+        assert not scheduler.get_jobs()
+        assert len(scheduler.get_job_run_stats()) == 1
+    assert not os.path.exists(settings.DB_PATH)
+
+
+def test_get_sleep_seconds_with_nothing_scheduled():
+    assert get_sleep_seconds(synced_timers()) == settings.DISPATCHER_MAX_SLEEP_SECONDS
+
+
+def test_get_sleep_seconds_with_job_scheduled():
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 5)
+    assert get_sleep_seconds(synced_timers()) == 5
+
+
+def test_get_sleep_seconds_with_job_scheduled_far_in_future():
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 3600)
+    assert get_sleep_seconds(synced_timers()) == settings.DISPATCHER_MAX_SLEEP_SECONDS
+
+
+def test_get_sleep_seconds_with_suppression():
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 10)
+    scheduler.schedule_suppression("test_good_job", T(-5), T(5))
+    assert get_sleep_seconds(synced_timers()) == 5
+
+
+def test_get_sleep_seconds_uses_timers_not_database():
+    timers = synced_timers()
+    # The dispatcher wasn't told about this job, so it doesn't wake for it
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 5)
+    assert get_sleep_seconds(timers) == settings.DISPATCHER_MAX_SLEEP_SECONDS
+
+    timers.add([T0 + timedelta(seconds=5)])
+    assert get_sleep_seconds(timers) == 5
+
+
+def test_get_sleep_seconds_when_wakeup_has_passed(freezer):
+    scheduler.schedule_suppression("test_good_job", T(-15), T(5))
+    freezer.move_to(T(4))
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    # The suppression ends at T(5), but the clock has moved on by the time we
+    # calculate how long to sleep
+    with patch("bennettbot.dispatcher.datetime") as mock_datetime:
+        mock_datetime.now.return_value = T0 + timedelta(seconds=10)
+        assert get_sleep_seconds(synced_timers()) == 0
+
+
+def test_job_timers(freezer):
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 20)
+    scheduler.schedule_job("test_bad_job", {}, "channel", TS, 10)
+    timers = synced_timers()
+    timers.add([T0 + timedelta(seconds=15), T0 + timedelta(seconds=5)])
+
+    assert timers.next_after(T0) == T0 + timedelta(seconds=5)
+    # Times that have passed are discarded
+    assert timers.next_after(T0 + timedelta(seconds=10)) == T0 + timedelta(seconds=15)
+    assert timers.heap[0] == T0 + timedelta(seconds=15)
+    assert timers.next_after(T0 + timedelta(seconds=20)) is None
+
+
+def test_job_timers_sync_if_stale():
+    timers = JobTimers()
+    with patch("bennettbot.dispatcher.time.monotonic") as monotonic:
+        monotonic.return_value = 1000
+        timers.sync_if_stale()
+        scheduler.schedule_job("test_good_job", {}, "channel", TS, 5)
+
+        monotonic.return_value = 1000 + settings.DISPATCHER_MAX_SLEEP_SECONDS - 1
+        timers.sync_if_stale()
+        assert timers.heap == []
+
+        monotonic.return_value = 1000 + settings.DISPATCHER_MAX_SLEEP_SECONDS
+        timers.sync_if_stale()
+        assert timers.heap == [T0 + timedelta(seconds=5)]
 
 
 def test_job_success_with_unsafe_shell_args():
@@ -101,6 +275,10 @@ def test_job_success():
     with open(os.path.join(log_dir, "stderr")) as f:
         assert f.read() == ""
 
+    assert scheduler.get_job_run_stats() == [
+        {"type": "test_good_job", "runs": 1, "failure_rate": 0, "p50": 0, "p95": 0}
+    ]
+
 
 def test_job_success_with_parameterised_args():
     log_dir = build_log_dir("test_parameterised_job")
@@ -144,6 +322,51 @@ def test_job_success_and_report():
         assert f.read() == ""
 
 
+def test_job_success_with_cached_result(freezer):
+    scheduler.schedule_job("test_cached_job", {}, "channel", TS, 0)
+    do_job(slack_web_client(), scheduler.reserve_job())
+
+    freezer.tick(timedelta(seconds=30))
+    scheduler.schedule_job("test_cached_job", {}, "channel1", TS, 0)
+    job_dispatcher = JobDispatcher(slack_web_client(), scheduler.reserve_job(), config)
+    asyncio.run(job_dispatcher.run())
+
+    # The second job is reported from the cache, without being run
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "the owl"},
+            {"channel": "logs", "text": "reported from cache"},
+            {"channel": "channel1", "text": "the owl"},
+        ],
+    )
+    assert not scheduler.get_jobs()
+    assert len(scheduler.get_job_run_stats()) == 1
+    metrics = scheduler.get_metrics()
+    assert metrics["jobs_started_total"] == metrics["jobs_finished_total"] == 2
+
+
+@pytest.mark.parametrize("fresh,ticks", [(True, 30), (False, 61)])
+def test_job_success_with_cached_result_not_used(freezer, fresh, ticks):
+    scheduler.schedule_job("test_cached_job", {}, "channel", TS, 0)
+    do_job(slack_web_client(), scheduler.reserve_job())
+
+    freezer.tick(timedelta(seconds=ticks))
+    scheduler.schedule_job("test_cached_job", {}, "channel1", TS, 0, fresh=fresh)
+    job_dispatcher = JobDispatcher(slack_web_client(), scheduler.reserve_job(), config)
+
+    assert job_dispatcher.get_cached_result() is None
+
+
+def test_job_failure_is_not_cached():
+    scheduler.schedule_job("test_cached_job", {}, "channel", TS, 0)
+    job_dispatcher = JobDispatcher(slack_web_client(), scheduler.reserve_job(), config)
+    job_dispatcher.run_args = "cat no-poem"
+    asyncio.run(job_dispatcher.run())
+
+    assert scheduler.get_cached_result("test_cached_job", {}, 60) is None
+
+
 def test_job_success_with_no_report():
     log_dir = build_log_dir("test_unreported_job")
 
@@ -218,6 +441,124 @@ def test_job_failure():
     with open(os.path.join(log_dir, "stderr")) as f:
         assert f.read() == "cat: no-poem: No such file or directory\n"
 
+    [stats] = scheduler.get_job_run_stats()
+    assert stats["failure_rate"] == 1
+
+
+def test_job_failure_with_retries(freezer):
+    scheduler.schedule_job("test_retried_bad_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    do_job(slack_web_client(), job_id)
+    assert scheduler.get_job(job_id)["start_after"] == T(10)
+
+    # The wait before each retry doubles
+    freezer.move_to(T(10))
+    assert scheduler.reserve_job() == job_id
+    do_job(slack_web_client(), job_id)
+    assert scheduler.get_job(job_id)["start_after"] == T(30)
+
+    freezer.move_to(T(30))
+    assert scheduler.reserve_job() == job_id
+    do_job(slack_web_client(), job_id)
+
+    # Tech-support is only called after the final attempt
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {
+                "channel": "channel",
+                "text": "will be attempted again in 10 seconds (attempt 1 of 3)",
+            },
+            {"channel": "logs", "text": "about to start"},
+            {
+                "channel": "channel",
+                "text": "will be attempted again in 20 seconds (attempt 2 of 3)",
+            },
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "failed.\nFind logs"},
+            {
+                "channel": settings.SLACK_TECH_SUPPORT_CHANNEL,
+                "text": "http://example.com",
+            },
+        ],
+    )
+    assert not scheduler.get_jobs()
+    assert scheduler.get_metrics()["jobs_retried_total"] == 2
+    [stats] = scheduler.get_job_run_stats()
+    assert stats["runs"] == 3
+
+
+def test_job_timeout_kills_process_group(tmp_path):
+    pid_path = tmp_path / "pid"
+    scheduler.schedule_job(
+        "test_timed_out_job", {"pid_path": str(pid_path)}, "channel", TS, 0
+    )
+    job_id = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job_id)
+
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "timed out after 0.2 seconds.\nFind logs"},
+            {
+                "channel": settings.SLACK_TECH_SUPPORT_CHANNEL,
+                "text": "http://example.com",
+            },
+        ],
+    )
+    assert not is_running(int(pid_path.read_text()))
+    [job_run] = connection.get_connection().execute("SELECT * FROM job_run")
+    assert job_run["rc"] == scheduler.TIMED_OUT_RC
+
+
+@patch("bennettbot.dispatcher.KILL_GRACE_SECONDS", 0.1)
+def test_job_timeout_kills_process_group_ignoring_sigterm():
+    scheduler.schedule_job("test_stubborn_timed_out_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+
+    start = time.monotonic()
+    do_job(slack_web_client(), job_id)
+
+    assert time.monotonic() - start < 5
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "timed out after 0.2 seconds"},
+            {
+                "channel": settings.SLACK_TECH_SUPPORT_CHANNEL,
+                "text": "http://example.com",
+            },
+        ],
+    )
+
+
+def is_running(pid):
+    """Return whether process with given pid is running (and isn't a zombie)."""
+
+    stat_path = Path(f"/proc/{pid}/stat")
+    return stat_path.exists() and stat_path.read_text().split()[2] != "Z"
+
+
+def test_job_does_not_wait_for_background_processes(tmp_path):
+    pid_path = tmp_path / "pid"
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    job_dispatcher = JobDispatcher(slack_web_client(), scheduler.reserve_job(), config)
+    # The background process inherits the command's stdout
+    job_dispatcher.run_args = f"sleep 5 & echo $! > {pid_path}; echo hi"
+
+    async def run():
+        # The loop's clock isn't frozen
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await job_dispatcher.run()
+        return loop.time() - start
+
+    assert asyncio.run(run()) < 2
+    os.kill(int(pid_path.read_text()), signal.SIGKILL)
+    with open(job_dispatcher.stdout_path) as f:
+        assert f.read() == "hi\n"
+
 
 def test_job_failure_in_dm():
     log_dir = build_log_dir("test_bad_job")
@@ -240,6 +581,47 @@ def test_job_failure_in_dm():
         assert f.read() == "cat: no-poem: No such file or directory\n"
 
 
+def test_job_success_with_multiple_recipients():
+    for channel in ["channel", "channel1"]:
+        scheduler.schedule_job("test_good_job", {}, channel, TS, 0, coalesce="dedupe")
+    job = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job)
+
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "succeeded"},
+            {"channel": "channel1", "text": "succeeded"},
+        ],
+    )
+
+
+def test_job_failure_with_multiple_recipients():
+    scheduler.schedule_job(
+        "test_bad_job", {}, "IM0001", TS, 0, is_im=True, coalesce="dedupe"
+    )
+    for channel in ["channel", "channel1"]:
+        scheduler.schedule_job("test_bad_job", {}, channel, TS, 0, coalesce="dedupe")
+    job = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job)
+
+    # Reposted to tech support only once, and never from a DM with the bot
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "IM0001", "text": "failed"},
+            {"channel": "channel", "text": "Calling tech-support"},
+            {
+                "channel": settings.SLACK_TECH_SUPPORT_CHANNEL,
+                "text": "http://example.com",
+            },
+            {"channel": "channel1", "text": "failed"},
+        ],
+    )
+
+
 def test_job_failure_when_command_not_found():
     log_dir = build_log_dir("test_really_bad_job")
 
@@ -290,6 +672,76 @@ def test_job_failure_with_host_log_dirs_setting():
         assert f.read() == "cat: no-poem: No such file or directory\n"
 
 
+@pytest.fixture
+def run_entrypoints_in_process():
+    # Mocket can't intercept the Unix socket that the worker pool starts its
+    # processes through, so entrypoints are called in this process instead.  The
+    # pool itself is tested in test_workers.
+    async def run_in_process(*args):
+        return workers.run_entrypoint(*args)
+
+    with patch("bennettbot.workers.run_in_worker", run_in_process):
+        yield
+
+
+def test_entrypoint_job_success(run_entrypoints_in_process):
+    log_dir = build_log_dir("test_good_entrypoint_job")
+
+    scheduler.schedule_job("test_good_entrypoint_job", {}, "channel", TS, 0)
+    job = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job)
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "Hello World!\n"},
+        ],
+    )
+
+    with open(os.path.join(log_dir, "stdout")) as f:
+        assert f.read() == "Hello World!\n"
+
+    with open(os.path.join(log_dir, "stderr")) as f:
+        assert f.read() == ""
+
+
+def test_entrypoint_job_success_with_parameterised_args(run_entrypoints_in_process):
+    scheduler.schedule_job(
+        "test_parameterised_entrypoint_job", {"name": "Fred"}, "channel", TS, 0
+    )
+    job = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job)
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "Hello Fred!\n"},
+        ],
+    )
+
+
+def test_entrypoint_job_failure(run_entrypoints_in_process):
+    log_dir = build_log_dir("test_bad_entrypoint_job")
+
+    scheduler.schedule_job("test_bad_entrypoint_job", {}, "channel", TS, 0)
+    job = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job)
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "failed"},
+            {
+                "channel": settings.SLACK_TECH_SUPPORT_CHANNEL,
+                "text": "http://example.com",
+            },
+        ],
+    )
+
+    with open(os.path.join(log_dir, "stderr")) as f:
+        assert f.read().endswith("Exception: An error was found!\n")
+
+
 def test_python_job_success():
     log_dir = build_log_dir("test_good_python_job")
 
@@ -518,9 +970,385 @@ def test_job_with_long_code_output_is_uploaded_as_file():
     )
 
 
+@patch("bennettbot.settings.JOB_LEASE_SECONDS", 0.03)
+def test_heartbeat_renews_lease():
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    job_dispatcher = JobDispatcher(slack_web_client(), job_id, config)
+
+    async def beat():
+        async with job_dispatcher.heartbeat():
+            await asyncio.sleep(0.1)
+        calls = renew_job_lease.call_count
+        await asyncio.sleep(0.05)
+        return calls
+
+    with patch("bennettbot.dispatcher.scheduler.renew_job_lease") as renew_job_lease:
+        calls = asyncio.run(beat())
+
+    assert calls >= 1
+    # The lease is no longer renewed once the block exits
+    assert renew_job_lease.call_count == calls
+    renew_job_lease.assert_called_with(job_id)
+
+
+@patch("bennettbot.settings.JOB_LEASE_SECONDS", 0.03)
+def test_heartbeat_keeps_renewing_lease_after_error():
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    job_dispatcher = JobDispatcher(slack_web_client(), job_id, config)
+
+    async def beat():
+        async with job_dispatcher.heartbeat():
+            await asyncio.sleep(0.1)
+
+    renewed_ids = []
+
+    def renew_job_lease(job_id):
+        if not renewed_ids:
+            renewed_ids.append(None)
+            raise sqlite3.OperationalError("database is locked")
+        renewed_ids.append(job_id)
+
+    with patch("bennettbot.dispatcher.scheduler.renew_job_lease", renew_job_lease):
+        asyncio.run(beat())
+
+    # The lease was renewed after the first attempt failed
+    assert renewed_ids[:2] == [None, job_id]
+
+
+@patch("bennettbot.settings.STREAM_OUTPUT_INTERVAL_SECONDS", 0.1)
+@patch("bennettbot.settings.STREAM_OUTPUT_MAX_LINES", 2)
+def test_job_with_streamed_output():
+    scheduler.schedule_job("test_streamed_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job_id)
+
+    # The output is posted once, and then updated as it changes
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {
+                "channel": "channel",
+                "thread_ts": TS,
+                "text": "Output of `test_streamed_job` so far:\n```one```",
+            },
+            {"channel": "channel", "text": "succeeded"},
+        ],
+    )
+    updates = get_mock_received_requests()["/api/chat.update"]
+    assert 1 <= len(updates) <= 3
+    assert updates[-1] == {
+        "channel": "channel",
+        "ts": TS,
+        "text": "Output of `test_streamed_job` so far:\n```two\nthree```",
+    }
+
+
+@patch("bennettbot.settings.STREAM_OUTPUT_INTERVAL_SECONDS", 0.01)
+def test_streaming_output_with_no_output():
+    scheduler.schedule_job("test_streamed_job", {}, "channel", TS, 0)
+    job_dispatcher = JobDispatcher(slack_web_client(), scheduler.reserve_job(), config)
+    job_dispatcher.set_up_log_dir()
+
+    async def stream():
+        async with job_dispatcher.streaming_output():
+            await asyncio.sleep(0.05)
+
+    asyncio.run(stream())
+    assert get_mock_received_requests() == {}
+
+
+@patch("bennettbot.settings.STREAM_OUTPUT_INTERVAL_SECONDS", 0.01)
+def test_streaming_output_when_message_cannot_be_posted():
+    scheduler.schedule_job("test_streamed_job", {}, "channel", TS, 0)
+    job_dispatcher = JobDispatcher(slack_web_client(), scheduler.reserve_job(), config)
+    job_dispatcher.set_up_log_dir()
+
+    async def stream():
+        async with job_dispatcher.streaming_output():
+            for line in ["one", "two", "three"]:
+                with open(job_dispatcher.stdout_path, "a") as f:
+                    f.write(f"{line}\n")
+                await asyncio.sleep(0.03)
+
+    with patch("bennettbot.dispatcher.notify_slack", return_value=None) as notify:
+        asyncio.run(stream())
+
+    # notify_slack reports the failure, so posting isn't attempted again
+    notify.assert_called_once()
+    assert get_mock_received_requests() == {}
+
+
+def test_output_tail(tmp_path):
+    path = tmp_path / "stdout"
+    tail = OutputTail(path, max_lines=2)
+
+    # A job with a python_entrypoint may not have created its stdout file yet
+    assert not tail.read()
+    assert tail.text() == ""
+
+    path.write_bytes(b"one\ntw")
+    assert tail.read()
+    assert tail.text() == "one\ntw"
+    assert not tail.read()
+
+    # A character that is split across reads is decoded once it is complete
+    with open(path, "ab") as f:
+        f.write(b"o\nthree \xe2\x9c")
+    assert tail.read()
+    assert tail.text() == "one\ntwo\nthree "
+    with open(path, "ab") as f:
+        f.write(b"\x93\nfour\n")
+    assert tail.read()
+    assert tail.text() == "three \u2713\nfour"
+
+
+class StubListener:
+    """Stands in for wakeup.Listener, whose socket can't be used while Mocket is
+    enabled, waking every few milliseconds."""
+
+    async def wait(self, timeout):
+        await asyncio.sleep(min(timeout, 0.01))
+
+
+def test_dispatcher_waits_for_running_jobs_when_stopped():
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    dispatcher = Dispatcher(slack_web_client(), config, StubListener())
+
+    async def run():
+        # Stop as soon as the job has been started
+        asyncio.get_running_loop().call_soon(dispatcher.stop)
+        await dispatcher.run()
+
+    asyncio.run(run())
+
+    assert dispatcher.stopping
+    assert not dispatcher.running_jobs
+    assert not scheduler.get_jobs()
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "succeeded"},
+        ],
+    )
+
+
+@patch("bennettbot.dispatcher.TICK_ERROR_SLEEP_SECONDS", 0.01)
+def test_dispatcher_keeps_running_after_error():
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    dispatcher = Dispatcher(slack_web_client(), config, StubListener())
+    calls = 0
+
+    async def run_once_after_error(*args):
+        # Fail the first time, and stop once the job has been started
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise sqlite3.OperationalError("database is locked")
+        job_dispatchers = await run_once(*args)
+        dispatcher.stop()
+        return job_dispatchers
+
+    async def run():
+        with patch("bennettbot.dispatcher.run_once", run_once_after_error):
+            await dispatcher.run()
+
+    asyncio.run(run())
+
+    assert not scheduler.get_jobs()
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "succeeded"},
+        ],
+    )
+
+
+def test_dispatcher_stops_on_sigterm():
+    dispatcher = Dispatcher(slack_web_client(), config, StubListener())
+    checker = MessageChecker(slack_web_client("bot"), slack_web_client("user"))
+
+    async def run():
+        asyncio.get_running_loop().call_later(
+            0.05, os.kill, os.getpid(), signal.SIGTERM
+        )
+        with patch.object(checker, "do_check", lambda: asyncio.sleep(3600)):
+            await dispatcher.run(checker)
+
+    asyncio.run(run())
+
+    assert dispatcher.stopping
+
+
+def test_dispatcher_kills_job(tmp_path):
+    pid_path = tmp_path / "pid"
+    scheduler.schedule_job(
+        "test_killable_job", {"pid_path": str(pid_path)}, "channel", TS, 0
+    )
+    dispatcher = Dispatcher(slack_web_client(), config, StubListener())
+
+    async def run():
+        task = asyncio.create_task(dispatcher.run())
+        # Wait until the job's pid has been recorded and its subprocess has started
+        while not (
+            scheduler.get_jobs()[0]["pid"]
+            and pid_path.exists()
+            and pid_path.read_text()
+        ):
+            await asyncio.sleep(0.01)
+        [job] = scheduler.get_jobs()
+        assert job["pid"] == dispatcher.running_jobs[job["id"]].process.pid
+        scheduler.request_job_kill(job["id"], "channel", TS)
+        while scheduler.get_jobs():
+            await asyncio.sleep(0.01)
+        dispatcher.stop()
+        await task
+
+    asyncio.run(run())
+
+    # The job isn't retried, and tech-support isn't called
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "was killed.\nFind logs"},
+        ],
+    )
+    assert not is_running(int(pid_path.read_text()))
+    [job_run] = connection.get_connection().execute("SELECT * FROM job_run")
+    assert job_run["rc"] == scheduler.KILLED_RC
+
+
+def test_dispatcher_keeps_retried_job_started_before_last_attempt_finished():
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    dispatcher = Dispatcher(slack_web_client(), config, StubListener())
+
+    async def run():
+        first_attempt = JobDispatcher(slack_web_client(), job_id, config)
+        first_attempt.task = asyncio.create_task(asyncio.sleep(0.01))
+        dispatcher.add_running_job(first_attempt)
+        second_attempt = JobDispatcher(slack_web_client(), job_id, config)
+        second_attempt.task = asyncio.create_task(asyncio.sleep(0.05))
+        dispatcher.add_running_job(second_attempt)
+
+        await first_attempt.task
+        await asyncio.sleep(0)
+        assert dispatcher.running_jobs == {job_id: second_attempt}
+        await second_attempt.task
+        await asyncio.sleep(0)
+        assert dispatcher.running_jobs == {}
+
+    asyncio.run(run())
+
+
+def test_dispatcher_ignores_kills_of_jobs_it_is_not_running():
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    scheduler.request_job_kill(job_id, "channel", TS)
+    dispatcher = Dispatcher(slack_web_client(), config, StubListener())
+
+    asyncio.run(dispatcher.kill_requested_jobs())
+
+    assert scheduler.get_jobs_to_kill() == [job_id]
+
+
+def test_dispatcher_cancels_kills_of_entrypoint_jobs():
+    scheduler.schedule_job("test_good_entrypoint_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    scheduler.request_job_kill(job_id, "channel1", "1234.5678")
+    dispatcher = Dispatcher(slack_web_client(), config, StubListener())
+
+    async def run():
+        job_dispatcher = JobDispatcher(slack_web_client(), job_id, config)
+        job_dispatcher.task = asyncio.create_task(asyncio.sleep(0))
+        dispatcher.add_running_job(job_dispatcher)
+        await dispatcher.kill_requested_jobs()
+        await job_dispatcher.task
+        return job_dispatcher
+
+    job_dispatcher = asyncio.run(run())
+
+    assert not job_dispatcher.killed
+    # The kill isn't handled again
+    assert scheduler.get_jobs_to_kill() == []
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {
+                "channel": "channel1",
+                "text": "shared with other jobs, so it can't be killed",
+                "thread_ts": "1234.5678",
+            },
+        ],
+    )
+
+
+def test_cancel_kill_of_job_that_has_finished():
+    scheduler.schedule_job("test_good_entrypoint_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    job_dispatcher = JobDispatcher(slack_web_client(), job_id, config)
+    scheduler.request_job_kill(job_id, "channel1", None)
+    scheduler.mark_job_done(job_id)
+
+    job_dispatcher.cancel_kill()
+
+    assert get_mock_received_requests() == {}
+
+
+def test_job_killed_before_command_starts():
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    job_dispatcher = JobDispatcher(slack_web_client(), scheduler.reserve_job(), config)
+
+    job_dispatcher.kill()
+    asyncio.run(job_dispatcher.run())
+
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "was killed"},
+        ],
+    )
+    assert not scheduler.get_jobs()
+
+
+def test_job_killed_while_command_starts(tmp_path):
+    pid_path = tmp_path / "pid"
+    scheduler.schedule_job(
+        "test_killable_job", {"pid_path": str(pid_path)}, "channel", TS, 0
+    )
+    job_dispatcher = JobDispatcher(slack_web_client(), scheduler.reserve_job(), config)
+    job_dispatcher.set_up_log_dir()
+    # As if kill() was called while the subprocess was being created
+    job_dispatcher.killed = True
+
+    rc = asyncio.run(job_dispatcher.run_command())
+
+    assert rc == scheduler.KILLED_RC
+    assert job_dispatcher.kill_task.done()
+
+
+def synced_timers():
+    timers = JobTimers()
+    timers.sync()
+    return timers
+
+
+def run_once_and_wait(client):
+    """Call run_once, and wait for the jobs that it starts to finish, returning
+    their JobDispatchers."""
+
+    async def run():
+        job_dispatchers = await run_once(client, config)
+        await asyncio.gather(*(jd.task for jd in job_dispatchers))
+        return job_dispatchers
+
+    return asyncio.run(run())
+
+
 def do_job(client, job):
     job_dispatcher = JobDispatcher(client, job, config)
-    job_dispatcher.do_job()
+    asyncio.run(job_dispatcher.run())
 
 
 def build_log_dir(job_type_with_namespace):
@@ -543,7 +1371,7 @@ def test_message_checker_run(freezer):
 
     # Mock the run function so the checker runs twice, not forever
     run_fn = Mock(side_effect=[True, True, False])
-    checker.do_check(run_fn, delay=0.1)
+    asyncio.run(checker.do_check(run_fn, delay=0.1))
 
     # search.messages is called twice for each run of the checker
     # no matches, so no reactions or messages reposted.
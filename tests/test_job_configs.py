@@ -26,6 +26,7 @@ def test_build_config():
             ],
         },
         "ns2": {
+            "max_concurrent_jobs": 2,
             "jobs": {
                 "good_job": {"run_args_template": "cat {poem}", "report_stdout": True},
                 "bad_job": {"run_args_template": "dog {poem}", "report_success": False},
@@ -80,42 +81,105 @@ def test_build_config():
                 "report_stdout": False,
                 "report_format": "text",
                 "report_success": True,
+                "priority": 0,
+                "coalesce": "replace",
+                "cache_ttl": 0,
+                "retries": 0,
+                "backoff": 60,
+                "python_entrypoint": None,
+                "timeout_seconds": None,
+                "stream_output": False,
+                "schedules": [],
             },
             "ns1_bad_job": {
                 "run_args_template": "dog {poem}",
                 "report_stdout": False,
                 "report_format": "text",
                 "report_success": True,
+                "priority": 0,
+                "coalesce": "replace",
+                "cache_ttl": 0,
+                "retries": 0,
+                "backoff": 60,
+                "python_entrypoint": None,
+                "timeout_seconds": None,
+                "stream_output": False,
+                "schedules": [],
             },
             "ns2_good_job": {
                 "run_args_template": "cat {poem}",
                 "report_stdout": True,
                 "report_format": "text",
                 "report_success": True,
+                "priority": 0,
+                "coalesce": "replace",
+                "cache_ttl": 0,
+                "retries": 0,
+                "backoff": 60,
+                "python_entrypoint": None,
+                "timeout_seconds": None,
+                "stream_output": False,
+                "schedules": [],
             },
             "ns2_bad_job": {
                 "run_args_template": "dog {poem}",
                 "report_stdout": False,
                 "report_format": "text",
                 "report_success": False,
+                "priority": 0,
+                "coalesce": "replace",
+                "cache_ttl": 0,
+                "retries": 0,
+                "backoff": 60,
+                "python_entrypoint": None,
+                "timeout_seconds": None,
+                "stream_output": False,
+                "schedules": [],
             },
             "ns3_good_python_job": {
                 "run_args_template": "python jobs.py",
                 "report_stdout": True,
                 "report_format": "text",
                 "report_success": True,
+                "priority": 0,
+                "coalesce": "replace",
+                "cache_ttl": 0,
+                "retries": 0,
+                "backoff": 60,
+                "python_entrypoint": None,
+                "timeout_seconds": None,
+                "stream_output": False,
+                "schedules": [],
             },
             "ns3_bad_python_job": {
                 "run_args_template": "python jobs.py",
                 "report_stdout": True,
                 "report_format": "text",
                 "report_success": True,
+                "priority": 0,
+                "coalesce": "replace",
+                "cache_ttl": 0,
+                "retries": 0,
+                "backoff": 60,
+                "python_entrypoint": None,
+                "timeout_seconds": None,
+                "stream_output": False,
+                "schedules": [],
             },
             "test_good_job": {
                 "run_args_template": "echo Hello",
                 "report_stdout": False,
                 "report_format": "text",
                 "report_success": True,
+                "priority": 0,
+                "coalesce": "replace",
+                "cache_ttl": 0,
+                "retries": 0,
+                "backoff": 60,
+                "python_entrypoint": None,
+                "timeout_seconds": None,
+                "stream_output": False,
+                "schedules": [],
             },
         },
         "slack": [
@@ -178,6 +242,8 @@ def test_build_config():
             "ns3": "#tech",
             "test": "#tech",
         },
+        "max_concurrent_jobs": {"ns2": 2},
+        "schedules": [],
     }
 
 
@@ -305,6 +371,211 @@ def test_build_config_with_invalid_report_format():
     assert "invalid report_format" in str(e)
 
 
+@pytest.mark.parametrize("priority", ["high", True])
+def test_build_config_with_invalid_priority(priority):
+    # fmt: off
+    raw_config = {
+        "ns": {
+            "jobs": {
+                "good_job": {
+                    "run_args_template": "cat [poem]",
+                    "priority": priority
+                }
+            },
+            "slack": []
+        }
+    }
+    # fmt: on
+
+    with pytest.raises(RuntimeError, match="invalid priority"):
+        build_config(raw_config)
+
+
+def test_build_config_with_invalid_coalesce():
+    # fmt: off
+    raw_config = {
+        "ns": {
+            "jobs": {
+                "good_job": {
+                    "run_args_template": "cat [poem]",
+                    "coalesce": "merge"
+                }
+            },
+            "slack": []
+        }
+    }
+    # fmt: on
+
+    with pytest.raises(RuntimeError, match="invalid coalesce"):
+        build_config(raw_config)
+
+
+@pytest.mark.parametrize(
+    "job_config,error",
+    [
+        ({"report_stdout": True, "cache_ttl": "1h"}, "invalid cache_ttl"),
+        ({"report_stdout": True, "cache_ttl": -1}, "invalid cache_ttl"),
+        ({"report_stdout": True, "cache_ttl": True}, "invalid cache_ttl"),
+        ({"cache_ttl": 60}, "does not report stdout"),
+    ],
+)
+def test_build_config_with_invalid_cache_ttl(job_config, error):
+    raw_config = {
+        "ns": {
+            "jobs": {"good_job": {"run_args_template": "cat [poem]", **job_config}},
+            "slack": [],
+        }
+    }
+
+    with pytest.raises(RuntimeError, match=error):
+        build_config(raw_config)
+
+
+@pytest.mark.parametrize(
+    "job_config,error",
+    [
+        ({"retries": "3"}, "invalid retries"),
+        ({"retries": -1}, "invalid retries"),
+        ({"retries": True}, "invalid retries"),
+        ({"backoff": 1.5}, "invalid backoff"),
+        ({"backoff": -1}, "invalid backoff"),
+        ({"backoff": False}, "invalid backoff"),
+    ],
+)
+def test_build_config_with_invalid_retries(job_config, error):
+    raw_config = {
+        "ns": {
+            "jobs": {"good_job": {"run_args_template": "cat [poem]", **job_config}},
+            "slack": [],
+        }
+    }
+
+    with pytest.raises(RuntimeError, match=error):
+        build_config(raw_config)
+
+
+@pytest.mark.parametrize("timeout_seconds", [0, -1, "1h", True])
+def test_build_config_with_invalid_timeout_seconds(timeout_seconds):
+    raw_config = {
+        "ns": {
+            "jobs": {
+                "good_job": {
+                    "run_args_template": "cat [poem]",
+                    "timeout_seconds": timeout_seconds,
+                }
+            },
+            "slack": [],
+        }
+    }
+
+    with pytest.raises(RuntimeError, match="invalid timeout_seconds"):
+        build_config(raw_config)
+
+
+@pytest.mark.parametrize(
+    "python_entrypoint", ["workspace.test.jobs", "workspace/test/jobs.py:main", 1]
+)
+def test_build_config_with_invalid_python_entrypoint(python_entrypoint):
+    raw_config = {
+        "ns": {
+            "jobs": {
+                "good_job": {
+                    "run_args_template": "python jobs.py",
+                    "python_entrypoint": python_entrypoint,
+                }
+            },
+            "slack": [],
+        }
+    }
+
+    with pytest.raises(RuntimeError, match="invalid python_entrypoint"):
+        build_config(raw_config)
+
+
+def test_build_config_with_schedules():
+    raw_config = {
+        "ns": {
+            "jobs": {
+                "good_job": {
+                    "run_args_template": "cat {poem}",
+                    "priority": 5,
+                    "schedules": [
+                        {
+                            "cron": "0 9 * * 1-5",
+                            "channel": "#poetry",
+                            "args": {"poem": "jabberwocky"},
+                        },
+                        {
+                            "cron": "30 * * * *",
+                            "channel": "#poetry",
+                            "args": {"poem": "kubla-khan"},
+                            "catch_up": False,
+                        },
+                    ],
+                }
+            },
+            "slack": [],
+        }
+    }
+
+    config = build_config(raw_config)
+    assert config["schedules"] == [
+        {
+            "job_type": "ns_good_job",
+            "priority": 5,
+            "coalesce": "replace",
+            "cron": "0 9 * * 1-5",
+            "channel": "#poetry",
+            "args": {"poem": "jabberwocky"},
+            "catch_up": True,
+        },
+        {
+            "job_type": "ns_good_job",
+            "priority": 5,
+            "coalesce": "replace",
+            "cron": "30 * * * *",
+            "channel": "#poetry",
+            "args": {"poem": "kubla-khan"},
+            "catch_up": False,
+        },
+    ]
+
+
+@pytest.mark.parametrize(
+    "schedule,error",
+    [
+        ({"cron": "0 9 * * *", "args": {"poem": "x"}}, "missing keys"),
+        (
+            {"cron": "0 9 * * *", "channel": "#c", "args": {"poem": "x"}, "at": 1},
+            "extra keys",
+        ),
+        (
+            {"cron": "0 25 * * *", "channel": "#c", "args": {"poem": "x"}},
+            "invalid cron expression",
+        ),
+        (
+            {"cron": "0 9 * * *", "channel": "#c", "args": {"verse": "x"}},
+            "does not provide the arguments",
+        ),
+    ],
+)
+def test_build_config_with_bad_schedule(schedule, error):
+    raw_config = {
+        "ns": {
+            "jobs": {
+                "good_job": {
+                    "run_args_template": "cat {poem}",
+                    "schedules": [schedule],
+                }
+            },
+            "slack": [],
+        }
+    }
+
+    with pytest.raises(RuntimeError, match=error):
+        build_config(raw_config)
+
+
 def test_build_config_with_missing_param_in_slack_command():
     raw_config = {
         "workflows": {
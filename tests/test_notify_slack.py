@@ -4,7 +4,7 @@ import pytest
 from mocket import mocketize
 
 from bennettbot import settings
-from bennettbot.slack import notify_slack, slack_web_client
+from bennettbot.slack import notify_slack, slack_web_client, update_slack_message
 from workspace.utils.blocks import get_text_block
 
 from .mock_http_request import get_mock_received_requests, mocket_register
@@ -126,6 +126,25 @@ def test_notify_slack_retries_fallback_error():
     assert latest_requests[2]["text"] == "Could not notify slack"
 
 
+@mocketize(strict_mode=True)
+def test_update_slack_message():
+    mocket_register({"chat.update": [{"ok": True, "ts": 123.45, "channel": "C1"}]})
+
+    update_slack_message(slack_web_client(), "C1", "123.45", "my message")
+    assert get_mock_received_requests()["/api/chat.update"] == [
+        {"channel": "C1", "ts": "123.45", "text": "my message"}
+    ]
+
+
+@mocketize(strict_mode=True)
+def test_update_slack_message_error():
+    # Errors are only logged, and the update isn't retried
+    mocket_register({"chat.update": [{"ok": False, "error": "ratelimited"}]})
+
+    update_slack_message(slack_web_client(), "C1", "123.45", "my message")
+    assert len(get_mock_received_requests()["/api/chat.update"]) == 1
+
+
 @pytest.mark.parametrize(
     "token_type,token",
     [
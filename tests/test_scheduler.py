@@ -1,6 +1,10 @@
+import os
+from datetime import timedelta
+from unittest.mock import patch
+
 import pytest
 
-from bennettbot import scheduler
+from bennettbot import scheduler, settings, storage
 
 from .assertions import (
     assert_job_matches,
@@ -15,6 +19,13 @@ from .time_helpers import T0, TS, T
 pytestmark = pytest.mark.freeze_time(T0)
 
 
+# Jobs and suppressions behave the same whichever backend stores them
+@pytest.fixture(autouse=True, params=["sqlite", "memory"])
+def scheduler_storage(request):
+    with patch("bennettbot.settings.SCHEDULER_STORAGE", request.param):
+        yield
+
+
 def test_schedule_job_with_no_jobs_already_scheduled():
     assert_no_running_job(
         scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
@@ -102,6 +113,152 @@ def test_schedule_job_with_job_of_same_type_running_and_another_scheduled(freeze
     assert_job_matches(jj[1], "good_job", ["args2"], "channel2", T(20), None)
 
 
+def test_schedule_job_with_dedupe_and_identical_job_scheduled():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 10, coalesce="dedupe")
+    scheduler.schedule_job(
+        "good_job", {"k": "v"}, "channel1", "123", 20, is_im=True, coalesce="dedupe"
+    )
+
+    [job] = scheduler.get_jobs_of_type("good_job")
+    assert_job_matches(job, "good_job", {"k": "v"}, "channel", T(10), None)
+    assert scheduler.get_job_recipients(job["id"]) == [
+        {"channel": "channel", "thread_ts": TS, "is_im": 0},
+        {"channel": "channel1", "thread_ts": "123", "is_im": 1},
+    ]
+
+
+def test_schedule_job_with_dedupe_and_different_job_scheduled():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0, coalesce="dedupe")
+    scheduler.schedule_job("good_job", {"k": "w"}, "channel", TS, 0, coalesce="dedupe")
+
+    jj = scheduler.get_jobs_of_type("good_job")
+    assert [job["args"] for job in jj] == [{"k": "v"}, {"k": "w"}]
+    assert len(scheduler.get_job_recipients(jj[0]["id"])) == 1
+
+
+def test_schedule_job_with_dedupe_and_identical_job_running(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0, coalesce="dedupe")
+    scheduler.reserve_job()
+
+    assert_running_job(
+        scheduler.schedule_job(
+            "good_job", {"k": "v"}, "channel", TS, 0, coalesce="dedupe"
+        )
+    )
+    assert len(scheduler.get_jobs_of_type("good_job")) == 2
+
+
+def test_schedule_job_with_queue():
+    for _ in range(3):
+        scheduler.schedule_job(
+            "good_job", {"k": "v"}, "channel", TS, 0, coalesce="queue"
+        )
+
+    assert len(scheduler.get_jobs_of_type("good_job")) == 3
+
+
+def test_schedule_jobs(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.reserve_job()
+
+    with patch("bennettbot.scheduler.notify_dispatcher") as notify_dispatcher:
+        existing_jobs_running = scheduler.schedule_jobs(
+            [
+                {
+                    "type_": "good_job",
+                    "args": {"k": "w"},
+                    "channel": "channel",
+                    "thread_ts": TS,
+                    "delay_seconds": 0,
+                },
+                {
+                    "type_": "odd_job",
+                    "args": {"k": "v"},
+                    "channel": "channel",
+                    "thread_ts": TS,
+                    "delay_seconds": 10,
+                },
+                # Replaces the odd_job above
+                {
+                    "type_": "odd_job",
+                    "args": {"k": "w"},
+                    "channel": "channel1",
+                    "thread_ts": TS,
+                    "delay_seconds": 5,
+                    "priority": 1,
+                },
+                {
+                    "type_": "even_job",
+                    "args": {},
+                    "channel": "channel",
+                    "thread_ts": TS,
+                    "delay_seconds": 0,
+                    "coalesce": "queue",
+                },
+                {
+                    "type_": "even_job",
+                    "args": {},
+                    "channel": "channel",
+                    "thread_ts": TS,
+                    "delay_seconds": 0,
+                    "coalesce": "queue",
+                },
+            ]
+        )
+
+    assert existing_jobs_running == [True, False, False, False, False]
+    notify_dispatcher.assert_called_once_with(
+        [T0 + timedelta(seconds=delay) for delay in [0, 10, 5, 0, 0]]
+    )
+    jobs = scheduler.get_jobs()
+    assert [job["type"] for job in jobs] == [
+        "good_job",
+        "good_job",
+        "odd_job",
+        "even_job",
+        "even_job",
+    ]
+    assert_job_matches(jobs[2], "odd_job", {"k": "w"}, "channel1", T(5), None)
+    assert jobs[2]["priority"] == 1
+
+
+def test_schedule_jobs_schedules_nothing_if_a_job_is_invalid():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+
+    with pytest.raises(TypeError):
+        scheduler.schedule_jobs(
+            [
+                {
+                    "type_": "good_job",
+                    "args": {"k": "w"},
+                    "channel": "channel",
+                    "thread_ts": TS,
+                    "delay_seconds": 0,
+                },
+                {
+                    "type_": "odd_job",
+                    "args": {"k": object()},
+                    "channel": "channel",
+                    "thread_ts": TS,
+                    "delay_seconds": 0,
+                },
+            ]
+        )
+
+    [job] = scheduler.get_jobs()
+    assert job["args"] == {"k": "v"}
+
+
+def test_cancel_job_removes_recipients():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0, coalesce="dedupe")
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0, coalesce="dedupe")
+    scheduler.cancel_job("good_job")
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0, coalesce="dedupe")
+
+    [job] = scheduler.get_jobs()
+    assert len(scheduler.get_job_recipients(job["id"])) == 1
+
+
 def test_cancel_job_with_no_jobs_of_same_type_scheduled():
     scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 0)
 
@@ -181,6 +338,29 @@ def test_remove_expired_suppressions(freezer):
     assert_suppression_matches(ss[1], "good_job", T(20), T(30))
 
 
+def test_get_suppression_index(freezer):
+    scheduler.schedule_suppression("good_job", T(-5), T(5))
+    index = scheduler.get_suppression_index()
+
+    assert index.suppressed_types(T0) == {"good_job"}
+    # The index is only rebuilt when suppressions change
+    scheduler.remove_expired_suppressions()
+    assert scheduler.get_suppression_index() is index
+
+    scheduler.schedule_suppression("odd_job", T(-5), T(5))
+    assert scheduler.get_suppression_index().suppressed_types(T0) == {
+        "good_job",
+        "odd_job",
+    }
+
+    scheduler.cancel_suppressions("odd_job")
+    assert scheduler.get_suppression_index().suppressed_types(T0) == {"good_job"}
+
+    freezer.move_to(T(6))
+    scheduler.remove_expired_suppressions()
+    assert scheduler.get_suppression_index().suppressed_types(T(6)) == set()
+
+
 def test_reserve_job_with_no_jobs_scheduled():
     assert not scheduler.reserve_job()
 
@@ -264,6 +444,196 @@ def test_reserve_job_with_suppression_in_future(freezer):
     assert_job_matches(job, "good_job", {"k": "v"}, "channel", T(5), T(10))
 
 
+def test_reserve_jobs_with_no_jobs_scheduled():
+    assert scheduler.reserve_jobs() == []
+
+
+def test_reserve_jobs_reserves_all_available_jobs_in_order(freezer):
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 6)
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 5)
+    scheduler.schedule_job("even_job", {"k": "v"}, "channel", TS, 20)
+    freezer.move_to(T(10))
+
+    job_ids = scheduler.reserve_jobs()
+    jobs = [scheduler.get_job(job_id) for job_id in job_ids]
+    assert len(jobs) == 2
+    assert_job_matches(jobs[0], "good_job", {"k": "v"}, "channel", T(5), T(10))
+    assert_job_matches(jobs[1], "odd_job", {"k": "v"}, "channel", T(6), T(10))
+
+    assert scheduler.reserve_jobs() == []
+
+
+def test_reserve_jobs_with_limit(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 5)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 6)
+    freezer.move_to(T(10))
+
+    [job_id] = scheduler.reserve_jobs(limit=1)
+    assert scheduler.get_job(job_id)["type"] == "good_job"
+
+    [job_id] = scheduler.reserve_jobs(limit=1)
+    assert scheduler.get_job(job_id)["type"] == "odd_job"
+
+
+def test_reserve_jobs_reserves_one_job_per_type(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 5, coalesce="queue")
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0, coalesce="queue")
+    freezer.move_to(T(10))
+
+    [job_id] = scheduler.reserve_jobs()
+    assert_job_matches(
+        scheduler.get_job(job_id), "good_job", {}, "channel", T(0), T(10)
+    )
+    assert scheduler.reserve_jobs() == []
+
+
+def test_reserve_jobs_with_max_running(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 5)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 6)
+    scheduler.schedule_job("even_job", {"k": "v"}, "channel", TS, 7)
+    freezer.move_to(T(10))
+
+    job_ids = scheduler.reserve_jobs(max_running=2)
+    assert [scheduler.get_job(job_id)["type"] for job_id in job_ids] == [
+        "good_job",
+        "odd_job",
+    ]
+
+    # Two jobs are running, so no more can be reserved
+    assert scheduler.reserve_jobs(max_running=2) == []
+
+    scheduler.mark_job_done(job_ids[0])
+    [job_id] = scheduler.reserve_jobs(limit=5, max_running=2)
+    assert scheduler.get_job(job_id)["type"] == "even_job"
+
+
+def test_reserve_jobs_with_max_running_by_namespace(freezer):
+    scheduler.schedule_job("ns1_good_job", {"k": "v"}, "channel", TS, 5)
+    scheduler.schedule_job("ns1_odd_job", {"k": "v"}, "channel", TS, 6)
+    scheduler.schedule_job("ns1_even_job", {"k": "v"}, "channel", TS, 7)
+    scheduler.schedule_job("ns2_good_job", {"k": "v"}, "channel", TS, 8)
+    scheduler.schedule_job("ns3_good_job", {"k": "v"}, "channel", TS, 9)
+    freezer.move_to(T(10))
+
+    limits = {"ns1": 2, "ns2": 0}
+    job_ids = scheduler.reserve_jobs(max_running_by_namespace=limits)
+    assert [scheduler.get_job(job_id)["type"] for job_id in job_ids] == [
+        "ns1_good_job",
+        "ns1_odd_job",
+        "ns3_good_job",
+    ]
+
+    assert scheduler.reserve_jobs(max_running_by_namespace=limits) == []
+
+    # Once an ns1 job finishes, the next ns1 job can run
+    scheduler.mark_job_done(job_ids[0])
+    [job_id] = scheduler.reserve_jobs(max_running_by_namespace=limits)
+    assert scheduler.get_job(job_id)["type"] == "ns1_even_job"
+
+
+def test_reserve_jobs_in_priority_order(freezer):
+    scheduler.schedule_job("report_job", {"k": "v"}, "channel", TS, 5)
+    scheduler.schedule_job("deploy_job", {"k": "v"}, "channel", TS, 6, priority=10)
+    freezer.move_to(T(10))
+
+    job_ids = scheduler.reserve_jobs()
+    assert [scheduler.get_job(job_id)["type"] for job_id in job_ids] == [
+        "deploy_job",
+        "report_job",
+    ]
+
+
+def test_reserve_jobs_admits_higher_priority_jobs_first(freezer):
+    scheduler.schedule_job("ns_report_job", {"k": "v"}, "channel", TS, 5)
+    scheduler.schedule_job("ns_other_report_job", {"k": "v"}, "channel", TS, 6)
+    scheduler.schedule_job("ns_deploy_job", {"k": "v"}, "channel", TS, 7, priority=10)
+    freezer.move_to(T(10))
+
+    [job_id] = scheduler.reserve_jobs(max_running=1)
+    assert scheduler.get_job(job_id)["type"] == "ns_deploy_job"
+
+    scheduler.mark_job_done(job_id)
+    [job_id] = scheduler.reserve_jobs(max_running_by_namespace={"ns": 1})
+    assert scheduler.get_job(job_id)["type"] == "ns_report_job"
+
+
+def test_schedule_job_updates_priority():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.schedule_job("good_job", {"k": "w"}, "channel", TS, 0, priority=5)
+
+    [job] = scheduler.get_jobs_of_type("good_job")
+    assert job["priority"] == 5
+
+
+def test_get_next_wakeup_with_nothing_scheduled():
+    assert scheduler.get_next_wakeup() is None
+
+
+def test_get_next_wakeup_with_job_scheduled():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 10)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 5)
+
+    assert str(scheduler.get_next_wakeup()) == T(5)
+
+
+def test_get_next_wakeup_ignores_jobs_already_due():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+
+    assert scheduler.get_next_wakeup() is None
+
+
+def test_get_next_wakeup_with_suppression():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 10)
+    scheduler.schedule_suppression("good_job", T(-5), T(5))
+
+    assert str(scheduler.get_next_wakeup()) == T(5)
+
+
+def test_get_next_wakeup_with_recurring_job():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 3600)
+    scheduler.sync_recurring_jobs([recurring_job("30 11 * * *")])
+
+    assert str(scheduler.get_next_wakeup()) == "2019-12-10 11:30:00+00:00"
+
+
+def test_mark_job_done_notifies_dispatcher(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+
+    with patch("bennettbot.scheduler.notify_dispatcher") as notify_dispatcher:
+        scheduler.mark_job_done(job_id)
+    notify_dispatcher.assert_called_once()
+
+
+def test_schedule_job_notifies_dispatcher():
+    with patch("bennettbot.scheduler.notify_dispatcher") as notify_dispatcher:
+        scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 10)
+    notify_dispatcher.assert_called_once_with([T0 + timedelta(seconds=10)])
+
+
+def test_get_pending_start_times(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.reserve_job()
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 20)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 10)
+    scheduler.schedule_job("even_job", {"k": "v"}, "channel", TS, 0)
+
+    assert scheduler.get_pending_start_times() == [
+        T0 + timedelta(seconds=10),
+        T0 + timedelta(seconds=20),
+    ]
+
+
+def test_cancel_suppressions_notifies_dispatcher():
+    with patch("bennettbot.scheduler.notify_dispatcher") as notify_dispatcher:
+        scheduler.cancel_suppressions("good_job")
+    notify_dispatcher.assert_called_once()
+
+
+def test_get_job_recipients_of_unknown_job():
+    assert scheduler.get_job_recipients(123) == []
+
+
 def test_mark_job_done(freezer):
     scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
     freezer.move_to(T(10))
@@ -272,3 +642,454 @@ def test_mark_job_done(freezer):
     scheduler.mark_job_done(job_id)
 
     assert not scheduler.get_jobs()
+
+
+def test_retry_job(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0, coalesce="dedupe")
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel1", TS, 0, coalesce="dedupe")
+    job_id = scheduler.reserve_job()
+    freezer.move_to(T(10))
+
+    with patch("bennettbot.scheduler.notify_dispatcher") as notify_dispatcher:
+        scheduler.retry_job(job_id, 20)
+
+    notify_dispatcher.assert_called_once_with([T0 + timedelta(seconds=30)])
+    job = scheduler.get_job(job_id)
+    assert job["start_after"] == T(30)
+    assert job["started_at"] is None
+    assert job["lease_expires_at"] is None
+    assert job["attempt"] == 2
+    assert len(scheduler.get_job_recipients(job_id)) == 2
+    # The job isn't available again until it is due
+    assert scheduler.reserve_job() is None
+    freezer.move_to(T(30))
+    assert scheduler.reserve_job() == job_id
+
+
+def test_schedule_job_replacing_retried_job_resets_attempt():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    scheduler.retry_job(job_id, 20)
+
+    scheduler.schedule_job("good_job", {"k": "w"}, "channel", TS, 0)
+
+    assert scheduler.get_job(job_id)["attempt"] == 1
+
+
+def test_record_job_pid():
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+
+    scheduler.record_job_pid(job_id, 1234)
+
+    assert scheduler.get_job(job_id)["pid"] == 1234
+    # The pid is forgotten if the job is retried
+    scheduler.retry_job(job_id, 20)
+    assert scheduler.get_job(job_id)["pid"] is None
+    # Recording the pid of a job that has been removed does nothing
+    scheduler.mark_job_done(job_id)
+    scheduler.record_job_pid(job_id, 1234)
+    assert not scheduler.get_jobs()
+
+
+def test_request_job_kill():
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0)
+    scheduler.schedule_job("odd_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    assert scheduler.get_jobs_to_kill() == []
+
+    with patch("bennettbot.scheduler.notify_dispatcher") as notify_dispatcher:
+        scheduler.request_job_kill(job_id, "channel1", TS)
+
+    notify_dispatcher.assert_called_once_with()
+    assert scheduler.get_jobs_to_kill() == [job_id]
+    job = scheduler.get_job(job_id)
+    assert job["kill_requested"]
+    assert job["kill_requested_channel"] == "channel1"
+    assert job["kill_requested_thread_ts"] == TS
+
+
+def test_cancel_job_kill():
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    scheduler.request_job_kill(job_id, "channel1", TS)
+
+    scheduler.cancel_job_kill(job_id)
+    # Jobs that don't exist are ignored
+    scheduler.cancel_job_kill(job_id + 1)
+
+    assert scheduler.get_jobs_to_kill() == []
+    job = scheduler.get_job(job_id)
+    assert not job["kill_requested"]
+    assert job["kill_requested_channel"] is None
+    assert job["kill_requested_thread_ts"] is None
+
+
+def test_request_job_kill_ignores_jobs_that_have_not_started():
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0)
+    [job] = scheduler.get_jobs()
+
+    scheduler.request_job_kill(job["id"], "channel", TS)
+    # Jobs that don't exist are ignored too
+    scheduler.request_job_kill(job["id"] + 1, "channel", TS)
+
+    assert scheduler.get_jobs_to_kill() == []
+
+
+def test_reserve_job_sets_lease(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    freezer.move_to(T(10))
+    job_id = scheduler.reserve_job()
+
+    assert scheduler.get_job(job_id)["lease_expires_at"] == T(70)
+
+
+def test_renew_job_lease(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 5)
+    job_id = scheduler.reserve_job()
+    freezer.move_to(T(20))
+
+    scheduler.renew_job_lease(job_id)
+    # Pending jobs have no lease to renew
+    scheduler.renew_job_lease(job_id + 1)
+    # Nor do jobs that have finished
+    scheduler.renew_job_lease(job_id + 2)
+
+    assert [job["lease_expires_at"] for job in scheduler.get_jobs()] == [T(80), None]
+
+
+def test_fail_expired_jobs(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 0, coalesce="dedupe")
+    scheduler.schedule_job(
+        "odd_job", {"k": "v"}, "channel1", None, 0, is_im=True, coalesce="dedupe"
+    )
+    good_job_id, odd_job_id = scheduler.reserve_jobs()
+    freezer.move_to(T(30))
+    scheduler.renew_job_lease(good_job_id)
+    # Another good_job is queued behind the running one
+    scheduler.schedule_job("good_job", {"k": "w"}, "channel", TS, 0)
+
+    freezer.move_to(T(61))
+    [(job, recipients)] = scheduler.fail_expired_jobs()
+
+    assert job.id == odd_job_id
+    assert recipients == [
+        {"channel": "channel", "thread_ts": TS, "is_im": 0},
+        {"channel": "channel1", "thread_ts": None, "is_im": 1},
+    ]
+    assert [job["type"] for job in scheduler.get_jobs()] == ["good_job", "good_job"]
+    [job_run] = scheduler.get_job_runs()
+    assert job_run["rc"] == scheduler.LEASE_EXPIRED_RC
+    assert job_run["log_dir"] is None
+
+    freezer.move_to(T(91))
+    [(job, _)] = scheduler.fail_expired_jobs()
+
+    assert job.id == good_job_id
+    # The queued good_job can now run
+    assert scheduler.reserve_job() is not None
+
+
+def test_fail_expired_jobs_ignores_running_jobs(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    freezer.move_to(T(61))
+
+    assert scheduler.fail_expired_jobs(running_job_ids=[job_id]) == []
+    assert [job["id"] for job in scheduler.get_jobs()] == [job_id]
+
+
+def test_schedule_job_with_fresh():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0, fresh=True)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 0, coalesce="dedupe")
+    scheduler.schedule_job(
+        "odd_job", {"k": "v"}, "channel", TS, 0, coalesce="dedupe", fresh=True
+    )
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 0, coalesce="dedupe")
+
+    assert [job["fresh"] for job in scheduler.get_jobs()] == [1, 1]
+
+
+def test_cache_result(freezer):
+    scheduler.cache_result("good_job", {"k": "v", "j": "w"}, "the owl")
+    freezer.tick(timedelta(seconds=10))
+
+    assert scheduler.get_cached_result("good_job", {"j": "w", "k": "v"}, 10) == {
+        "stdout": "the owl",
+        "created_at": T(0),
+    }
+    assert scheduler.get_cached_result("good_job", {"j": "w", "k": "v"}, 9) is None
+    assert scheduler.get_cached_result("good_job", {"k": "v"}, 10) is None
+    assert scheduler.get_cached_result("odd_job", {"j": "w", "k": "v"}, 10) is None
+
+    scheduler.cache_result("good_job", {"k": "v", "j": "w"}, "the pussycat")
+    assert scheduler.get_cached_result("good_job", {"k": "v", "j": "w"}, 0) == {
+        "stdout": "the pussycat",
+        "created_at": T(10),
+    }
+
+
+def test_cache_result_evicts_least_recently_used_results(freezer):
+    with patch("bennettbot.settings.RESULT_CACHE_MAX_BYTES", 20):
+        scheduler.cache_result("good_job", {"k": "1"}, "0123456789")
+        freezer.tick(timedelta(seconds=1))
+        scheduler.cache_result("good_job", {"k": "2"}, "0123456789")
+        freezer.tick(timedelta(seconds=1))
+        scheduler.get_cached_result("good_job", {"k": "1"}, 60)
+        freezer.tick(timedelta(seconds=1))
+        scheduler.cache_result("good_job", {"k": "3"}, "0123456789")
+
+    assert scheduler.get_cached_result("good_job", {"k": "1"}, 60)
+    assert scheduler.get_cached_result("good_job", {"k": "2"}, 60) is None
+    assert scheduler.get_cached_result("good_job", {"k": "3"}, 60)
+
+
+def test_record_job_run(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    freezer.move_to(T(10))
+    job_id = scheduler.reserve_job()
+    freezer.move_to(T(25))
+
+    scheduler.record_job_run(job_id, 0, "logs/good_job")
+    scheduler.mark_job_done(job_id)
+
+    assert scheduler.get_metrics() == {
+        "jobs_started_total": 1,
+        "jobs_finished_total": 1,
+        "jobs_failed_total": 0,
+    }
+    [job_run] = scheduler.get_job_runs()
+    assert job_run == {
+        "id": 1,
+        "job_id": job_id,
+        "type": "good_job",
+        "args": {"k": "v"},
+        "queued_at": T(0),
+        "started_at": T(10),
+        "finished_at": T(25),
+        "rc": 0,
+        "log_dir": "logs/good_job",
+    }
+
+
+def test_record_job_run_of_removed_job():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    scheduler.mark_job_done(job_id)
+
+    scheduler.record_job_run(job_id, 0, "logs/good_job")
+    scheduler.retry_job(job_id, 20)
+    scheduler.mark_job_done(job_id)
+
+    assert not scheduler.get_job_runs()
+    assert scheduler.get_job(job_id) is None
+    assert not scheduler.get_jobs()
+
+
+def test_get_queue_stats(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.reserve_job()
+    freezer.move_to(T(10))
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 0)
+    freezer.move_to(T(20))
+    scheduler.schedule_job("odd_job", {"k": "w"}, "channel", TS, 0, coalesce="queue")
+
+    assert scheduler.get_queue_stats() == [
+        {
+            "type": "good_job",
+            "pending": 1,
+            "running": 1,
+            "oldest_pending_created_at": T(10),
+        },
+        {
+            "type": "odd_job",
+            "pending": 2,
+            "running": 0,
+            "oldest_pending_created_at": T(10),
+        },
+    ]
+
+
+def test_increment_metrics():
+    scheduler.increment_metrics({"jobs_started_total": 1})
+    scheduler.increment_metrics({"jobs_started_total": 2, "jobs_failed_total": 1})
+
+    assert scheduler.get_metrics() == {"jobs_started_total": 3, "jobs_failed_total": 1}
+
+
+def test_memory_storage_does_not_touch_database(freezer):
+    with patch("bennettbot.settings.SCHEDULER_STORAGE", "memory"):
+        scheduler.sync_recurring_jobs([recurring_job("0 12 * * *")])
+        freezer.move_to("2019-12-10 12:00:10+00:00")
+        assert scheduler.schedule_recurring_jobs() == ["good_job"]
+        job_id = scheduler.reserve_job()
+        scheduler.get_next_wakeup()
+        scheduler.cache_result("good_job", {"k": "v"}, "the owl")
+        scheduler.get_cached_result("good_job", {"k": "v"}, 10)
+        scheduler.record_job_run(job_id, 0, None)
+        scheduler.mark_job_done(job_id)
+        scheduler.record_dispatcher_tick(0.5)
+
+        assert scheduler.get_metrics()["jobs_started_total"] == 1
+        assert len(scheduler.get_job_run_stats()) == 1
+    assert not os.path.exists(settings.DB_PATH)
+
+
+def test_get_job_run_stats(freezer):
+    for duration, rc in [(10, 0), (20, 0), (30, 1), (40, 0)]:
+        run_job("good_job", duration, rc, freezer)
+    run_job("odd_job", 5, 1, freezer)
+
+    assert scheduler.get_job_run_stats() == [
+        {"type": "good_job", "runs": 4, "failure_rate": 0.25, "p50": 20, "p95": 40},
+        {"type": "odd_job", "runs": 1, "failure_rate": 1, "p50": 5, "p95": 5},
+    ]
+    assert scheduler.get_job_run_stats("odd_job") == [
+        {"type": "odd_job", "runs": 1, "failure_rate": 1, "p50": 5, "p95": 5},
+    ]
+
+
+def test_get_job_runs(freezer):
+    run_job("good_job", 10, 0, freezer)
+    run_job("odd_job", 5, 1, freezer)
+    freezer.tick(timedelta(days=2))
+    run_job("good_job", 20, 1, freezer)
+
+    assert [(run["type"], run["rc"]) for run in scheduler.get_job_runs()] == [
+        ("good_job", 0),
+        ("odd_job", 1),
+        ("good_job", 1),
+    ]
+    assert [run["rc"] for run in scheduler.get_job_runs("good_job", days=1)] == [1]
+
+
+def test_get_job_run_stats_ignores_old_runs(freezer):
+    run_job("good_job", 10, 0, freezer)
+    freezer.tick(timedelta(days=31))
+
+    assert scheduler.get_job_run_stats() == []
+
+
+def test_sync_recurring_jobs():
+    scheduler.sync_recurring_jobs([recurring_job("0 9 * * *")])
+
+    [rj] = scheduler.get_recurring_jobs()
+    assert rj["job_type"] == "good_job"
+    assert rj["args"] == {"k": "v"}
+    assert rj["next_run_at"] == "2019-12-11 09:00:00+00:00"
+
+
+def test_sync_recurring_jobs_keeps_next_run_at_of_existing_schedules(freezer):
+    scheduler.sync_recurring_jobs(
+        [recurring_job("0 9 * * *"), recurring_job("0 10 * * *")]
+    )
+    freezer.tick(timedelta(days=2))
+    scheduler.sync_recurring_jobs(
+        [recurring_job("0 9 * * *", priority=3), recurring_job("0 12 * * *")]
+    )
+
+    assert [
+        (rj["cron"], rj["priority"], rj["next_run_at"])
+        for rj in scheduler.get_recurring_jobs()
+    ] == [
+        ("0 9 * * *", 3, "2019-12-11 09:00:00+00:00"),
+        ("0 12 * * *", 0, "2019-12-12 12:00:00+00:00"),
+    ]
+
+
+def test_schedule_recurring_jobs(freezer):
+    scheduler.sync_recurring_jobs([recurring_job("0 12 * * *", priority=3)])
+    assert scheduler.schedule_recurring_jobs() == []
+
+    freezer.move_to("2019-12-10 12:00:10+00:00")
+    assert scheduler.schedule_recurring_jobs() == ["good_job"]
+    assert scheduler.schedule_recurring_jobs() == []
+
+    [job] = scheduler.get_jobs()
+    assert_job_matches(job, "good_job", {"k": "v"}, "#channel", T(2877), None)
+    assert job["thread_ts"] is None
+    assert job["priority"] == 3
+    [rj] = scheduler.get_recurring_jobs()
+    assert rj["next_run_at"] == "2019-12-11 12:00:00+00:00"
+
+
+def test_schedule_recurring_jobs_changes_nothing_if_jobs_cannot_be_scheduled(
+    freezer,
+):
+    scheduler.sync_recurring_jobs([recurring_job("0 12 * * *")])
+    freezer.move_to("2019-12-10 12:00:10+00:00")
+
+    backend = storage.get_storage()
+    with patch.object(type(backend), "schedule_jobs", side_effect=ValueError):
+        with pytest.raises(ValueError):
+            scheduler.schedule_recurring_jobs()
+
+    assert not scheduler.get_jobs()
+    [rj] = scheduler.get_recurring_jobs()
+    assert rj["next_run_at"] == "2019-12-10 12:00:00+00:00"
+    assert scheduler.schedule_recurring_jobs() == ["good_job"]
+
+
+def test_schedule_recurring_jobs_with_coalesce(freezer):
+    scheduler.sync_recurring_jobs(
+        [
+            recurring_job("0 12 * * *", coalesce="dedupe"),
+            recurring_job("0 12 * * *", coalesce="dedupe") | {"channel": "#other"},
+        ]
+    )
+
+    freezer.move_to("2019-12-10 12:00:10+00:00")
+    assert scheduler.schedule_recurring_jobs() == ["good_job", "good_job"]
+
+    [job] = scheduler.get_jobs()
+    assert len(scheduler.get_job_recipients(job["id"])) == 2
+
+
+def test_schedule_recurring_jobs_combines_missed_runs(freezer):
+    scheduler.sync_recurring_jobs([recurring_job("0 * * * *")])
+
+    freezer.move_to("2019-12-10 15:30:00+00:00")
+    assert scheduler.schedule_recurring_jobs() == ["good_job"]
+
+    assert len(scheduler.get_jobs()) == 1
+    [rj] = scheduler.get_recurring_jobs()
+    assert rj["next_run_at"] == "2019-12-10 16:00:00+00:00"
+
+
+def test_schedule_recurring_jobs_without_catch_up(freezer):
+    scheduler.sync_recurring_jobs([recurring_job("0 * * * *", catch_up=False)])
+
+    # Missed by more than DISPATCHER_MAX_SLEEP_SECONDS, so skipped
+    freezer.move_to("2019-12-10 15:30:00+00:00")
+    assert scheduler.schedule_recurring_jobs() == []
+
+    # Only just due, so scheduled
+    freezer.move_to("2019-12-10 16:00:30+00:00")
+    assert scheduler.schedule_recurring_jobs() == ["good_job"]
+
+    [rj] = scheduler.get_recurring_jobs()
+    assert rj["next_run_at"] == "2019-12-10 17:00:00+00:00"
+
+
+def recurring_job(cron, catch_up=True, priority=0, coalesce="replace"):
+    return {
+        "job_type": "good_job",
+        "cron": cron,
+        "args": {"k": "v"},
+        "channel": "#channel",
+        "catch_up": catch_up,
+        "priority": priority,
+        "coalesce": coalesce,
+    }
+
+
+def run_job(type_, duration, rc, freezer):
+    scheduler.schedule_job(type_, {}, "channel", TS, 0)
+    job_id = scheduler.reserve_job()
+    freezer.tick(timedelta(seconds=duration))
+    scheduler.record_job_run(job_id, rc, "logs")
+    scheduler.mark_job_done(job_id)
@@ -0,0 +1,133 @@
+import pytest
+
+from bennettbot.storage import Job, Suppression, SuppressionIndex
+
+from .time_helpers import TS, T
+
+
+def suppression(id_, job_type, start, end):
+    return Suppression(id_, job_type, T(start), T(end))
+
+
+def job(args):
+    return Job(
+        1,
+        "good_job",
+        args,
+        "channel",
+        TS,
+        T(0),
+        None,
+        0,
+        T(0),
+        0,
+        0,
+        None,
+        1,
+        None,
+        0,
+        None,
+        None,
+    )
+
+
+def test_job_args_are_decoded_lazily():
+    # Invalid JSON is only noticed when args are read
+    record = job("{")
+    with pytest.raises(ValueError):
+        record.args
+
+    record = job('{"k": "v"}')
+    args = record.args
+
+    assert args == {"k": "v"}
+    # Args are only decoded once
+    assert record.args is args
+    assert record["args"] is args
+
+
+def test_record_fields_can_be_read_by_key():
+    record = suppression(1, "good_job", 0, 10)
+
+    assert record["job_type"] == record.job_type == "good_job"
+    with pytest.raises(KeyError):
+        record["type"]
+
+
+def test_record_equality():
+    assert suppression(1, "good_job", 0, 10) == suppression(1, "good_job", 0, 10)
+    assert suppression(1, "good_job", 0, 10) != suppression(1, "good_job", 0, 11)
+    assert job('{"k": "v"}') != suppression(1, "good_job", 0, 10)
+
+
+def test_record_repr():
+    assert repr(Suppression(1, "good_job", "a", "b")) == (
+        "Suppression(id=1, job_type='good_job', start_at='a', end_at='b')"
+    )
+
+
+def test_suppression_index_with_no_suppressions():
+    index = SuppressionIndex([])
+
+    assert not index.is_suppressed("good_job", T(0))
+    assert index.suppressed_types(T(0)) == set()
+    assert index.next_boundary(T(0)) is None
+    assert index.partition(T(0)) == ([], [])
+
+
+def test_suppression_index_is_suppressed():
+    index = SuppressionIndex([suppression(1, "good_job", 0, 10)])
+
+    assert not index.is_suppressed("good_job", T(0))
+    assert index.is_suppressed("good_job", T(1))
+    assert index.is_suppressed("good_job", T(10))
+    assert not index.is_suppressed("good_job", T(11))
+    assert not index.is_suppressed("odd_job", T(5))
+
+
+def test_suppression_index_merges_overlapping_suppressions():
+    index = SuppressionIndex(
+        [
+            suppression(1, "good_job", 20, 30),
+            suppression(2, "good_job", 0, 10),
+            suppression(3, "good_job", 5, 15),
+            # Touches the end of the previous suppression
+            suppression(4, "good_job", 15, 18),
+            suppression(5, "odd_job", 0, 40),
+        ]
+    )
+
+    assert index.suppressed_until("good_job", T(1)) == T(18)
+    assert index.suppressed_until("good_job", T(16)) == T(18)
+    assert index.suppressed_until("good_job", T(19)) is None
+    assert index.suppressed_until("good_job", T(25)) == T(30)
+    assert index.suppressed_types(T(19)) == {"odd_job"}
+    assert index.suppressed_types(T(25)) == {"good_job", "odd_job"}
+
+
+def test_suppression_index_next_boundary():
+    index = SuppressionIndex(
+        [suppression(1, "good_job", 0, 10), suppression(2, "odd_job", 5, 20)]
+    )
+
+    assert index.next_boundary(T(-5)) == T(0)
+    assert index.next_boundary(T(0)) == T(0)
+    assert index.next_boundary(T(1)) == T(5)
+    assert index.next_boundary(T(12)) == T(20)
+    assert index.next_boundary(T(21)) is None
+
+
+def test_suppression_index_partition():
+    suppressions = [
+        suppression(1, "good_job", 5, 10),
+        suppression(2, "good_job", -10, -5),
+        suppression(3, "odd_job", -5, 5),
+        suppression(4, "odd_job", 0, 5),
+    ]
+    index = SuppressionIndex(reversed(suppressions))
+
+    # Suppressions that have ended are in neither list
+    assert index.partition(T(0)) == (
+        [suppressions[2]],
+        [suppressions[0], suppressions[3]],
+    )
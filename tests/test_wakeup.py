@@ -0,0 +1,96 @@
+import asyncio
+import socket
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+
+from bennettbot.wakeup import Listener, notify_dispatcher
+
+from .time_helpers import T0
+
+
+def at(seconds):
+    return T0 + timedelta(seconds=seconds)
+
+
+def wait(listener, timeout):
+    return asyncio.run(listener.wait(timeout))
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    path = tmp_path / "dispatcher.sock"
+    with patch("bennettbot.settings.DISPATCHER_SOCKET_PATH", path):
+        yield path
+
+
+def test_notify_dispatcher_when_not_listening(socket_path):
+    # This doesn't raise
+    notify_dispatcher()
+
+
+def test_listener_times_out(socket_path):
+    listener = Listener()
+    assert wait(listener, 0.01) is None
+    listener.close()
+
+
+def test_listener_is_notified(socket_path):
+    listener = Listener()
+    notify_dispatcher()
+    notify_dispatcher()
+
+    assert wait(listener, 1) == []
+    # Both notifications were handled by the first wait
+    assert wait(listener, 0.01) is None
+    listener.close()
+
+
+def test_listener_receives_start_times(socket_path):
+    listener = Listener()
+    notify_dispatcher([at(10), at(5)])
+    notify_dispatcher()
+    notify_dispatcher([at(1)])
+
+    assert wait(listener, 1) == [at(5), at(10), at(1)]
+    listener.close()
+
+
+def test_listener_skips_invalid_start_times(socket_path):
+    listener = Listener()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.sendto(
+            b"\n".join(
+                [
+                    at(5).isoformat().encode(),
+                    b"not a time",
+                    b"2019-12-10T11:12:13",
+                    b"\xff",
+                    at(1).isoformat().encode(),
+                ]
+            ),
+            str(socket_path),
+        )
+
+    assert wait(listener, 1) == [at(5), at(1)]
+    listener.close()
+
+
+@patch("bennettbot.wakeup.MAX_NOTIFIED_START_TIMES", 2)
+def test_notify_dispatcher_sends_earliest_start_times(socket_path):
+    listener = Listener()
+    notify_dispatcher([at(10), at(5), at(1)])
+
+    assert wait(listener, 1) == [at(1), at(5)]
+    listener.close()
+
+
+def test_listener_replaces_stale_socket(socket_path):
+    Listener().close()
+    assert socket_path.exists()
+
+    listener = Listener()
+    notify_dispatcher()
+    assert wait(listener, 1) == []
+    listener.close()
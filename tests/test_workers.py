@@ -0,0 +1,237 @@
+import asyncio
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from bennettbot import scheduler, settings, workers
+
+
+# Entrypoints for the tests below.  Coverage isn't measured in the worker pool, so
+# those that are only called there are excluded.
+
+
+def greet(greeting, name):
+    print(f"{greeting}...")
+    return f"{greeting} {name}!"
+
+
+def print_and_read_back(path):
+    print("Hello")
+    with open(path) as f:
+        return f"Read {f.read()!r}"
+
+
+def no_output():
+    return None
+
+
+def pid():  # pragma: no cover
+    return os.getpid()
+
+
+def print_cwd():
+    return os.getcwd()
+
+
+def raise_error():
+    raise ValueError("Something went wrong")
+
+
+def exit_with(code):
+    sys.exit(code)
+
+
+def sleep_for(seconds):
+    try:
+        time.sleep(seconds)
+    except Exception:  # pragma: no cover
+        # Timeouts aren't caught by a function's own error handling
+        return "Caught"
+
+
+def kill_worker():  # pragma: no cover
+    os._exit(1)
+
+
+def run_in_worker(*args):
+    return asyncio.run(workers.run_in_worker(*args))
+
+
+@pytest.fixture
+def log_paths(tmp_path):
+    return tmp_path / "stdout", tmp_path / "stderr"
+
+
+def run_entrypoint(function_name, args, log_paths, cwd=None):
+    """Call the function with given name in this module directly, returning its rc,
+    stdout and stderr."""
+
+    stdout_path, stderr_path = log_paths
+    rc = workers.run_entrypoint(
+        f"{__name__}:{function_name}",
+        args,
+        cwd or os.getcwd(),
+        stdout_path,
+        stderr_path,
+    )
+    return rc, stdout_path.read_text(), stderr_path.read_text()
+
+
+def test_run_entrypoint(log_paths):
+    assert run_entrypoint("greet", {"greeting": "Hi", "name": "Bob"}, log_paths) == (
+        0,
+        "Hi...\nHi Bob!\n",
+        "",
+    )
+
+
+def test_run_entrypoint_writes_each_line_as_it_is_printed(log_paths):
+    stdout_path, _ = log_paths
+    assert run_entrypoint(
+        "print_and_read_back", {"path": str(stdout_path)}, log_paths
+    ) == (0, "Hello\nRead 'Hello\\n'\n", "")
+
+
+def test_run_entrypoint_with_no_output(log_paths):
+    assert run_entrypoint("no_output", {}, log_paths) == (0, "", "")
+
+
+def test_run_entrypoint_runs_in_cwd(log_paths, tmp_path):
+    cwd = os.getcwd()
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+
+    assert run_entrypoint("print_cwd", {}, log_paths, cwd=workspace) == (
+        0,
+        f"{workspace}\n",
+        "",
+    )
+    assert os.getcwd() == cwd
+
+
+def test_run_entrypoint_with_error(log_paths):
+    rc, stdout, stderr = run_entrypoint("raise_error", {}, log_paths)
+
+    assert rc == 1
+    assert stdout == ""
+    assert stderr.startswith("Traceback")
+    assert stderr.endswith("ValueError: Something went wrong\n")
+
+
+def test_run_entrypoint_with_unknown_function(log_paths):
+    rc, _, stderr = run_entrypoint("unknown", {}, log_paths)
+
+    assert rc == 1
+    assert "AttributeError" in stderr
+
+
+@pytest.mark.parametrize(
+    "code,rc,stderr",
+    [(None, 0, ""), (0, 0, ""), (3, 3, ""), ("Bad input", 1, "Bad input\n")],
+)
+def test_run_entrypoint_with_exit(log_paths, code, rc, stderr):
+    assert run_entrypoint("exit_with", {"code": code}, log_paths) == (rc, "", stderr)
+
+
+def test_run_entrypoint_with_timeout(log_paths):
+    stdout_path, stderr_path = log_paths
+
+    rc = workers.run_entrypoint(
+        f"{__name__}:sleep_for", {"seconds": 5}, os.getcwd(), *log_paths, 0.1
+    )
+
+    assert rc == scheduler.TIMED_OUT_RC
+    assert stdout_path.read_text() == ""
+    assert stderr_path.read_text().endswith(
+        "JobTimedOut: Timed out after 0.1 seconds\n"
+    )
+    # The timer is cancelled, and the previous handler restored
+    assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+    assert signal.getsignal(signal.SIGALRM) == signal.SIG_DFL
+
+
+def test_run_entrypoint_finishing_before_timeout(log_paths):
+    rc = workers.run_entrypoint(
+        f"{__name__}:sleep_for", {"seconds": 0}, os.getcwd(), *log_paths, 5
+    )
+
+    assert rc == 0
+    assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+
+
+def test_run_in_worker(log_paths):
+    stdout_path, stderr_path = log_paths
+
+    rc = run_in_worker(
+        f"{__name__}:greet",
+        {"greeting": "Hi", "name": "Bob"},
+        os.getcwd(),
+        stdout_path,
+        stderr_path,
+    )
+
+    assert rc == 0
+    assert stdout_path.read_text() == "Hi...\nHi Bob!\n"
+
+
+def test_run_in_worker_with_timeout(log_paths):
+    rc = run_in_worker(
+        f"{__name__}:sleep_for", {"seconds": 5}, os.getcwd(), *log_paths, 0.1
+    )
+
+    assert rc == scheduler.TIMED_OUT_RC
+
+
+def test_run_in_worker_does_not_hold_a_thread(tmp_path):
+    async def run():
+        # With a single thread for asyncio.to_thread(), calls made in threads can
+        # still be made while jobs run
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(1))
+        jobs = [
+            asyncio.create_task(
+                workers.run_in_worker(
+                    f"{__name__}:sleep_for",
+                    {"seconds": 1},
+                    os.getcwd(),
+                    tmp_path / f"stdout{i}",
+                    tmp_path / f"stderr{i}",
+                )
+            )
+            for i in range(settings.PYTHON_WORKER_POOL_SIZE + 1)
+        ]
+        # Give the jobs time to be submitted, then check that a call in a thread
+        # doesn't wait for them to finish
+        await asyncio.sleep(0.3)
+        await asyncio.wait_for(asyncio.to_thread(lambda: None), 0.5)
+        return await asyncio.gather(*jobs)
+
+    assert asyncio.run(run()) == [0] * (settings.PYTHON_WORKER_POOL_SIZE + 1)
+
+
+def test_run_in_worker_reuses_pool(log_paths):
+    stdout_path, stderr_path = log_paths
+    pids = set()
+    for _ in range(3):
+        run_in_worker(f"{__name__}:pid", {}, os.getcwd(), stdout_path, stderr_path)
+        pids.add(stdout_path.read_text())
+
+    assert workers.get_executor() is workers.get_executor()
+    assert len(pids) <= settings.PYTHON_WORKER_POOL_SIZE
+
+
+def test_run_in_worker_when_worker_dies(log_paths):
+    stdout_path, stderr_path = log_paths
+    executor = workers.get_executor()
+
+    rc = run_in_worker(
+        f"{__name__}:kill_worker", {}, os.getcwd(), stdout_path, stderr_path
+    )
+
+    assert rc == -1
+    assert "BrokenProcessPool" in stderr_path.read_text()
+    # The broken pool is replaced
+    assert workers.get_executor() is not executor
@@ -25,7 +25,9 @@ dummy_config = build_config(
     {
         "test": {
             "default_channel": "#some-team",
-            "jobs": {"deploy": {"run_args_template": "fab deploy:production"}},
+            "jobs": {
+                "deploy": {"run_args_template": "fab deploy:production", "priority": 10}
+            },
             "slack": [],
         }
     }
@@ -70,6 +72,7 @@ def test_on_closed_merged_pr(web_client):
     jj = scheduler.get_jobs_of_type("test_deploy")
     assert len(jj) == 1
     assert_job_matches(jj[0], "test_deploy", {}, "#some-team", T(60), None)
+    assert jj[0]["priority"] == 10
     # no suppressions, no messages sent
     assert_slack_client_sends_messages(messages_kwargs=[])
 
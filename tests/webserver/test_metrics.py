@@ -0,0 +1,119 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+
+from bennettbot import scheduler
+
+from ..time_helpers import T0, TS, T
+
+
+# Make sure all tests run when datetime.now() returning T0
+pytestmark = pytest.mark.freeze_time(T0)
+
+AUTH_HEADERS = {"Authorization": "Bearer metrics_token"}
+
+
+def test_metrics_with_nothing_recorded(web_client):
+    rsp = web_client.get("/metrics", headers=AUTH_HEADERS)
+
+    assert rsp.status_code == 200
+    assert rsp.content_type == "text/plain; version=0.0.4; charset=utf-8"
+    assert rsp.data.decode() == (
+        "# HELP bennettbot_jobs_pending Jobs waiting to run, by type.\n"
+        "# TYPE bennettbot_jobs_pending gauge\n"
+        "# HELP bennettbot_jobs_running Jobs running, by type.\n"
+        "# TYPE bennettbot_jobs_running gauge\n"
+        "# HELP bennettbot_oldest_pending_job_age_seconds How long ago the oldest job that is waiting to run was scheduled.\n"
+        "# TYPE bennettbot_oldest_pending_job_age_seconds gauge\n"
+        "bennettbot_oldest_pending_job_age_seconds 0.0\n"
+        "# HELP bennettbot_suppressions_active Active suppressions, by job type.\n"
+        "# TYPE bennettbot_suppressions_active gauge\n"
+        "# HELP bennettbot_jobs_started_total Jobs started by the dispatcher.\n"
+        "# TYPE bennettbot_jobs_started_total counter\n"
+        "bennettbot_jobs_started_total 0.0\n"
+        "# HELP bennettbot_jobs_finished_total Jobs that finished, including those reported from the cache.\n"
+        "# TYPE bennettbot_jobs_finished_total counter\n"
+        "bennettbot_jobs_finished_total 0.0\n"
+        "# HELP bennettbot_jobs_failed_total Jobs that finished with a non-zero rc.\n"
+        "# TYPE bennettbot_jobs_failed_total counter\n"
+        "bennettbot_jobs_failed_total 0.0\n"
+        "# HELP bennettbot_jobs_retried_total Jobs that failed and were queued to be attempted again.\n"
+        "# TYPE bennettbot_jobs_retried_total counter\n"
+        "bennettbot_jobs_retried_total 0.0\n"
+        "# HELP bennettbot_dispatcher_tick_seconds Time taken by each run of the dispatcher's loop.\n"
+        "# TYPE bennettbot_dispatcher_tick_seconds summary\n"
+        "bennettbot_dispatcher_tick_seconds_sum 0.0\n"
+        "bennettbot_dispatcher_tick_seconds_count 0.0\n"
+        "# HELP bennettbot_dispatcher_last_tick_seconds Time taken by the last run of the dispatcher's loop.\n"
+        "# TYPE bennettbot_dispatcher_last_tick_seconds gauge\n"
+        "bennettbot_dispatcher_last_tick_seconds 0.0\n"
+        "# HELP bennettbot_dispatcher_last_tick_timestamp_seconds When the dispatcher's loop last ran, as a Unix timestamp.\n"
+        "# TYPE bennettbot_dispatcher_last_tick_timestamp_seconds gauge\n"
+        "bennettbot_dispatcher_last_tick_timestamp_seconds 0.0\n"
+    )
+
+
+def test_metrics(freezer, web_client):
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0)
+    scheduler.schedule_job("bad_job", {}, "channel", TS, 0)
+    good_job_id, bad_job_id = scheduler.reserve_jobs()
+    scheduler.record_job_run(bad_job_id, 1, "logs/bad_job")
+    scheduler.mark_job_done(bad_job_id)
+    freezer.move_to(T(10))
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0, coalesce="queue")
+    scheduler.schedule_job("odd_job", {}, "channel", TS, 0)
+    scheduler.schedule_job("odd_job", {}, "channel", TS, 0, coalesce="queue")
+    scheduler.schedule_suppression("odd_job", T(5), T(50))
+    scheduler.schedule_suppression("odd_job", T(15), T(60))
+    scheduler.schedule_suppression('quoted"job', T(5), T(50))
+    # Not active yet
+    scheduler.schedule_suppression("good_job", T(45), T(60))
+    scheduler.record_dispatcher_tick(0.25)
+    freezer.move_to(T(40))
+    scheduler.record_dispatcher_tick(0.5)
+
+    rsp = web_client.get("/metrics", headers=AUTH_HEADERS)
+
+    samples = [
+        line for line in rsp.data.decode().splitlines() if not line.startswith("#")
+    ]
+    assert samples == [
+        'bennettbot_jobs_pending{type="good_job"} 1.0',
+        'bennettbot_jobs_pending{type="odd_job"} 2.0',
+        'bennettbot_jobs_running{type="good_job"} 1.0',
+        'bennettbot_jobs_running{type="odd_job"} 0.0',
+        "bennettbot_oldest_pending_job_age_seconds 30.0",
+        'bennettbot_suppressions_active{type="odd_job"} 2.0',
+        'bennettbot_suppressions_active{type="quoted\\"job"} 1.0',
+        "bennettbot_jobs_started_total 2.0",
+        "bennettbot_jobs_finished_total 1.0",
+        "bennettbot_jobs_failed_total 1.0",
+        "bennettbot_jobs_retried_total 0.0",
+        "bennettbot_dispatcher_tick_seconds_sum 0.75",
+        "bennettbot_dispatcher_tick_seconds_count 2.0",
+        "bennettbot_dispatcher_last_tick_seconds 0.5",
+        f"bennettbot_dispatcher_last_tick_timestamp_seconds {(T0 + timedelta(seconds=40)).timestamp()!r}",
+    ]
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {},
+        {"Authorization": "metrics_token"},
+        {"Authorization": "Basic metrics_token"},
+        {"Authorization": "Bearer wrong_token"},
+    ],
+)
+def test_metrics_with_invalid_token(web_client, headers):
+    rsp = web_client.get("/metrics", headers=headers)
+
+    assert rsp.status_code == 403
+
+
+@patch("bennettbot.settings.METRICS_TOKEN", b"")
+def test_metrics_with_no_token_configured(web_client):
+    rsp = web_client.get("/metrics", headers={"Authorization": "Bearer "})
+
+    assert rsp.status_code == 403